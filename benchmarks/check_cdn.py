@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Checks CDN purges of the indexer app against a stub purge endpoint.
+
+Generates a synthetic tree, starts benchmarks.server on it with the fake
+GitHub and INDEXER_CDN_PURGE_URL pointing at benchmarks.fake_purge, then
+checks the cache headers of directory.json, that a reindex without changes
+purges nothing and that a new build of one branch only purges the keys of
+that channel and of the whole index. Exits non-zero on failures.
+
+    python3 -m benchmarks.check_cdn
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from .fixtures import ROOT_DIR, make_staged_build
+from .fake_purge import FakePurgeEndpoint
+from .loadtest import wait_for_server
+from .check_metrics import TOKEN, request
+
+PURGE_TOKEN = "bench-purge"
+# seconds without a purge after which a reindex is taken as fully purged
+PURGE_QUIET = 1.0
+
+
+def get_keys(purges: list) -> set:
+    return {key for _, body in purges for key in body["keys"]}
+
+
+def check(port: int, root: str, endpoint: FakePurgeEndpoint) -> list:
+    """
+    A method for running the checks against a started server
+    Returns:
+        List of failures
+    """
+    failures = []
+    purges = endpoint.take(PURGE_QUIET)
+    if not {"firmware", "asset-packs"} <= get_keys(purges):
+        failures.append(f"first reindexes purged {sorted(get_keys(purges))}")
+    if any(auth != f"Bearer {PURGE_TOKEN}" for auth, _ in purges):
+        failures.append("purges were sent without the token")
+
+    status, headers, _ = request(
+        port, "GET", "/firmware/directory.json?channel=development"
+    )
+    if "s-maxage" not in headers.get("cache-control", ""):
+        failures.append(f"directory.json Cache-Control {headers.get('cache-control')}")
+    if headers.get("surrogate-key") != "firmware/development":
+        failures.append(f"directory.json Surrogate-Key {headers.get('surrogate-key')}")
+
+    request(port, "GET", "/firmware/reindex", headers={"Token": TOKEN})
+    purges = endpoint.take(PURGE_QUIET)
+    if purges:
+        failures.append(f"unchanged reindex purged {sorted(get_keys(purges))}")
+
+    # a new build of one branch, as an upload would publish it
+    make_staged_build(os.path.join(root, "firmware", "feature-1"), "feature-1", 4, 64)
+    request(port, "GET", "/firmware/reindex", headers={"Token": TOKEN})
+    purges = endpoint.take(PURGE_QUIET)
+    expected = {"firmware", "firmware/wip-feature-1"}
+    if get_keys(purges) != expected:
+        failures.append(
+            f"new feature-1 build purged {sorted(get_keys(purges))}, "
+            f"expected {sorted(expected)}"
+        )
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8768)
+    parser.add_argument("--branches", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    endpoint = FakePurgeEndpoint()
+    purge_url = endpoint.start()
+    root = tempfile.mkdtemp(prefix="indexer-check-cdn-")
+    try:
+        from . import server as bench_server
+
+        bench_server.generate(
+            root,
+            argparse.Namespace(branches=args.branches, artifacts=4, size=64, packs=2),
+        )
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.server",
+                "--port",
+                str(args.port),
+                "--files-dir",
+                root,
+                "--branches",
+                str(args.branches),
+            ],
+            cwd=ROOT_DIR,
+            env={
+                **os.environ,
+                "INDEXER_TOKEN": TOKEN,
+                "INDEXER_CDN_PURGE_URL": purge_url,
+                "INDEXER_CDN_PURGE_TOKEN": PURGE_TOKEN,
+            },
+        )
+        try:
+            wait_for_server(f"http://127.0.0.1:{args.port}", args.timeout)
+            failures = check(args.port, root, endpoint)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        endpoint.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK purges only carried changed surrogate keys")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Checks /metrics of the indexer app running on synthetic data.
+
+Starts benchmarks.server with the fake GitHub, makes the requests every
+metric family is fed by (directory.json, a forced reindex, a resumable
+upload), then scrapes /metrics with and without the token and checks that
+every family has samples with the expected labels. Exits non-zero on
+failures.
+
+    python3 -m benchmarks.check_metrics
+"""
+import os
+import sys
+import argparse
+import subprocess
+import http.client
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from .fixtures import ROOT_DIR
+from .loadtest import wait_for_server
+
+TOKEN = "bench"
+UPLOAD_SIZE = 64 * 1024
+
+# metric name -> labels that each have to be on one of its non-zero samples
+EXPECTED = {
+    "indexer_reindex_phase_seconds_count": [
+        {"phase": "github_sync"},
+        {"phase": "commit_fetch"},
+        {"phase": "directory_scan"},
+        {"phase": "hashing"},
+    ],
+    "indexer_reindex_seconds_count": [
+        {"directory": "firmware", "kind": "full"},
+        {"directory": "asset-packs", "kind": "full"},
+    ],
+    "indexer_request_seconds_count": [
+        {"route": "/firmware/directory.json", "method": "GET"},
+        {"route": "/{directory}/uploads/{upload_id}", "method": "PATCH"},
+    ],
+    "indexer_upload_bytes_count": [{"route": "/{directory}/uploads/{upload_id}"}],
+    "indexer_lock_wait_seconds_count": [{"lock": "reindex"}],
+    "indexer_index_bytes": [{"directory": "firmware"}, {"directory": "asset-packs"}],
+    "indexer_github_calls_total": [{"call": "get_branches"}],
+}
+
+
+def request(port: int, method: str, path: str, body: bytes = None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    connection.request(method, path, body=body, headers=headers or {})
+    response = connection.getresponse()
+    headers = {name.lower(): value for name, value in response.getheaders()}
+    return response.status, headers, response.read()
+
+
+def exercise(port: int) -> None:
+    """
+    A method for making the requests the metrics are fed by
+    """
+    token = {"Token": TOKEN}
+    for _ in range(3):
+        request(port, "GET", "/firmware/directory.json")
+    status, _, _ = request(port, "GET", "/firmware/reindex", headers=token)
+    assert status == 200, f"reindex answered {status}"
+    status, headers, _ = request(
+        port,
+        "POST",
+        "/asset-packs/uploads",
+        headers={
+            **token,
+            "Upload-Length": str(UPLOAD_SIZE),
+            # filename check.bin
+            "Upload-Metadata": "filename Y2hlY2suYmlu",
+        },
+    )
+    assert status == 201, f"upload creation answered {status}"
+    location = headers["location"]
+    status, _, _ = request(
+        port,
+        "PATCH",
+        location,
+        body=os.urandom(UPLOAD_SIZE),
+        headers={
+            **token,
+            "Upload-Offset": "0",
+            "Content-Type": "application/offset+octet-stream",
+        },
+    )
+    assert status == 204, f"upload answered {status}"
+
+
+def check(body: str) -> list:
+    """
+    A method for checking a scrape against EXPECTED
+    Returns:
+        List of failures
+    """
+    samples = [
+        sample
+        for family in text_string_to_metric_families(body)
+        for sample in family.samples
+    ]
+    failures = []
+    for name, expected in EXPECTED.items():
+        for labels in expected:
+            if not any(
+                sample.name == name
+                and sample.value > 0
+                and labels.items() <= sample.labels.items()
+                for sample in samples
+            ):
+                failures.append(f"{name} has no sample with {labels}")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--branches", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.server",
+            "--port",
+            str(args.port),
+            "--branches",
+            str(args.branches),
+            "--packs",
+            "2",
+        ],
+        cwd=ROOT_DIR,
+        env={**os.environ, "INDEXER_TOKEN": TOKEN},
+    )
+    try:
+        wait_for_server(f"http://127.0.0.1:{args.port}", args.timeout)
+        exercise(args.port)
+        failures = []
+        status, _, _ = request(args.port, "GET", "/metrics")
+        if status != 401:
+            failures.append(f"/metrics without a token answered {status}")
+        status, _, body = request(
+            args.port, "GET", "/metrics", headers={"Token": TOKEN}
+        )
+        if status != 200:
+            failures.append(f"/metrics answered {status}")
+        else:
+            failures.extend(check(body.decode()))
+        status, _, _ = request(
+            args.port, "GET", "/metrics", headers={"Authorization": f"Bearer {TOKEN}"}
+        )
+        if status != 200:
+            failures.append(f"/metrics with a bearer token answered {status}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"OK {sum(map(len, EXPECTED.values()))} metric samples checked")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Index encoding benchmark, directory.json against the compact msgpack form.
+
+Reindexes a synthetic tree with the fake GitHub, then compares the size
+(raw and gzipped) of the full index in both encodings and how long a
+client takes to decode it: json.loads, msgpack.unpackb alone, and
+msgpack.unpackb with urls and hex digests restored to the json form.
+
+    python3 -m benchmarks.encoding --branches 50 --packs 20
+"""
+import os
+import gzip
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+
+import msgpack
+
+
+def restore(data, base_url: str, prefixes: list):
+    """
+    A method for turning a compact index back into the json form, what a
+    client that wants full urls does after decoding
+    """
+    if isinstance(data, list):
+        return [restore(value, base_url, prefixes) for value in data]
+    if not isinstance(data, dict):
+        return data
+    result = {}
+    for key, value in data.items():
+        if key.endswith("url") and isinstance(value, list):
+            value = base_url + prefixes[value[0]] + "/" + value[1]
+        elif key == "sha256" and isinstance(value, bytes):
+            value = value.hex()
+        else:
+            value = restore(value, base_url, prefixes)
+        result[key] = value
+    return result
+
+
+def decode_restored(body: bytes) -> dict:
+    compact = msgpack.unpackb(body)
+    return restore(compact["index"], compact["base_url"], compact["prefixes"])
+
+
+def time_decode(decode, body: bytes, repeat: int) -> float:
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(body)
+        runs.append(time.perf_counter() - started)
+    return statistics.median(runs)
+
+
+def measure(slices, repeat: int) -> dict:
+    json_body = slices.get()[0]
+    msgpack_body = slices.get(compact=True)[0]
+    # the compact form has to carry the same index
+    assert decode_restored(msgpack_body) == json.loads(json_body)
+    return {
+        "json_bytes": len(json_body),
+        "json_gzip_bytes": len(gzip.compress(json_body)),
+        "msgpack_bytes": len(msgpack_body),
+        "msgpack_gzip_bytes": len(gzip.compress(msgpack_body)),
+        "json_decode_s": time_decode(json.loads, json_body, repeat),
+        "msgpack_decode_s": time_decode(msgpack.unpackb, msgpack_body, repeat),
+        "msgpack_restore_s": time_decode(decode_restored, msgpack_body, repeat),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--artifacts", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--releases", type=int, default=10)
+    parser.add_argument("--packs", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    root = tempfile.mkdtemp(prefix="indexer-encoding-")
+    try:
+        from . import fixtures, fake_github, server
+
+        settings = fixtures.use_files_dir(root)
+        settings.tracing = False
+        fake_github.configure(args.branches, args.tags, args.releases, 0.0)
+        fake_github.install()
+        server.generate(root, args)
+
+        from src.repository import indexes
+
+        report = {}
+        for directory, index in indexes.items():
+            index.reindex()
+            report[directory] = measure(index.slices, args.repeat)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for directory, result in report.items():
+        print(
+            f"{directory:12} size json {result['json_bytes']:8}B "
+            f"(gzip {result['json_gzip_bytes']:7}B)  "
+            f"msgpack {result['msgpack_bytes']:8}B "
+            f"(gzip {result['msgpack_gzip_bytes']:7}B)"
+        )
+        print(
+            f"{'':12} decode json {result['json_decode_s'] * 1000:7.2f}ms  "
+            f"msgpack {result['msgpack_decode_s'] * 1000:7.2f}ms  "
+            f"msgpack+restore {result['msgpack_restore_s'] * 1000:7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import sys
+import time
+import datetime
+from types import SimpleNamespace
+
+from .fixtures import get_branch_names, get_build_sha
+
+# what the fake repository serves, see configure()
+config = {"branches": 1, "tags": 0, "releases": 1, "latency": 0.0}
+
+
+class FakeList(list):
+    """
+    The parts of PyGithub's PaginatedList the indexer uses
+    """
+
+    @property
+    def totalCount(self) -> int:
+        return len(self)
+
+    def get_page(self, page: int) -> list:
+        return self[page * 30 : (page + 1) * 30]
+
+
+class FakeRepository:
+    full_name = "bench/Momentum-Firmware"
+
+    def call(self, items: list) -> FakeList:
+        if config["latency"]:
+            time.sleep(config["latency"])
+        return FakeList(items)
+
+    def get_tags(self) -> FakeList:
+        return self.call(
+            SimpleNamespace(name=f"tag-{i}") for i in range(config["tags"])
+        )
+
+    def get_releases(self) -> FakeList:
+        return self.call(
+            SimpleNamespace(
+                title=get_release_name(i),
+                body="## 🚀 Changelog\n- Synthetic release",
+                prerelease=False,
+                created_at=datetime.datetime(2024, 1, 1) - datetime.timedelta(days=i),
+            )
+            for i in range(config["releases"])
+        )
+
+    def get_branches(self) -> FakeList:
+        names = [*get_branch_names(config["branches"]), "release"]
+        return self.call(SimpleNamespace(name=name) for name in names)
+
+    def get_commits(self, branch: str) -> FakeList:
+        return self.call(
+            SimpleNamespace(
+                sha=get_build_sha(branch, i) + "0" * 32,
+                html_url=f"https://github.com/{self.full_name}/commit/{i}",
+                author=SimpleNamespace(login="bench"),
+                commit=SimpleNamespace(
+                    message=f"Synthetic commit {i}",
+                    author=SimpleNamespace(
+                        date=datetime.datetime(2024, 1, 1) - datetime.timedelta(hours=i)
+                    ),
+                ),
+            )
+            for i in range(30)
+        )
+
+
+def get_release_name(i: int = 0) -> str:
+    return f"mntm-{999 - i:03d}"
+
+
+def configure(
+    branches: int, tags: int = 0, releases: int = 1, latency: float = 0.0
+) -> None:
+    """
+    A method to set what the fake GitHub repository serves
+    Args:
+        branches: Number of branches, including dev
+        tags: Number of tags
+        releases: Number of releases, the first one is the latest
+        latency: Seconds every API call takes
+
+    Returns:
+        Nothing
+    """
+    config.update(branches=branches, tags=tags, releases=releases, latency=latency)
+
+
+def install() -> None:
+    """
+    A method for replacing IndexerGithub with a subclass backed by
+    FakeRepository, has to run before src.repository is imported
+    """
+    if "src.repository" in sys.modules:
+        raise RuntimeError("install() has to run before src.repository is imported")
+    from src import models
+
+    class FakeIndexerGithub(models.IndexerGithub):
+        def connect(self) -> None:
+            self._IndexerGithub__repo = FakeRepository()
+            self._IndexerGithub__git = SimpleNamespace(
+                rate_limiting=(5000, 5000), rate_limiting_resettime=2e9
+            )
+
+    models.IndexerGithub = FakeIndexerGithub
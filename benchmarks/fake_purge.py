@@ -0,0 +1,60 @@
+import json
+import time
+import threading
+import http.server
+
+
+class FakePurgeEndpoint:
+    """
+    A CDN purge hook that records what the indexer POSTs to it, see
+    INDEXER_CDN_PURGE_URL
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (Authorization header, JSON body) of every purge
+        self.purges = []
+        self.server = None
+
+    def start(self) -> str:
+        """
+        A method for serving the endpoint on a free port in a thread
+        Returns:
+            URL to purge with
+        """
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with endpoint.lock:
+                    endpoint.purges.append(
+                        (self.headers.get("Authorization"), json.loads(body))
+                    )
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/purge"
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+
+    def take(self, wait: float) -> list:
+        """
+        A method to get the purges received since the last call, after
+        `wait` seconds without a new one
+        """
+        count = -1
+        while True:
+            with self.lock:
+                if len(self.purges) == count:
+                    purges, self.purges = self.purges, []
+                    return purges
+                count = len(self.purges)
+            time.sleep(wait)
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import subprocess
+
+# (target, type, extension) of the artifacts of one build, cycled when a
+# build has more artifacts than this
+ARTIFACTS = [
+    ("f7", "update", "tgz"),
+    ("f7", "full", "dfu"),
+    ("f7", "full", "json"),
+    ("f7", "full", "elf"),
+    ("f7", "updater", "json"),
+    ("any", "resources", "tgz"),
+    ("f7", "sdk", "zip"),
+    ("f7", "debug", "elf"),
+]
+BUILDS_PER_BRANCH = 20
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_files_dir(root: str):
+    """
+    A method for pointing the indexer settings, including the hidden
+    directories under files_dir, at a scratch directory. Has to run before
+    anything but src.settings is imported
+    Args:
+        root: Scratch directory
+
+    Returns:
+        The settings object
+    """
+    sys.path.insert(0, os.path.join(ROOT_DIR, "indexer"))
+    os.environ.setdefault("INDEXER_TOKEN", "bench")
+    from src.settings import settings
+
+    settings.files_dir = root
+    for field in type(settings).model_fields:
+        if field.endswith("_dir") and field != "files_dir":
+            setattr(settings, field, os.path.join(root, "." + field[:-4]))
+    return settings
+
+
+def get_branch_names(branches: int) -> list:
+    """
+    A method to get the branch names of a synthetic repository
+    Args:
+        branches: Number of branches, including dev
+
+    Returns:
+        ["dev", "feature-1", ...]
+    """
+    return ["dev"] + [f"feature-{i}" for i in range(1, branches)]
+
+
+def get_build_sha(branch: str, build: int) -> str:
+    return hashlib.sha1(f"{branch}/{build}".encode()).hexdigest()[:8]
+
+
+def get_artifact_names(version: str, artifacts: int) -> list:
+    names = []
+    for i in range(artifacts):
+        target, type, ext = ARTIFACTS[i % len(ARTIFACTS)]
+        if i >= len(ARTIFACTS):
+            type += str(i // len(ARTIFACTS))
+        names.append(f"flipper-z-{target}-{type}-mntm-{version}.{ext}")
+    return names
+
+
+def make_firmware_tree(
+    root: str,
+    branches: int,
+    artifacts: int,
+    size: int,
+    release: str = None,
+    builds: int = BUILDS_PER_BRANCH,
+) -> None:
+    """
+    A method for generating a `files/firmware` tree like the one uploads
+    leave behind, newest build last modified
+    Args:
+        root: Directory to create the branch directories in
+        branches: Number of branches, including dev
+        artifacts: Artifacts per build
+        size: Bytes per artifact
+        release: Also create a directory with one build of this release
+        builds: Builds kept per branch
+
+    Returns:
+        Nothing
+    """
+    block = random.Random(0).randbytes(size)
+    # the newest builds were uploaded a while ago, as on a live server
+    now = time.time() - 600
+    dirs = {branch: builds for branch in get_branch_names(branches)}
+    if release:
+        dirs[release] = 1
+    for branch, count in dirs.items():
+        branch_dir = os.path.join(root, branch)
+        os.makedirs(branch_dir, exist_ok=True)
+        for build in range(count):
+            if branch == release:
+                version = release.removeprefix("mntm-")
+            else:
+                version = get_build_sha(branch, build)
+            mtime = now - build * 60
+            for name in get_artifact_names(version, artifacts):
+                path = os.path.join(branch_dir, name)
+                with open(path, "wb") as file:
+                    file.write(name.encode())
+                    file.write(block)
+                os.utime(path, (mtime, mtime))
+        os.utime(branch_dir, (now, now))
+
+
+def make_staged_build(root: str, branch: str, artifacts: int, size: int) -> None:
+    """
+    A method for generating one new build, as uploadfiles stages it
+    """
+    block = random.Random(1).randbytes(size)
+    os.makedirs(root, exist_ok=True)
+    for name in get_artifact_names(get_build_sha(branch, -1), artifacts):
+        with open(os.path.join(root, name), "wb") as file:
+            file.write(name.encode())
+            file.write(block)
+
+
+def git(*args, cwd: str) -> None:
+    subprocess.check_call(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def make_asset_packs(root: str, dest: str, packs: int, size: int, commits: int) -> None:
+    """
+    A method for generating an asset packs git repository with a `dev`
+    branch, and a clone of it at `dest` to index, like the submodule
+    Args:
+        root: Scratch directory for the origin repository
+        dest: Where the clone goes, e.g. files_dir/asset-packs
+        packs: Number of packs
+        size: Bytes per pack download
+        commits: Commits after the initial one, each updating one pack
+
+    Returns:
+        Nothing
+    """
+    from PIL import Image
+
+    rng = random.Random(0)
+    work = os.path.join(root, "asset-packs-work")
+    origin = os.path.join(root, "asset-packs-origin.git")
+    os.makedirs(work)
+    git("init", "-q", "-b", "dev", cwd=work)
+    for i in range(packs):
+        pack = os.path.join(work, f"pack-{i}")
+        source = os.path.join(pack, "source", "Main")
+        for sub in ("Anims", "Icons/Passport", "Icons/Animations", "Fonts"):
+            os.makedirs(os.path.join(source, sub))
+        os.makedirs(os.path.join(pack, "download"))
+        os.makedirs(os.path.join(pack, "preview"))
+        with open(os.path.join(pack, "meta.json"), "w") as file:
+            json.dump(
+                {
+                    "name": f"Pack {i}",
+                    "author": f"author-{i % 7}",
+                    "description": f"Synthetic pack number {i}",
+                },
+                file,
+            )
+        with open(os.path.join(source, "Anims", "manifest.txt"), "w") as file:
+            file.writelines(f"Name: anim_{i}_{j}\n" for j in range(1 + i % 5))
+        for name in ("passport_128x64", "passport_happy_46x49", "icon_a", "icon_b"):
+            with open(os.path.join(source, "Icons", "Passport", name + ".png"), "wb"):
+                pass
+        with open(os.path.join(source, "Fonts", f"font_{i % 3}.u8f"), "wb"):
+            pass
+        for ext in ("tar.gz", "zip"):
+            with open(os.path.join(pack, "download", f"pack-{i}.{ext}"), "wb") as file:
+                file.write(rng.randbytes(size))
+        color = (i * 37 % 256, i * 91 % 256, 128)
+        Image.new("RGB", (128, 64), color).save(os.path.join(pack, "preview", "1.png"))
+    git("add", "-A", cwd=work)
+    git("commit", "-q", "-m", "Add packs", cwd=work)
+    for commit in range(commits):
+        i = rng.randrange(packs)
+        path = os.path.join(work, f"pack-{i}", "download", f"pack-{i}.tar.gz")
+        with open(path, "wb") as file:
+            file.write(rng.randbytes(size))
+        git("commit", "-q", "-a", "-m", f"Update pack-{i}", cwd=work)
+    git("clone", "-q", "--bare", work, origin, cwd=root)
+    git("clone", "-q", "-b", "dev", origin, dest, cwd=root)
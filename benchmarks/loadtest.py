@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Mixed HTTP load against the indexer app running on synthetic data.
+
+Starts benchmarks.server (unless --url is given), then polls directory.json,
+follows latest-file redirects and posts large uploadfiles (or uploadarchive
+tar streams) at the same time.
+Reports latency percentiles, throughput and error rate per route, and the
+directory.json latency while uploads are in flight.
+
+    python3 -m benchmarks.loadtest --duration 30 --pollers 16 --uploaders 2
+"""
+import os
+import sys
+import json
+import time
+import random
+import tarfile
+import argparse
+import threading
+import statistics
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+
+from .fixtures import ROOT_DIR, get_artifact_names
+
+TOKEN = "bench"
+BOUNDARY = "indexer-loadtest-boundary"
+
+
+class Recorder:
+    """
+    Collects (route, started, latency, ok, upload in flight) samples from
+    all workers
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        # uploads in flight, to tell reads stalled by them apart
+        self.uploading = 0
+
+    def add(
+        self, route: str, started: float, latency: float, ok: bool, busy: bool
+    ) -> None:
+        with self.lock:
+            self.samples.append((route, started, latency, ok, busy))
+
+    def upload_started(self) -> None:
+        with self.lock:
+            self.uploading += 1
+
+    def upload_finished(self) -> None:
+        with self.lock:
+            self.uploading -= 1
+
+
+def get_percentile(values: list, percentile: int) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+def make_upload_body(upload: int, artifacts: int, size: int) -> tuple:
+    """
+    A method for building a multipart uploadfiles request without copying
+    the artifact bytes for every file
+    Returns:
+        (list of body chunks, content length)
+    """
+    block = random.Random(upload).randbytes(size)
+    chunks = [
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="branch"\r\n\r\n'
+        f"feature-1\r\n".encode()
+    ]
+    for name in get_artifact_names(f"{upload:08x}", artifacts):
+        chunks.append(
+            f"--{BOUNDARY}\r\nContent-Disposition: form-data; "
+            f'name="files"; filename="{name}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode()
+        )
+        chunks.append(block)
+        chunks.append(b"\r\n")
+    chunks.append(f"--{BOUNDARY}--\r\n".encode())
+    return chunks, sum(len(chunk) for chunk in chunks)
+
+
+def make_archive_body(upload: int, artifacts: int, size: int) -> tuple:
+    """
+    A method for building an uploadarchive tar stream, same files as
+    make_upload_body()
+    Returns:
+        (list of body chunks, content length)
+    """
+    block = random.Random(upload).randbytes(size)
+    padding = b"\0" * (-size % tarfile.BLOCKSIZE)
+    chunks = []
+    for name in get_artifact_names(f"{upload:08x}", artifacts):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        chunks += [info.tobuf(format=tarfile.PAX_FORMAT), block, padding]
+    chunks.append(b"\0" * tarfile.BLOCKSIZE * 2)
+    return chunks, sum(len(chunk) for chunk in chunks)
+
+
+def worker(url: str, kind: str, args, recorder: Recorder, deadline: float) -> None:
+    parts = urlsplit(url)
+    connection = None
+    counter = 0
+    while time.monotonic() < deadline:
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                parts.hostname, parts.port, timeout=args.timeout
+            )
+        counter += 1
+        body = None
+        headers = {}
+        if kind == "directory.json":
+            method, path = "GET", "/firmware/directory.json"
+        elif kind == "latest":
+            method = "GET"
+            path = "/firmware/development/f7/update_tgz"
+        elif args.upload_format == "tar":
+            method, path = "POST", "/firmware/uploadarchive?branch=feature-1"
+            upload = threading.get_ident() % 65536 * 65536 + counter
+            body, length = make_archive_body(upload, args.artifacts, args.upload_size)
+            headers = {
+                "Token": TOKEN,
+                "Content-Type": "application/x-tar",
+                "Content-Length": str(length),
+            }
+        else:
+            method, path = "POST", "/firmware/uploadfiles"
+            upload = threading.get_ident() % 65536 * 65536 + counter
+            body, length = make_upload_body(upload, args.artifacts, args.upload_size)
+            headers = {
+                "Token": TOKEN,
+                "Content-Type": f"multipart/form-data; boundary={BOUNDARY}",
+                "Content-Length": str(length),
+            }
+        if kind == "upload":
+            recorder.upload_started()
+        busy = recorder.uploading > 0
+        started = time.monotonic()
+        ok = False
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = None
+        finally:
+            if kind == "upload":
+                recorder.upload_finished()
+        recorder.add(kind, started, time.monotonic() - started, ok, busy)
+        if kind == "upload" and args.upload_interval:
+            time.sleep(args.upload_interval)
+
+
+def wait_for_server(url: str, timeout: float) -> None:
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, 1)
+            connection.request("GET", "/firmware/directory.json")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up in {timeout}s")
+
+
+def report(recorder: Recorder, duration: float) -> dict:
+    routes = {}
+    for route in ("directory.json", "latest", "upload"):
+        samples = [s for s in recorder.samples if s[0] == route]
+        if not samples:
+            continue
+        latencies = sorted(s[2] for s in samples)
+        routes[route] = {
+            "requests": len(samples),
+            "throughput": len(samples) / duration,
+            "error_rate": sum(not s[3] for s in samples) / len(samples),
+            "p50_ms": get_percentile(latencies, 50) * 1000,
+            "p99_ms": get_percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+    for route in ("directory.json", "latest"):
+        busy = sorted(s[2] for s in recorder.samples if s[0] == route and s[4])
+        if route in routes and busy:
+            routes[route]["p99_during_upload_ms"] = get_percentile(busy, 99) * 1000
+    return routes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="Use a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--pollers", type=int, default=16)
+    parser.add_argument("--redirects", type=int, default=4)
+    parser.add_argument("--uploaders", type=int, default=1)
+    parser.add_argument("--upload-interval", type=float, default=0.0)
+    parser.add_argument("--upload-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument(
+        "--upload-format",
+        choices=["multipart", "tar"],
+        default="multipart",
+        help="uploadfiles or uploadarchive",
+    )
+    parser.add_argument("--artifacts", type=int, default=8)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        url = f"http://127.0.0.1:{args.port}"
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.server",
+                "--port",
+                str(args.port),
+                "--branches",
+                str(args.branches),
+                "--artifacts",
+                str(args.artifacts),
+            ],
+            cwd=ROOT_DIR,
+            env={**os.environ, "INDEXER_TOKEN": TOKEN},
+        )
+    try:
+        wait_for_server(url, 60)
+        recorder = Recorder()
+        deadline = time.monotonic() + args.duration
+        threads = [
+            threading.Thread(
+                target=worker, args=(url, kind, args, recorder, deadline), daemon=True
+            )
+            for kind, count in (
+                ("directory.json", args.pollers),
+                ("latest", args.redirects),
+                ("upload", args.uploaders),
+            )
+            for _ in range(count)
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        routes = report(recorder, time.monotonic() - started)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(routes, indent=2))
+        return
+    for route, stats in routes.items():
+        line = (
+            f"{route:15} {stats['requests']:7} req {stats['throughput']:8.1f}/s  "
+            f"errors {stats['error_rate'] * 100:5.1f}%  "
+            f"p50 {stats['p50_ms']:8.1f}ms  p99 {stats['p99_ms']:8.1f}ms  "
+            f"max {stats['max_ms']:8.1f}ms"
+        )
+        if "p99_during_upload_ms" in stats:
+            line += f"  p99 while uploading {stats['p99_during_upload_ms']:8.1f}ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
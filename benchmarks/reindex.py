@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Reindex benchmarks against synthetic trees and a fake GitHub.
+
+Every scenario runs in its own process, so peak RSS is not shared between
+them. Results are appended to a history file and compared to the last run
+with the same parameters.
+
+    python3 -m benchmarks.reindex --branches 20 --artifacts 8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import statistics
+import subprocess
+from collections import Counter
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["firmware_reindex", "firmware_reindex_branch", "move_files", "packs"]
+# audit events worth counting, roughly one syscall each (or a process)
+AUDIT_EVENTS = {
+    "open",
+    "os.listdir",
+    "os.scandir",
+    "os.mkdir",
+    "os.remove",
+    "os.rename",
+    "os.rmdir",
+    "os.utime",
+    "os.link",
+    "shutil.move",
+    "shutil.copyfile",
+    "subprocess.Popen",
+}
+
+audit_counts = Counter()
+audit_enabled = False
+
+
+def audit_hook(event: str, args: tuple) -> None:
+    if audit_enabled and event in AUDIT_EVENTS:
+        audit_counts[event] += 1
+
+
+def read_proc_io() -> dict:
+    try:
+        with open("/proc/self/io", "r") as file:
+            return dict(
+                (key, int(value))
+                for key, value in (
+                    line.split(": ") for line in file.read().splitlines()
+                )
+            )
+    except OSError:
+        return {}
+
+
+def reset_peak_rss() -> bool:
+    # Linux only, makes VmHWM start again from the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss_kb() -> int:
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(operation, setup=None) -> dict:
+    """
+    A method to run one repeat of a scenario
+    Args:
+        operation: What is measured
+        setup: Runs before, not measured
+
+    Returns:
+        Wall time, peak RSS and syscall counts of the operation
+    """
+    global audit_enabled
+    if setup:
+        setup()
+    exact_rss = reset_peak_rss()
+    io_before = read_proc_io()
+    audit_counts.clear()
+    audit_enabled = True
+    started = time.perf_counter()
+    try:
+        operation()
+    finally:
+        wall = time.perf_counter() - started
+        audit_enabled = False
+    io_after = read_proc_io()
+    return {
+        "wall_s": wall,
+        "peak_rss_kb": read_peak_rss_kb(),
+        "peak_rss_exact": exact_rss,
+        "read_syscalls": io_after.get("syscr", 0) - io_before.get("syscr", 0),
+        "write_syscalls": io_after.get("syscw", 0) - io_before.get("syscw", 0),
+        "fs_calls": sum(audit_counts.values()),
+        "fs_call_counts": dict(audit_counts),
+    }
+
+
+def run_child(scenario: str, params: dict) -> dict:
+    """
+    A method for setting up a synthetic tree and measuring one scenario,
+    runs in the benchmark child process
+    """
+    logging.getLogger().setLevel(logging.ERROR)
+    root = tempfile.mkdtemp(prefix="indexer-bench-")
+    try:
+        from . import fixtures, fake_github
+
+        settings = fixtures.use_files_dir(root)
+        settings.tracing = False
+        fake_github.configure(
+            params["branches"], params["tags"], params["releases"], params["latency"]
+        )
+        fake_github.install()
+        firmware_dir = os.path.join(root, "firmware")
+        if scenario == "packs":
+            fixtures.make_asset_packs(
+                root,
+                os.path.join(root, "asset-packs"),
+                params["packs"],
+                params["size"],
+                params["pack_commits"],
+            )
+        else:
+            fixtures.make_firmware_tree(
+                firmware_dir,
+                params["branches"],
+                params["artifacts"],
+                params["size"],
+                release=fake_github.get_release_name(),
+                builds=params["builds"],
+            )
+
+        from src.repository import indexes
+        from src.file_upload import move_files_for_indexed
+        from src.tiering import stage_cold_file, commit_cold_files
+
+        sys.addaudithook(audit_hook)
+        firmware = indexes["firmware"]
+        setup = None
+        if scenario == "firmware_reindex":
+            operation = firmware.reindex
+        elif scenario == "firmware_reindex_branch":
+            firmware.reindex()
+            operation = lambda: firmware.reindex_branch("dev")
+        elif scenario == "move_files":
+            staging = os.path.join(root, ".staging", "bench")
+            counter = iter(range(1 << 30))
+
+            def setup():
+                shutil.rmtree(staging, ignore_errors=True)
+                fixtures.make_staged_build(
+                    staging,
+                    f"staged-{next(counter)}",
+                    params["artifacts"],
+                    params["size"],
+                )
+
+            def operation():
+                dest_dir = os.path.join(firmware_dir, "dev")
+                paths, files_per_build = move_files_for_indexed(dest_dir, staging, "")
+                # what the background tiering of an upload does
+                staged = [(path, *stage_cold_file(path)) for path in paths]
+                commit_cold_files(dest_dir, staged, files_per_build)
+
+        elif scenario == "packs":
+            # the first reindex renders the preview variants, measured separately
+            cold = measure(indexes["asset-packs"].reindex)
+            operation = indexes["asset-packs"].reindex
+        else:
+            raise ValueError(f"Unknown scenario {scenario}")
+
+        runs = [measure(operation, setup) for _ in range(params["repeat"])]
+        result = {
+            "wall_s": statistics.median(run["wall_s"] for run in runs),
+            "wall_s_min": min(run["wall_s"] for run in runs),
+            "peak_rss_kb": max(run["peak_rss_kb"] for run in runs),
+            "peak_rss_exact": all(run["peak_rss_exact"] for run in runs),
+            "read_syscalls": statistics.median(run["read_syscalls"] for run in runs),
+            "write_syscalls": statistics.median(run["write_syscalls"] for run in runs),
+            "fs_calls": statistics.median(run["fs_calls"] for run in runs),
+            "fs_call_counts": runs[-1]["fs_call_counts"],
+        }
+        if scenario == "packs":
+            result["cold_wall_s"] = cold["wall_s"]
+        return result
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def get_git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=ROOT_DIR,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def read_history(path: str) -> list:
+    if not os.path.isfile(path):
+        return []
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def format_change(current: float, previous: float) -> str:
+    if not previous:
+        return ""
+    return f" ({(current - previous) / previous * 100:+.1f}%)"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--builds", type=int, default=20)
+    parser.add_argument("--artifacts", type=int, default=8)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--releases", type=int, default=10)
+    parser.add_argument("--packs", type=int, default=50)
+    parser.add_argument("--pack-commits", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--history", default=os.path.join(ROOT_DIR, "benchmarks", "history.jsonl")
+    )
+    parser.add_argument("--no-history", action="store_true")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    params = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("scenarios", "history", "no_history", "child")
+    }
+
+    if args.child:
+        print(json.dumps(run_child(args.child, params)))
+        return
+
+    history = read_history(args.history)
+    commit = get_git_commit()
+    for scenario in args.scenarios:
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.reindex",
+                *sys.argv[1:],
+                "--child",
+                scenario,
+            ],
+            cwd=ROOT_DIR,
+        )
+        result = json.loads(output.decode().splitlines()[-1])
+        key = {k: v for k, v in params.items() if k != "repeat"}
+        previous = next(
+            (
+                entry["result"]
+                for entry in reversed(history)
+                if entry["scenario"] == scenario and entry["params"] == key
+            ),
+            {},
+        )
+        print(
+            f"{scenario:24} "
+            f"wall {result['wall_s'] * 1000:9.1f}ms"
+            f"{format_change(result['wall_s'], previous.get('wall_s'))}  "
+            f"peak rss {result['peak_rss_kb'] / 1024:7.1f}MiB"
+            f"{format_change(result['peak_rss_kb'], previous.get('peak_rss_kb'))}  "
+            f"syscalls r/w {result['read_syscalls']:.0f}/{result['write_syscalls']:.0f}  "
+            f"fs calls {result['fs_calls']:.0f}"
+            f"{format_change(result['fs_calls'], previous.get('fs_calls'))}"
+        )
+        entry = {
+            "time": int(time.time()),
+            "commit": commit,
+            "scenario": scenario,
+            "params": key,
+            "result": result,
+        }
+        history.append(entry)
+        if not args.no_history:
+            with open(args.history, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+
+
+if __name__ == "__main__":
+    main()
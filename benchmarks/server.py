@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Runs the indexer app against a synthetic files tree and a fake GitHub.
+
+    python3 -m benchmarks.server --port 8765 --branches 10
+
+--files-dir serves a tree generated earlier (kept on exit) and --real-github
+leaves the real GitHub client in place, see benchmarks.startup. With
+--replica-of the app starts empty and replicates another one:
+
+    python3 -m benchmarks.server --port 8766 --replica-of http://127.0.0.1:8765
+"""
+import os
+import shutil
+import argparse
+import tempfile
+
+
+def generate(root: str, args) -> None:
+    from . import fixtures, fake_github
+
+    fixtures.make_firmware_tree(
+        os.path.join(root, "firmware"),
+        args.branches,
+        args.artifacts,
+        args.size,
+        release=fake_github.get_release_name(),
+    )
+    fixtures.make_asset_packs(
+        root, os.path.join(root, "asset-packs"), args.packs, args.size, 0
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--artifacts", type=int, default=8)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--releases", type=int, default=10)
+    parser.add_argument("--packs", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--files-dir", help="Serve this tree instead of generating one")
+    parser.add_argument("--real-github", action="store_true")
+    parser.add_argument("--replica-of", help="URL of the primary to replicate")
+    args = parser.parse_args()
+
+    root = args.files_dir or tempfile.mkdtemp(prefix="indexer-server-")
+    try:
+        from . import fixtures, fake_github
+
+        settings = fixtures.use_files_dir(root)
+        settings.port = args.port
+        settings.replica_of = args.replica_of
+        fake_github.configure(args.branches, args.tags, args.releases, args.latency)
+        if not args.real_github:
+            fake_github.install()
+        if not args.files_dir and not args.replica_of:
+            generate(root, args)
+
+        import uvicorn
+        import main as app_main
+
+        uvicorn.run(
+            app_main.app,
+            host="127.0.0.1",
+            port=settings.port,
+            workers=settings.workers,
+            log_level="warning",
+        )
+    finally:
+        if not args.files_dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
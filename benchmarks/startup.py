@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark, from process start to the first served request.
+
+Generates a synthetic tree once, then starts benchmarks.server on it again
+and again with the real GitHub client and no network (proxies pointed at a
+closed port), and times how long it takes until the port accepts
+connections, until directory.json answers at all (503 until a reindex
+succeeded) and until it answers 200. Without the network the firmware index
+can't be built, so it never answers 200, pass --fake-github for that. Also
+times `import main` on its own.
+
+    python3 -m benchmarks.startup --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import http.client
+
+from .fixtures import ROOT_DIR
+
+# nothing listens on the discard port, so every request fails right away
+OFFLINE_PROXY = "http://127.0.0.1:9"
+
+
+def get_env(offline: bool) -> dict:
+    env = {**os.environ, "INDEXER_TOKEN": "bench"}
+    if offline:
+        for name in ("HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"):
+            env[name] = OFFLINE_PROXY
+        for name in ("NO_PROXY", "no_proxy"):
+            env.pop(name, None)
+    return env
+
+
+def measure_import(env: dict) -> float:
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import time; started = time.perf_counter(); import main; "
+            "print(time.perf_counter() - started)",
+        ],
+        cwd=os.path.join(ROOT_DIR, "indexer"),
+        env=env,
+    )
+    return float(output.decode().splitlines()[-1])
+
+
+def is_listening(port: int) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def get_status(port: int) -> int:
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        connection.request("GET", "/firmware/directory.json")
+        return connection.getresponse().status
+    except (OSError, http.client.HTTPException):
+        return 0
+
+
+def measure_start(files_dir: str, args, env: dict) -> dict:
+    """
+    A method to start the server once and wait for the first request
+    Returns:
+        Seconds until the port was bound, until directory.json answered
+        and until it was served
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.server",
+        "--port",
+        str(args.port),
+        "--files-dir",
+        files_dir,
+        "--branches",
+        str(args.branches),
+    ]
+    if not args.fake_github:
+        command.append("--real-github")
+    started = time.monotonic()
+    server = subprocess.Popen(
+        command,
+        cwd=ROOT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    result = {"listening_s": None, "first_response_s": None, "first_index_s": None}
+    try:
+        deadline = started + args.timeout
+        while time.monotonic() < deadline and server.poll() is None:
+            if result["listening_s"] is None and is_listening(args.port):
+                result["listening_s"] = time.monotonic() - started
+            status = get_status(args.port) if result["listening_s"] else 0
+            if status and result["first_response_s"] is None:
+                result["first_response_s"] = time.monotonic() - started
+            if status == 200:
+                result["first_index_s"] = time.monotonic() - started
+                break
+            time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+    return result
+
+
+def summarize(values: list) -> dict:
+    values = [value for value in values if value is not None]
+    if not values:
+        return {"median": None, "min": None}
+    return {"median": statistics.median(values), "min": min(values)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--artifacts", type=int, default=8)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--packs", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--online", action="store_true", help="Keep the network")
+    parser.add_argument(
+        "--fake-github", action="store_true", help="Serve GitHub from the fake"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    env = get_env(not args.online)
+    root = tempfile.mkdtemp(prefix="indexer-startup-")
+    try:
+        from . import server
+
+        server.generate(root, argparse.Namespace(**vars(args)))
+        imports = [measure_import(env) for _ in range(args.repeat)]
+        starts = [measure_start(root, args, env) for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {"import_main_s": summarize(imports)}
+    for name in ("listening_s", "first_response_s", "first_index_s"):
+        report[name] = summarize([start[name] for start in starts])
+    report["failed_starts"] = sum(start["first_index_s"] is None for start in starts)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for name in ("import_main_s", "listening_s", "first_response_s", "first_index_s"):
+        stats = report[name]
+        if stats["median"] is None:
+            print(f"{name:16} n/a")
+            continue
+        print(
+            f"{name:16} median {stats['median'] * 1000:8.1f}ms  "
+            f"min {stats['min'] * 1000:8.1f}ms"
+        )
+    if report["failed_starts"]:
+        print(
+            f"{report['failed_starts']} of {args.repeat} starts never served the index"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,89 @@
 #!/usr/bin/env python3
 import os
+import asyncio
 import logging
 import uvicorn
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from src import directories, file_upload, security
-from src.repository import indexes, raw_file_upload_directories
+from src import (
+    admission,
+    bundles,
+    cdn,
+    directories,
+    file_upload,
+    metrics,
+    replication,
+    scrubber,
+    security,
+    tiering,
+    tracing,
+)
+from src.repository import indexes, raw_file_upload_directories, RepositoryIndex
+from src.github_refresh import GithubRefresher
+from src.replication import Replica
+from src.reindex_pool import pool, reindex_until_initialized
+from src.watcher import FilesWatcher
 from src.settings import settings
-from pygelf import GelfTcpHandler
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     if not os.path.isdir(settings.files_dir):
         os.makedirs(settings.files_dir)
+    os.makedirs(settings.staging_dir, exist_ok=True)
+    pool.start(settings.reindex_workers)
+    if settings.cdn_purge_url:
+        cdn.purger.start()
     for index in indexes:
-        try:
-            index_path = os.path.join(settings.files_dir, index)
-            os.makedirs(index_path, exist_ok=True)
-            indexes[index].reindex()
-        except Exception:
-            logging.exception(f"Init {index} reindex failed")
+        index_path = os.path.join(settings.files_dir, index)
+        os.makedirs(index_path, exist_ok=True)
     for raw_upload_dir in raw_file_upload_directories:
         try:
             dir_path = os.path.join(settings.files_dir, raw_upload_dir)
             os.makedirs(dir_path, exist_ok=True)
         except Exception:
             logging.exception(f"Failed to create {dir_path}")
+    watcher = None
+    startups = {}
+    refreshers = []
+    replicas = []
+    if settings.replica_of:
+        # no reindexes and no GitHub calls, everything comes from the primary
+        for index in indexes.values():
+            replicas.append(Replica(index))
+            replicas[-1].start()
+    else:
+        # all indexes at once, bounded by the pool. Serving doesn't wait for
+        # them unless startup_reindex_wait is set, indexes answer 503 until
+        # a reindex succeeded, so a slow or unreachable GitHub doesn't keep
+        # the port closed
+        startups = {
+            index: asyncio.ensure_future(reindex_until_initialized(indexes[index]))
+            for index in indexes
+        }
+        if settings.startup_reindex_wait > 0:
+            await asyncio.wait(startups.values(), timeout=settings.startup_reindex_wait)
+            for index, startup in startups.items():
+                if not startup.done():
+                    logging.warning(f"Init {index} reindex not done yet")
+        if settings.watch_files:
+            try:
+                watcher = FilesWatcher()
+                watcher.start()
+            except Exception:
+                logging.exception("Failed to start files watcher")
+                watcher = None
+        if settings.github_refresh_interval > 0:
+            for index in indexes.values():
+                if isinstance(index, RepositoryIndex):
+                    refreshers.append(GithubRefresher(index))
+                    refreshers[-1].start()
+        for index in indexes.values():
+            if isinstance(index, RepositoryIndex):
+                index.gc.start()
+    if settings.scrub_rate > 0:
+        scrubber.scrubber.start()
     logger = logging.getLogger()
     prev_level = logger.level
     logger.setLevel(logging.INFO)
@@ -36,10 +92,30 @@ async def lifespan(app: FastAPI):
 
     yield
 
+    if watcher:
+        watcher.stop()
+    for refresher in refreshers:
+        refresher.stop()
+    for replica in replicas:
+        replica.stop()
+    if not settings.replica_of:
+        for index in indexes.values():
+            if isinstance(index, RepositoryIndex):
+                index.gc.stop()
+    for startup in startups.values():
+        startup.cancel()
+    scrubber.scrubber.stop()
+    cdn.purger.stop()
+    pool.stop()
+
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
 
 
+# inside check_token, so requests without a token don't take upload slots
+app.middleware("http")(admission.admit_upload)
+
+
 @app.middleware("http")
 async def check_token(request: Request, call_next):
     if security.check_token(request):
@@ -47,8 +123,16 @@ async def check_token(request: Request, call_next):
     return Response(status_code=401)
 
 
-app.include_router(file_upload.router)
+app.middleware("http")(metrics.observe_request)
+if not settings.replica_of:
+    app.include_router(file_upload.router)
 app.include_router(directories.router)
+app.include_router(bundles.router)
+app.include_router(metrics.router)
+app.include_router(tracing.router)
+app.include_router(replication.router)
+app.include_router(tiering.router)
+app.include_router(scrubber.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -68,6 +152,8 @@ def main() -> None:
     logger = logging.getLogger()
     logger.setLevel(logging.WARN)
     if settings.kubernetes_namespace and settings.gelf_host and settings.gelf_port:
+        from pygelf import GelfTcpHandler
+
         handler = GelfTcpHandler(
             host=settings.gelf_host,
             port=settings.gelf_port,
@@ -75,8 +161,12 @@ def main() -> None:
             _kubernetes_labels_app=settings.kubernetes_app,
             _kubernetes_container_name=settings.kubernetes_container,
             _kubernetes_pod_name=settings.kubernetes_pod,
+            include_extra_fields=True,
         )
         logger.addHandler(handler)
+    if settings.tracing:
+        # spans are logged at INFO, above the WARN of everything else
+        tracing.logger.setLevel(logging.INFO)
     uvicorn.run(
         "main:app",
         host="127.0.0.1",
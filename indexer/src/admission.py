@@ -0,0 +1,126 @@
+import shutil
+import logging
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from .metrics import UPLOADS_IN_FLIGHT, UPLOADS_REJECTED
+from .settings import settings
+
+
+# last path segment -> methods whose body is an upload
+UPLOAD_ROUTES = {
+    "uploadfiles": ("POST",),
+    "uploadfilesraw": ("POST",),
+    "uploadarchive": ("POST",),
+    "uploadmanifestfiles": ("POST",),
+}
+
+
+def get_upload_kind(request: Request) -> str:
+    """
+    A method to tell upload requests apart before they are routed
+    Returns:
+        "body" for requests carrying an upload body, "create" for tus
+        upload creation, None for everything else
+    """
+    parts = request.url.path.rstrip("/").split("/")
+    if request.method in UPLOAD_ROUTES.get(parts[-1], ()):
+        return "body"
+    if len(parts) >= 2 and parts[-2] == "uploads" and request.method == "PATCH":
+        return "body"
+    if parts[-1] == "uploads" and request.method == "POST":
+        return "create"
+    return None
+
+
+def get_length(request: Request, header: str) -> int:
+    length = request.headers.get(header, "")
+    # chunked bodies only count against the number of uploads
+    return int(length) if length.isdigit() else 0
+
+
+class UploadAdmission:
+    """
+    Decides whether an upload may start, before its body is read. Limits
+    the uploads in flight and the bytes they bring along, and keeps
+    settings.upload_min_free_bytes free on the files_dir volume. Everything
+    over the limits is turned away with 503 and Retry-After, instead of
+    queueing on the index lock with its body spooled
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.staged_bytes = 0
+
+    def get_free_bytes(self) -> int:
+        return shutil.disk_usage(settings.files_dir).free
+
+    def check(self, size: int, count: bool = True) -> str:
+        """
+        A method for checking an upload against the limits
+        Args:
+            size: Upload size in bytes, 0 if unknown
+            count: Counts against the number of uploads in flight
+
+        Returns:
+            Why the upload is rejected, None if it is admitted
+        """
+        if count and self.in_flight >= settings.max_concurrent_uploads:
+            return "uploads"
+        # a single upload over the budget still gets through on its own
+        if (
+            count
+            and self.in_flight > 0
+            and self.staged_bytes + size > settings.max_staged_bytes
+        ):
+            return "staged_bytes"
+        # bodies of uploads in flight may not be written out yet
+        free = self.get_free_bytes() - self.staged_bytes - size
+        if free < settings.upload_min_free_bytes:
+            return "disk"
+        return None
+
+    def reject(self, reason: str) -> JSONResponse:
+        UPLOADS_REJECTED.labels(reason).inc()
+        messages = {
+            "uploads": "Too many uploads in progress, try again later!",
+            "staged_bytes": "Too much upload data in progress, try again later!",
+            "disk": "Not enough disk space for the upload, try again later!",
+        }
+        logging.warning(messages[reason])
+        return JSONResponse(
+            messages[reason],
+            status_code=503,
+            headers={"Retry-After": str(settings.upload_retry_after)},
+        )
+
+
+admission = UploadAdmission()
+
+
+async def admit_upload(request: Request, call_next):
+    """
+    Middleware admitting uploads before their body is read, see
+    UploadAdmission
+    """
+    kind = get_upload_kind(request)
+    if kind is None:
+        return await call_next(request)
+    if kind == "create":
+        reason = admission.check(get_length(request, "Upload-Length"), count=False)
+        if reason:
+            return admission.reject(reason)
+        return await call_next(request)
+    size = get_length(request, "Content-Length")
+    reason = admission.check(size)
+    if reason:
+        return admission.reject(reason)
+    admission.in_flight += 1
+    admission.staged_bytes += size
+    UPLOADS_IN_FLIGHT.set(admission.in_flight)
+    try:
+        return await call_next(request)
+    finally:
+        admission.in_flight -= 1
+        admission.staged_bytes -= size
+        UPLOADS_IN_FLIGHT.set(admission.in_flight)
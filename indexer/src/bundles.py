@@ -0,0 +1,307 @@
+import os
+import time
+import zlib
+import struct
+import asyncio
+import hashlib
+import logging
+import tarfile
+import threading
+from collections import OrderedDict
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from .repository import indexes, RepositoryIndex
+from .cdn import get_cache_headers
+from .slices import match_etag
+from .directories import not_ready_response
+from .settings import settings
+
+
+router = APIRouter()
+
+CHUNK_SIZE = 1024 * 1024
+ZIP_MAX_SIZE = 0xFFFFFFFF
+MEDIA_TYPES = {"zip": "application/zip", "tar": "application/x-tar"}
+
+# directory -> sha256 -> crc32 of the files of that index
+crcs = {}
+# (directory, format, sha256 of every file, target) -> (etag, length, parts)
+layouts = OrderedDict()
+# get_layout() runs in worker threads, held for crcs and layouts but never
+# while reading files
+cache_lock = threading.Lock()
+
+
+def get_crc32(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def get_dos_time(timestamp: int) -> tuple:
+    local = time.gmtime(max(timestamp, 315532800))
+    dos_time = (local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2)
+    dos_date = ((local.tm_year - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday
+    return dos_time, dos_date
+
+
+def build_zip(files: list, timestamp: int, file_crcs: dict) -> list:
+    """
+    A method for laying out a store-only zip of files on disk. Sizes and
+    CRCs go in the local headers, so the zip can be read as a stream too
+    Args:
+        files: List of (name in the bundle, path, size, sha256)
+        timestamp: Modification time of all entries
+        file_crcs: sha256 -> crc32 of every file
+
+    Returns:
+        List of parts, bytes or (path, size)
+    """
+    dos_time, dos_date = get_dos_time(timestamp)
+    parts = []
+    central = []
+    offset = 0
+    for name, path, size, sha256 in files:
+        crc = file_crcs[sha256]
+        encoded = name.encode()
+        # utf-8 names, stored
+        fields = (0x0800, 0, dos_time, dos_date, crc, size, size, len(encoded))
+        local = struct.pack("<IH4HIIIHH", 0x04034B50, 20, *fields, 0) + encoded
+        # made by unix, for the file mode in the external attributes
+        central.append(
+            struct.pack(
+                "<IHH4HIIIHHHHHII",
+                0x02014B50,
+                0x0314,
+                20,
+                *fields,
+                0,
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                offset,
+            )
+            + encoded
+        )
+        parts.extend([local, (path, size)])
+        offset += len(local) + size
+    central_dir = b"".join(central)
+    end = struct.pack(
+        "<IHHHHIIH",
+        0x06054B50,
+        0,
+        0,
+        len(files),
+        len(files),
+        len(central_dir),
+        offset,
+        0,
+    )
+    if offset + len(central_dir) > ZIP_MAX_SIZE:
+        raise ValueError("Build is too large for a zip bundle, use tar")
+    parts.append(central_dir + end)
+    return parts
+
+
+def build_tar(files: list, timestamp: int) -> list:
+    """
+    A method for laying out a ustar archive of files on disk
+    Args:
+        files: List of (name in the bundle, path, size, sha256)
+        timestamp: Modification time of all entries
+
+    Returns:
+        List of parts, bytes or (path, size)
+    """
+    parts = []
+    for name, path, size, sha256 in files:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = timestamp
+        info.mode = 0o644
+        parts.extend([info.tobuf(tarfile.USTAR_FORMAT), (path, size)])
+        padding = -size % tarfile.BLOCKSIZE
+        if padding:
+            parts.append(tarfile.NUL * padding)
+    parts.append(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+    return parts
+
+
+def get_version_files(version: dict, target: str) -> list:
+    """
+    A method to get the files of an indexed version on disk
+    Args:
+        version: Version in dict form
+        target: Only files for this target, all if empty
+
+    Returns:
+        List of (name in the bundle, path, size, sha256)
+    """
+    prefix = settings.base_url + "/"
+    files = []
+    for file in version["files"]:
+        # deltas patch other builds, they aren't part of this one
+        if "source_sha256" in file:
+            continue
+        if target and file["target"] != target:
+            continue
+        if not file["url"].startswith(prefix):
+            continue
+        path = os.path.join(settings.files_dir, file["url"].removeprefix(prefix))
+        files.append(
+            (os.path.basename(path), path, os.path.getsize(path), file["sha256"])
+        )
+    return files
+
+
+def get_layout(directory: str, version: dict, target: str, extension: str) -> tuple:
+    """
+    A method to get the layout of a bundle, headers are built and CRCs
+    computed once per build, later requests only read the files
+    Args:
+        directory: Repository name
+        version: Version in dict form
+        target: Only files for this target, all if empty
+        extension: zip or tar
+
+    Returns:
+        ETag, Content-Length and list of parts
+    """
+    key = (
+        directory,
+        extension,
+        tuple(
+            file["sha256"] for file in version["files"] if "source_sha256" not in file
+        ),
+        target,
+    )
+    with cache_lock:
+        layout = layouts.get(key)
+        if layout is not None:
+            layouts.move_to_end(key)
+            return layout
+    files = get_version_files(version, target)
+    if not files:
+        raise LookupError("No files found!")
+    if extension == "zip":
+        with cache_lock:
+            index_crcs = crcs.get(directory, {})
+            known = {
+                sha256: index_crcs[sha256]
+                for _, _, _, sha256 in files
+                if sha256 in index_crcs
+            }
+        computed = {
+            sha256: get_crc32(path)
+            for _, path, _, sha256 in files
+            if sha256 not in known
+        }
+        parts = build_zip(files, version["timestamp"], {**known, **computed})
+        with cache_lock:
+            index_crcs = crcs.setdefault(directory, {})
+            index_crcs.update(computed)
+            # only the files still indexed
+            digests = indexes[directory].file_digests
+            for sha256 in index_crcs.keys() - digests.keys():
+                del index_crcs[sha256]
+    else:
+        parts = build_tar(files, version["timestamp"])
+    length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+    etag = '"' + hashlib.sha256(repr(key).encode()).hexdigest()[:32] + '"'
+    layout = (etag, length, parts)
+    with cache_lock:
+        layouts[key] = layout
+        if len(layouts) > settings.bundle_layout_cache_size:
+            layouts.popitem(last=False)
+    return layout
+
+
+async def stream_parts(parts: list):
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+            continue
+        path, size = part
+        with open(path, "rb") as file:
+            remaining = size
+            while remaining > 0:
+                chunk = await asyncio.to_thread(file.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # a changed file would make the rest of the bundle wrong
+                    raise IOError(f"{path} is shorter than indexed")
+                remaining -= len(chunk)
+                yield chunk
+
+
+@router.get("/{directory}/{channel}/bundle.{extension}")
+async def bundle_request(
+    request: Request,
+    directory: str,
+    channel: str,
+    extension: str,
+    version: str = None,
+    target: str = None,
+):
+    """
+    Method for downloading every file of a build at once, as a store-only
+    zip or tar streamed from the published files
+    Args:
+        directory: Repository name
+        channel: Channel id
+        extension: zip or tar
+        version: Version of the channel, the latest if empty
+        target: Only include files for this target
+
+    Returns:
+        Bundle
+    """
+    index = indexes.get(directory)
+    if not isinstance(index, RepositoryIndex) or extension not in MEDIA_TYPES:
+        return JSONResponse("Not found!", status_code=404)
+    if not index.initialized:
+        return not_ready_response()
+    if target:
+        target = target.replace("-", "/")
+    cur_channel = next((c for c in index.index["channels"] if c["id"] == channel), None)
+    if cur_channel is None:
+        return JSONResponse(f"Channel `{channel}` not found!", status_code=404)
+    cur_version = next(
+        (
+            v
+            for v in cur_channel["versions"]
+            if version is None or v["version"] == version
+        ),
+        None,
+    )
+    if cur_version is None:
+        return JSONResponse(f"Version `{version}` not found!", status_code=404)
+    try:
+        etag, length, parts = await asyncio.to_thread(
+            get_layout, directory, cur_version, target, extension
+        )
+    except LookupError as e:
+        return JSONResponse(str(e), status_code=404)
+    except ValueError as e:
+        return JSONResponse(str(e), status_code=400)
+    except OSError as e:
+        logging.exception(e)
+        return JSONResponse("Build files are not available!", status_code=404)
+    name = f"{directory}-{cur_version['version']}"
+    if target:
+        name += "-" + target.replace("/", "-")
+    headers = {
+        "ETag": etag,
+        "Content-Length": str(length),
+        "Content-Disposition": f'attachment; filename="{name}.{extension}"',
+        **get_cache_headers(directory, channel),
+    }
+    if match_etag(request.headers.get("If-None-Match"), etag):
+        del headers["Content-Length"]
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(
+        stream_parts(parts), media_type=MEDIA_TYPES[extension], headers=headers
+    )
@@ -0,0 +1,162 @@
+import re
+import json
+import base64
+import bisect
+from typing import List
+
+
+SORT_KEYS = {
+    "updated": lambda pack: pack["stats"]["updated"],
+    "added": lambda pack: pack["stats"]["added"],
+    "anims": lambda pack: pack["stats"]["anims"],
+    "icons": lambda pack: pack["stats"]["icons"],
+    "name": lambda pack: pack["name"].lower(),
+}
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def encode_cursor(generation: int, offset: int) -> str:
+    cursor = json.dumps({"g": generation, "o": offset}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded))
+        generation, offset = int(data["g"]), int(data["o"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+    # a negative offset would slice from the end
+    if offset < 0:
+        raise ValueError("Invalid cursor")
+    return generation, offset
+
+
+class PacksQueryIndex:
+    """
+    Sort orders and filter lookups over one catalog snapshot, so listing
+    packs never scans the whole catalog
+    """
+
+    def __init__(self, catalog: dict, generation: int):
+        self.packs = catalog.get("packs", [])
+        self.generation = generation
+        positions = range(len(self.packs))
+        # pack positions for every (sort key, order), and the rank of every
+        # pack in them to sort filtered subsets without walking the full order
+        self.orders = {}
+        self.ranks = {}
+        for key, get in SORT_KEYS.items():
+            ascending = sorted(positions, key=lambda i: (get(self.packs[i]), i))
+            self.orders[(key, "asc")] = ascending
+            self.orders[(key, "desc")] = ascending[::-1]
+            self.ranks[key] = [0] * len(ascending)
+            for rank, i in enumerate(ascending):
+                self.ranks[key][i] = rank
+        self.authors = {}
+        self.fonts = {}
+        self.passport = {}
+        self.tokens = {}
+        for i, pack in enumerate(self.packs):
+            self.authors.setdefault(pack["author"].lower(), set()).add(i)
+            for font in pack["stats"]["fonts"]:
+                self.fonts.setdefault(font.lower(), set()).add(i)
+            for part in pack["stats"]["passport"]:
+                self.passport.setdefault(part.lower(), set()).add(i)
+            for token in tokenize(pack["name"] + " " + pack["description"]):
+                self.tokens.setdefault(token, set()).add(i)
+        self.vocabulary = sorted(self.tokens)
+
+    def match_token(self, prefix: str) -> set:
+        matches = set()
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            matches.update(self.tokens[token])
+        return matches
+
+    def filter(
+        self, author: str, fonts: List[str], passport: List[str], text: str
+    ) -> set:
+        """
+        A method to get the positions of packs matching all filters
+        Returns:
+            Set of pack positions, or None if nothing is filtered
+        """
+        selected = None
+
+        def narrow(found: set):
+            nonlocal selected
+            selected = set(found) if selected is None else selected & found
+
+        if author:
+            narrow(self.authors.get(author.lower(), set()))
+        for font in fonts:
+            narrow(self.fonts.get(font.lower(), set()))
+        for part in passport:
+            narrow(self.passport.get(part.lower(), set()))
+        # every word of the search text has to prefix-match a word of the
+        # pack name or description
+        for token in tokenize(text or ""):
+            narrow(self.match_token(token))
+        return selected
+
+    def query(
+        self,
+        sort: str = "updated",
+        order: str = "desc",
+        author: str = None,
+        fonts: List[str] = [],
+        passport: List[str] = [],
+        text: str = None,
+        limit: int = 20,
+        cursor: str = None,
+    ) -> dict:
+        """
+        A method for listing packs
+        Args:
+            sort: Sort key (updated, added, anims, icons, name)
+            order: asc or desc
+            author: Only packs by this author
+            fonts: Only packs including all these fonts
+            passport: Only packs including all these passport parts
+            text: Search text over pack name and description
+            limit: Page size
+            cursor: Cursor of the next page from a previous response
+
+        Returns:
+            Page of packs, total matches and the next page cursor
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key `{sort}`")
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Unknown order `{order}`")
+        offset = 0
+        if cursor:
+            generation, offset = decode_cursor(cursor)
+            if generation != self.generation:
+                raise LookupError("Catalog changed, restart listing")
+        selected = self.filter(author, fonts, passport, text)
+        if selected is None:
+            ordered = self.orders[(sort, order)]
+        else:
+            ordered = sorted(
+                selected, key=self.ranks[sort].__getitem__, reverse=order == "desc"
+            )
+        page = ordered[offset : offset + limit]
+        next_offset = offset + len(page)
+        return {
+            "packs": [self.packs[i] for i in page],
+            "total": len(ordered),
+            "next_cursor": (
+                encode_cursor(self.generation, next_offset)
+                if next_offset < len(ordered)
+                else None
+            ),
+        }
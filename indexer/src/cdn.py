@@ -0,0 +1,143 @@
+import json
+import asyncio
+import logging
+import urllib.request
+
+from .reindex_pool import call_in_loop
+from .settings import settings
+
+
+# directory -> surrogate key -> ETag of what it was last purged for
+fingerprints = {}
+
+
+def get_surrogate_key(directory: str, channel: str = None) -> str:
+    """
+    A method to get the surrogate key of an index response. Responses of a
+    channel (its slices and latest file redirects) only change with that
+    channel, everything else with the index
+    Args:
+        directory: Index directory
+        channel: Channel id the response is limited to
+
+    Returns:
+        Surrogate key
+    """
+    if channel:
+        return f"{directory}/{channel}"
+    return directory
+
+
+def get_cache_headers(directory: str, channel: str = None) -> dict:
+    """
+    A method to get the headers that let the CDN keep an index response
+    until it is purged. Without a purge hook nothing is cached, nginx keeps
+    sending no-cache
+    Args:
+        directory: Index directory
+        channel: Channel id the response is limited to
+
+    Returns:
+        Dict of headers
+    """
+    if not settings.cdn_purge_url:
+        return {}
+    return {
+        "Cache-Control": f"public, max-age=0, s-maxage={settings.cdn_max_age}",
+        settings.cdn_surrogate_key_header: get_surrogate_key(directory, channel),
+    }
+
+
+def get_fingerprints(directory: str, slices) -> dict:
+    keys = {get_surrogate_key(directory): slices.get()[1]}
+    for channel in slices.index.get("channels", []):
+        key = get_surrogate_key(directory, channel["id"])
+        keys[key] = slices.get(channel["id"])[1]
+    return keys
+
+
+def purge_changed(directory: str, slices, generation: int) -> None:
+    """
+    A method for purging the surrogate keys whose responses changed with
+    new slices of an index, called whenever the slices are swapped in
+    Args:
+        directory: Index directory
+        slices: New IndexSlices
+        generation: Change feed generation of the slices
+
+    Returns:
+        Nothing
+    """
+    if not settings.cdn_purge_url:
+        return
+    old = fingerprints.get(directory, {})
+    new = get_fingerprints(directory, slices)
+    fingerprints[directory] = new
+    # channels that are gone too, their redirects don't exist anymore
+    keys = {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+    if keys:
+        call_in_loop(lambda: purger.submit(keys, directory, generation))
+
+
+class CdnPurger:
+    """
+    Sends changed surrogate keys to the purge hook (settings.cdn_purge_url)
+    in the background. Keys of reindexes that happen while a purge is in
+    flight are sent together with the next one, failed purges are retried
+    """
+
+    def __init__(self):
+        # surrogate key -> (directory, generation) that made it stale
+        self.pending = {}
+        self.event = asyncio.Event()
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    def submit(self, keys: set, directory: str, generation: int) -> None:
+        for key in keys:
+            self.pending[key] = (directory, generation)
+        self.event.set()
+
+    def post(self, pending: dict) -> None:
+        generations = {}
+        for directory, generation in pending.values():
+            generations[directory] = max(generation, generations.get(directory, 0))
+        request = urllib.request.Request(
+            settings.cdn_purge_url,
+            data=json.dumps(
+                {"keys": sorted(pending), "generations": generations}
+            ).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        if settings.cdn_purge_token:
+            request.add_header("Authorization", f"Bearer {settings.cdn_purge_token}")
+        with urllib.request.urlopen(request, timeout=settings.cdn_purge_timeout):
+            pass
+
+    async def run(self) -> None:
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            pending, self.pending = self.pending, {}
+            try:
+                await asyncio.to_thread(self.post, pending)
+                logging.info(f"Purged {', '.join(sorted(pending))}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("CDN purge failed")
+                logging.exception(e)
+                # newer staleness of the same keys wins
+                self.pending = {**pending, **self.pending}
+                await asyncio.sleep(settings.cdn_purge_retry_delay)
+                self.event.set()
+
+
+purger = CdnPurger()
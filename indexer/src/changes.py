@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+from .reindex_pool import call_in_loop
+from .settings import settings
+
+
+def summarize(index: dict) -> dict:
+    """
+    A method for reducing an index to what a change diff is made of
+    Args:
+        index: Index in dict form (firmware channels or asset packs)
+
+    Returns:
+        Dict of channel/pack id -> {"version": ..., "files": {url: sha256}}
+    """
+    summary = {}
+    for channel in index.get("channels", []):
+        version = channel["versions"][0] if channel["versions"] else {}
+        summary[channel["id"]] = {
+            "version": version.get("version"),
+            "files": {file["url"]: file["sha256"] for file in version.get("files", [])},
+        }
+    for pack in index.get("packs", []):
+        summary[pack["id"]] = {
+            "version": str(pack["stats"]["updated"]),
+            "files": {file["url"]: file["sha256"] for file in pack["files"]},
+        }
+    return summary
+
+
+def diff_summaries(old: dict, new: dict) -> dict:
+    """
+    A method for computing a structured diff between two index summaries
+    Args:
+        old: Previous summary
+        new: Current summary
+
+    Returns:
+        Dict with added/removed ids and per-id changes, empty if nothing changed
+    """
+    diff = {}
+    added = sorted(new.keys() - old.keys())
+    removed = sorted(old.keys() - new.keys())
+    changed = []
+    for entry_id in sorted(new.keys() & old.keys()):
+        old_entry, new_entry = old[entry_id], new[entry_id]
+        change = {}
+        if old_entry["version"] != new_entry["version"]:
+            change["version"] = [old_entry["version"], new_entry["version"]]
+        old_files, new_files = old_entry["files"], new_entry["files"]
+        files = {
+            "added": sorted(new_files.keys() - old_files.keys()),
+            "removed": sorted(old_files.keys() - new_files.keys()),
+            "changed": sorted(
+                url
+                for url in new_files.keys() & old_files.keys()
+                if new_files[url] != old_files[url]
+            ),
+        }
+        if any(files.values()):
+            change["files"] = {k: v for k, v in files.items() if v}
+        if change:
+            changed.append({"id": entry_id, **change})
+    if added:
+        diff["added"] = added
+    if removed:
+        diff["removed"] = removed
+    if changed:
+        diff["changed"] = changed
+    return diff
+
+
+class ChangeFeed:
+    """
+    Generation counter and recent diffs of one index. The generation and
+    the summary it was recorded for are persisted, so the generation keeps
+    growing across restarts and a restart with the same content records no
+    change. The diffs are not persisted
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.generation, self.summary = self.load_state()
+        self.history = deque(maxlen=settings.changes_history)
+        self.event = asyncio.Event()
+
+    def get_state_path(self) -> str:
+        return os.path.join(settings.state_dir, f"{self.directory}.generation.json")
+
+    def load_state(self) -> tuple:
+        """
+        Returns:
+            Generation, and the summary of its index (None if unknown)
+        """
+        try:
+            with open(self.get_state_path(), "r") as state_file:
+                state = json.load(state_file)
+            return int(state["generation"]), state.get("summary")
+        except FileNotFoundError:
+            return 0, None
+        except Exception as e:
+            logging.exception(e)
+            return 0, None
+
+    def save_state(self) -> None:
+        os.makedirs(settings.state_dir, exist_ok=True)
+        state_path = self.get_state_path()
+        with open(state_path + ".tmp", "w") as state_file:
+            json.dump(
+                {"generation": self.generation, "summary": self.summary}, state_file
+            )
+        os.replace(state_path + ".tmp", state_path)
+
+    def record(self, index: dict, generation: int = None) -> bool:
+        """
+        A method for recording a new index state, bumps the generation and
+        wakes waiting subscribers if anything changed
+        Args:
+            index: New index in dict form
+            generation: Generation to use instead of the next one, replicas
+                keep the generations of the primary
+
+        Returns:
+            True if the index changed
+        """
+        summary = summarize(index)
+        old_summary = self.summary
+        self.summary = summary
+        if old_summary is None:
+            # first index ever, or of a state saved without its summary
+            diff = {"added": sorted(summary)} if summary else {}
+        else:
+            diff = diff_summaries(old_summary, summary)
+        if not diff:
+            if generation is not None:
+                self.generation = generation
+            return False
+        self.generation = self.generation + 1 if generation is None else generation
+        self.history.append(
+            {"generation": self.generation, "timestamp": int(time.time()), **diff}
+        )
+        try:
+            self.save_state()
+        except Exception as e:
+            logging.exception(e)
+        event, self.event = self.event, asyncio.Event()
+        # reindexes run in pool threads
+        call_in_loop(event.set)
+        return True
+
+    def get_changes(self, since: int) -> dict:
+        """
+        A method to get the diffs newer than a generation
+        Args:
+            since: Last generation the client has seen
+
+        Returns:
+            Current generation and the diffs after `since`. `reset` is set
+            when the diffs are no longer available and the client has to
+            refetch the whole index
+        """
+        oldest = self.history[0]["generation"] if self.history else None
+        reset = since > self.generation or (
+            since < self.generation and (oldest is None or since < oldest - 1)
+        )
+        return {
+            "generation": self.generation,
+            "reset": reset,
+            "changes": (
+                []
+                if reset
+                else [change for change in self.history if change["generation"] > since]
+            ),
+        }
+
+    async def wait(self, since: int, timeout: float) -> dict:
+        """
+        A method to wait (long-poll) until there are changes after `since`
+        Args:
+            since: Last generation the client has seen
+            timeout: Max seconds to wait
+
+        Returns:
+            Same as get_changes()
+        """
+        if since == self.generation and timeout > 0:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.get_changes(since)
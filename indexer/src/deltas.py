@@ -0,0 +1,342 @@
+import os
+import shutil
+import asyncio
+import hashlib
+import logging
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from .models import VersionFile
+from .metrics import locked
+from .reindex_pool import get_index_lock
+from .settings import settings
+
+
+DELTA_SUFFIX = ".zst"
+
+executor: ProcessPoolExecutor = None
+# keeps references to running generation tasks, asyncio only holds weak ones
+background_tasks = set()
+# (directory, branch) -> number of generations scheduled or running, their
+# delta directories are left alone by delete_orphaned_deltas()
+pending_deltas = {}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=settings.delta_workers)
+    return executor
+
+
+def get_delta_dir(directory: str, branch: str) -> str:
+    return os.path.join(settings.deltas_dir, directory, branch)
+
+
+def get_delta_name(source_sha256: str, target_sha256: str) -> str:
+    return f"{target_sha256}.{source_sha256}{DELTA_SUFFIX}"
+
+
+def get_file_path(url: str) -> str:
+    return os.path.join(settings.files_dir, url.removeprefix(settings.base_url + "/"))
+
+
+def get_build_files(index: dict, directory: str, branch: str) -> dict:
+    """
+    A method to get the files of the indexed build of a branch
+    Args:
+        index: Index in dict form
+        directory: Repository name
+        branch: Branch name
+
+    Returns:
+        Dict of (target, type) -> VersionFile dict
+    """
+    prefix = os.path.join(settings.base_url, directory, branch) + "/"
+    for channel in index.get("channels", []):
+        for version in channel["versions"]:
+            files = {
+                (file["target"], file["type"]): file
+                for file in version["files"]
+                if file["url"].startswith(prefix) and "source_sha256" not in file
+            }
+            if files:
+                return files
+    return {}
+
+
+def make_delta(source_path: str, target_path: str, delta_path: str) -> str:
+    """
+    A method for generating a binary delta, runs in the process pool
+    Args:
+        source_path: Previous build artifact
+        target_path: New build artifact
+        delta_path: Output path
+
+    Returns:
+        sha256 of the delta file
+    """
+    tmp_path = delta_path + ".tmp"
+    subprocess.check_call(
+        [
+            "zstd",
+            "-q",
+            "-f",
+            f"-{settings.delta_compression_level}",
+            f"--patch-from={source_path}",
+            target_path,
+            "-o",
+            tmp_path,
+        ]
+    )
+    sha256 = hashlib.sha256()
+    with open(tmp_path, "rb") as delta_file:
+        while chunk := delta_file.read(1024 * 1024):
+            sha256.update(chunk)
+    os.replace(tmp_path, delta_path)
+    return sha256.hexdigest()
+
+
+def list_deltas(directory: str, branch: str, delta_sha256s: dict = None) -> dict:
+    """
+    A method for listing the deltas of a branch on disk with their digests
+    Args:
+        directory: Repository name
+        branch: Branch name
+        delta_sha256s: Known delta name -> sha256, others get hashed
+
+    Returns:
+        Dict of delta name -> sha256
+    """
+    delta_dir = get_delta_dir(directory, branch)
+    if not os.path.isdir(delta_dir):
+        return {}
+    deltas = {}
+    for name in os.listdir(delta_dir):
+        if not name.endswith(DELTA_SUFFIX):
+            continue
+        sha256 = (delta_sha256s or {}).get(name)
+        if sha256 is None:
+            with open(os.path.join(delta_dir, name), "rb") as delta_file:
+                sha256 = hashlib.file_digest(delta_file, "sha256").hexdigest()
+        deltas[name] = sha256
+    return deltas
+
+
+def add_delta_files_to_version(
+    version_files: list, directory: str, branch: str, delta_sha256s: dict
+) -> None:
+    """
+    A method for listing the deltas of a build next to its files
+    Args:
+        version_files: VersionFile list (models or dicts) of the build
+        directory: Repository name
+        branch: Branch name
+        delta_sha256s: Delta name -> sha256 of the deltas of the branch, see
+            list_deltas() and ScanCache.scan_deltas()
+
+    Returns:
+        Nothing
+    """
+    delta_dir = get_delta_dir(directory, branch)
+    targets = {}
+    for file in version_files:
+        file = file if isinstance(file, dict) else file.dict()
+        targets[file["sha256"]] = file
+    for name, sha256 in sorted(delta_sha256s.items()):
+        target_sha256, _, source_sha256 = name.removesuffix(DELTA_SUFFIX).partition(".")
+        target = targets.get(target_sha256)
+        if target is None:
+            continue
+        delta_path = os.path.join(delta_dir, name)
+        delta_file = VersionFile(
+            url=os.path.join(
+                settings.base_url, os.path.relpath(delta_path, settings.files_dir)
+            ),
+            target=target["target"],
+            type="delta_" + target["type"],
+            sha256=sha256,
+            source_sha256=source_sha256,
+            target_sha256=target_sha256,
+        )
+        if version_files and isinstance(version_files[0], dict):
+            version_files.append(delta_file.dict(exclude_none=True))
+        else:
+            version_files.append(delta_file)
+
+
+def delete_stale_deltas(directory: str, branch: str, build_files: dict) -> None:
+    """
+    A method for removing deltas that don't lead to the current build, call
+    it with the index lock held and only for the build that is indexed.
+    Temporary files are left to the generations still writing them
+    """
+    delta_dir = get_delta_dir(directory, branch)
+    if not os.path.isdir(delta_dir):
+        return
+    current = {file["sha256"] for file in build_files.values()}
+    for name in os.listdir(delta_dir):
+        if not name.endswith(DELTA_SUFFIX):
+            continue
+        if name.partition(".")[0] not in current:
+            os.remove(os.path.join(delta_dir, name))
+
+
+def delete_orphaned_deltas(directory: str) -> None:
+    """
+    A method for removing deltas of branches that have no build directory
+    anymore
+    Args:
+        directory: Repository name
+
+    Returns:
+        Nothing
+    """
+    main_dir = os.path.join(settings.deltas_dir, directory)
+    if not os.path.isdir(main_dir):
+        return
+    for root, dirs, files in os.walk(main_dir, topdown=False):
+        branch = os.path.relpath(root, main_dir)
+        # zstd may be writing into it, or about to
+        if branch == "." or pending_deltas.get((directory, branch)):
+            continue
+        branch_dir = os.path.join(settings.files_dir, directory, branch)
+        if files and not os.path.isdir(branch_dir):
+            shutil.rmtree(root)
+            logging.info(f"Deleting deltas of {branch}")
+        elif not files and not os.listdir(root):
+            os.rmdir(root)
+
+
+async def generate_deltas(reindex_dir, branch: str, previous: dict) -> None:
+    """
+    A method for generating deltas from the previous build of a branch to
+    the newly indexed one, and adding them to the live index when done
+    Args:
+        reindex_dir: Index of the branch
+        branch: Branch name
+        previous: Files of the previous build, see get_build_files()
+
+    Returns:
+        Nothing
+    """
+    directory = reindex_dir.directory
+    current = get_build_files(reindex_dir.index, directory, branch)
+    delta_dir = get_delta_dir(directory, branch)
+    loop = asyncio.get_running_loop()
+    jobs = {}
+    for key, target in current.items():
+        source = previous.get(key)
+        if source is None or source["sha256"] == target["sha256"]:
+            continue
+        if target["type"] not in settings.delta_file_types:
+            continue
+        source_path = get_file_path(source["url"])
+        target_path = get_file_path(target["url"])
+        if not os.path.isfile(source_path) or not os.path.isfile(target_path):
+            continue
+        name = get_delta_name(source["sha256"], target["sha256"])
+        os.makedirs(delta_dir, exist_ok=True)
+        jobs[name] = loop.run_in_executor(
+            get_executor(),
+            make_delta,
+            source_path,
+            target_path,
+            os.path.join(delta_dir, name),
+        )
+    if not jobs:
+        return
+    results = await asyncio.gather(*jobs.values(), return_exceptions=True)
+    delta_sha256s = {}
+    for name, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            logging.error(f"Delta {name} for {branch} failed")
+            logging.exception(result)
+            continue
+        delta_sha256s[name] = result
+    # reindexes replace the index from pool threads, never change it in place
+    async with locked(get_index_lock(directory), "deltas"):
+        added = await asyncio.to_thread(
+            add_deltas_to_index, reindex_dir, branch, current, delta_sha256s
+        )
+    if added:
+        logging.info(f"Generated {len(delta_sha256s)} deltas for {branch}")
+
+
+def add_deltas_to_index(
+    reindex_dir, branch: str, current: dict, delta_sha256s: dict
+) -> bool:
+    """
+    A method for swapping in a copy of the index that lists the deltas of a
+    branch, and removing the deltas of older builds. Call it with the index
+    lock held
+    Args:
+        reindex_dir: Index of the branch
+        branch: Branch name
+        current: Files of the build the deltas lead to, see get_build_files()
+        delta_sha256s: Delta name -> sha256
+
+    Returns:
+        False if the index was rebuilt for another build meanwhile
+    """
+    directory = reindex_dir.directory
+    index = reindex_dir.index
+    # a generation for a newer build prunes, this one must not touch its output
+    if get_build_files(index, directory, branch) != current:
+        return False
+    delete_stale_deltas(directory, branch, current)
+    prefix = os.path.join(settings.base_url, directory, branch) + "/"
+    channels = []
+    for channel in index["channels"]:
+        versions = []
+        for version in channel["versions"]:
+            if any(file["url"].startswith(prefix) for file in version["files"]):
+                files = [
+                    file for file in version["files"] if "source_sha256" not in file
+                ]
+                add_delta_files_to_version(
+                    files,
+                    directory,
+                    branch,
+                    list_deltas(directory, branch, delta_sha256s),
+                )
+                version = {**version, "files": files}
+            versions.append(version)
+        channels.append({**channel, "versions": versions})
+    reindex_dir.index = {**index, "channels": channels}
+    reindex_dir.file_digests = {
+        **reindex_dir.file_digests,
+        **{
+            file["sha256"]: get_file_path(file["url"])
+            for channel in channels
+            for version in channel["versions"]
+            for file in version["files"]
+            if "source_sha256" in file and file["url"].startswith(prefix)
+        },
+    }
+    reindex_dir.build_slices()
+    return True
+
+
+def schedule_deltas(reindex_dir, branch: str, previous: dict) -> None:
+    """
+    A method for starting delta generation in the background, so the upload
+    response doesn't wait for it
+    """
+    if not previous or not settings.delta_file_types:
+        return
+    key = (reindex_dir.directory, branch)
+    # counted from scheduling on, the task may only start after a GC
+    pending_deltas[key] = pending_deltas.get(key, 0) + 1
+
+    def done(task: asyncio.Task) -> None:
+        background_tasks.discard(task)
+        pending_deltas[key] -= 1
+        if not pending_deltas[key]:
+            del pending_deltas[key]
+
+    task = asyncio.get_running_loop().create_task(
+        generate_deltas(reindex_dir, branch, previous)
+    )
+    background_tasks.add(task)
+    task.add_done_callback(done)
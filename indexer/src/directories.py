@@ -1,15 +1,30 @@
 import os
+import json
 import logging
-import asyncio
-from fastapi import APIRouter
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse
+from typing import List
+from fastapi import APIRouter, Header, Query, Request, Response
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    RedirectResponse,
+    FileResponse,
+    StreamingResponse,
+)
 
 from .repository import indexes, RepositoryIndex, PacksCatalog
+from .reindex_pool import pool
+from .cdn import get_cache_headers
+from .slices import match_etag
 from .settings import settings
 
 
 router = APIRouter()
-lock = asyncio.Lock()
+
+MSGPACK_MEDIA_TYPES = (
+    "application/msgpack",
+    "application/x-msgpack",
+    "application/vnd.msgpack",
+)
 
 
 @router.get("/")
@@ -20,19 +35,110 @@ async def root_request():
     return RedirectResponse("/firmware", status_code=303)
 
 
+def not_ready_response() -> JSONResponse:
+    # the server doesn't wait for the first reindexes, e.g. while GitHub is
+    # unreachable, an empty index here would look like nothing is released
+    return JSONResponse(
+        "Index is not ready yet!",
+        status_code=503,
+        headers={"Retry-After": str(settings.not_ready_retry_after)},
+    )
+
+
+def accepts_msgpack(request: Request) -> bool:
+    accept = request.headers.get("Accept", "")
+    return any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES)
+
+
 def setup_routes(prefix: str, index):
+    @router.get(prefix + "/directory.msgpack")
     @router.get(prefix + "/directory.json")
     @router.get(prefix)
-    async def directory_request():
+    async def directory_request(
+        request: Request, channel: str = None, target: str = None, fields: str = None
+    ):
         """
-        Method for obtaining indices
+        Method for obtaining indices, as compact msgpack for the .msgpack
+        path or a msgpack Accept header
         Args:
-            Nothing
+            channel: Only include this channel id
+            target: Only include files for this target
+            fields: Only include these version fields (comma separated)
 
         Returns:
-            Indices in json
+            Indices in json or msgpack
+        """
+        if not index.initialized:
+            return not_ready_response()
+        compact = request.url.path.endswith(".msgpack") or accepts_msgpack(request)
+        try:
+            body, etag = index.slices.get(channel, target, fields, compact=compact)
+        except KeyError as e:
+            return JSONResponse(str(e.args[0]), status_code=404)
+        except ValueError as e:
+            return JSONResponse(str(e), status_code=400)
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept",
+            **get_cache_headers(index.directory, channel),
+        }
+        if match_etag(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers=headers)
+        media_type = MSGPACK_MEDIA_TYPES[0] if compact else "application/json"
+        return Response(body, media_type=media_type, headers=headers)
+
+    @router.get(prefix + "/changes")
+    async def changes_request(since: int = 0, wait: int = 0):
         """
-        return index.index
+        Method for obtaining index changes, long-polls if `wait` is set
+        and there is nothing newer than `since` yet
+        Args:
+            since: Last generation the client has seen
+            wait: Max seconds to wait for a change
+
+        Returns:
+            Current generation and the diffs after `since` in json
+        """
+        timeout = min(max(wait, 0), settings.changes_max_wait)
+        return await index.changes.wait(since, timeout)
+
+    @router.get(prefix + "/changes/stream")
+    async def changes_stream_request(
+        request: Request, since: int = None, last_event_id: int = Header(default=None)
+    ):
+        """
+        Method for subscribing to index changes as Server-Sent Events,
+        one `change` event per generation
+        Args:
+            since: Last generation the client has seen, current one if empty
+
+        Returns:
+            Event stream
+        """
+        if last_event_id is not None:
+            since = last_event_id
+        elif since is None:
+            since = index.changes.generation
+
+        async def stream(since: int):
+            while not await request.is_disconnected():
+                changes = await index.changes.wait(since, settings.changes_max_wait)
+                if changes["reset"]:
+                    data = json.dumps(changes)
+                    yield f"id: {changes['generation']}\nevent: reset\ndata: {data}\n\n"
+                for change in changes["changes"]:
+                    data = json.dumps(change)
+                    yield f"id: {change['generation']}\nevent: change\ndata: {data}\n\n"
+                if since == changes["generation"]:
+                    # keepalive for proxies
+                    yield ": ping\n\n"
+                since = changes["generation"]
+
+        return StreamingResponse(
+            stream(since),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     if isinstance(index, RepositoryIndex):
 
@@ -53,12 +159,66 @@ def setup_routes(prefix: str, index):
             Returns:
                 Artifact file
             """
+            if not index.initialized:
+                return not_ready_response()
             if len(index.index["channels"]) == 0:
                 return JSONResponse("No channels found!", status_code=404)
             try:
-                return index.get_file_from_latest_version(channel, target, file_type)
+                url = index.get_file_from_latest_version(channel, target, file_type)
             except Exception as e:
                 return JSONResponse(str(e), status_code=404)
+            return RedirectResponse(
+                url,
+                status_code=302,
+                headers=get_cache_headers(index.directory, channel),
+            )
+
+    if isinstance(index, PacksCatalog):
+
+        @router.get(prefix + "/packs")
+        async def packs_request(
+            sort: str = "updated",
+            order: str = "desc",
+            author: str = None,
+            font: List[str] = Query(default=[]),
+            passport: List[str] = Query(default=[]),
+            q: str = None,
+            limit: int = Query(default=20, ge=1, le=100),
+            cursor: str = None,
+        ):
+            """
+            A method for listing packs of the catalog
+            Args:
+                sort: Sort key (updated, added, anims, icons, name)
+                order: asc or desc
+                author: Only packs by this author
+                font: Only packs including this font, can be repeated
+                passport: Only packs including this passport part, can be repeated
+                q: Search text over pack name and description
+                limit: Page size
+                cursor: `next_cursor` from the previous page
+
+            Returns:
+                Page of packs in json
+            """
+            if not index.initialized:
+                return not_ready_response()
+            try:
+                packs = index.list_packs(
+                    sort=sort,
+                    order=order,
+                    author=author,
+                    fonts=font,
+                    passport=passport,
+                    text=q,
+                    limit=limit,
+                    cursor=cursor,
+                )
+            except ValueError as e:
+                return JSONResponse(str(e), status_code=400)
+            except LookupError as e:
+                return JSONResponse(str(e), status_code=410)
+            return JSONResponse(packs, headers=get_cache_headers(index.directory))
 
     #     @router.get(prefix + "/{channel}/{file_name}")
     #     async def repository_file_request(channel, file_name):
@@ -117,13 +277,35 @@ def setup_routes(prefix: str, index):
         Returns:
             Reindex status
         """
-        async with lock:
+        if settings.replica_of:
+            return JSONResponse(
+                "Replicas are reindexed by the primary!", status_code=409
+            )
+        try:
+            await pool.submit(index)
+            return JSONResponse("Reindexing is done!")
+        except Exception as e:
+            logging.exception(e)
+            return JSONResponse("Reindexing is failed!", status_code=500)
+
+    if isinstance(index, RepositoryIndex):
+
+        @router.get(prefix + "/gc")
+        async def gc_request(dry_run: bool = True):
+            """
+            Method for running the garbage collection of stale branch
+            directories right away
+            Args:
+                dry_run: Only report what would be deleted
+
+            Returns:
+                Collection report
+            """
             try:
-                index.reindex()
-                return JSONResponse("Reindexing is done!")
+                return JSONResponse(await index.gc.collect(dry_run=dry_run))
             except Exception as e:
                 logging.exception(e)
-                return JSONResponse("Reindexing is failed!", status_code=500)
+                return JSONResponse("Garbage collection failed!", status_code=500)
 
     # if isinstance(index, RepositoryIndex):
 
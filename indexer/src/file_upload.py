@@ -1,23 +1,48 @@
 import os
 import re
+import json
+import time
+import asyncio
+import base64
+import uuid
 import shutil
+import hashlib
 import pathlib
 import logging
-import asyncio
+import tarfile
 import tempfile
+import threading
+import subprocess
 from typing import List
-from fastapi import APIRouter, Form, UploadFile
+from collections import deque
+from fastapi import APIRouter, File, Form, Header, Request, Response, UploadFile
 from fastapi.responses import JSONResponse
-from .repository import indexes, raw_file_upload_directories
+from .models import ManifestFile, UploadManifest
+from .deltas import get_build_files, schedule_deltas
+from .repository import indexes, raw_file_upload_directories, RepositoryIndex
+from .metrics import locked
+from .reindex_pool import get_index_lock, pool
+from .tracing import span, traced, count
+from .tiering import select_cold_files, schedule_tiering
 from .settings import settings
 
 
 router = APIRouter()
-lock = asyncio.Lock()
 # it's global just for speed up via regex pre-compiling on app start
 __reindex_regexp__ = re.compile(r"^mntm-\d+$|^dev$")
 
 TOKEN_FILENAME = ".version_id"
+HASH_CHUNK_SIZE = 1024 * 1024
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+TUS_VERSION = "1.0.0"
+
+# upload_id -> pending manifest, see create_upload_manifest()
+manifests = {}
+# upload_id -> running sha256 of a resumable upload, see patch_resumable_upload()
+resumable_hashers = {}
+# upload_ids with a PATCH in progress
+patching_uploads = set()
 
 
 def is_directory_reindex_needed(branch: str) -> bool:
@@ -50,7 +75,269 @@ def save_files(path: str, files: List[UploadFile]) -> None:
             out_file.write(file.file.read())
 
 
-def move_files_for_indexed(dest_dir: str, source_dir: str, version_token: str) -> None:
+def save_file_hashed(path: str, file: UploadFile) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "wb") as out_file:
+        while chunk := file.file.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+            out_file.write(chunk)
+    return sha256.hexdigest()
+
+
+class ChunkReader:
+    """
+    File-like view of a request body for code that reads it in a thread.
+    The event loop feeds chunks, None ends the body, and waits once
+    settings.archive_buffer_size bytes are buffered and not read yet
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.condition = threading.Condition()
+        self.chunks = deque()
+        self.buffered = 0
+        self.closed = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.buffer = bytearray()
+        self.eof = False
+
+    async def feed(self, chunk: bytes) -> None:
+        await self.writable.wait()
+        with self.condition:
+            if chunk is None:
+                self.closed = True
+            else:
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+                if self.buffered >= settings.archive_buffer_size:
+                    self.writable.clear()
+            self.condition.notify()
+
+    def fill(self, size: int) -> None:
+        with self.condition:
+            while size < 0 or len(self.buffer) < size:
+                while not self.chunks and not self.closed:
+                    self.condition.wait()
+                if not self.chunks:
+                    self.eof = True
+                    break
+                chunk = self.chunks.popleft()
+                self.buffered -= len(chunk)
+                self.buffer += chunk
+            if self.buffered < settings.archive_buffer_size:
+                self.loop.call_soon_threadsafe(self.writable.set)
+
+    def peek(self, size: int) -> bytes:
+        self.fill(size)
+        return bytes(self.buffer[:size])
+
+    def read(self, size: int = -1) -> bytes:
+        self.fill(size)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def drain(self) -> None:
+        # the event loop may still be feeding, it must never wait for a
+        # reader that is gone
+        while not self.eof:
+            self.read(HASH_CHUNK_SIZE)
+
+
+def get_archive_member_name(member: tarfile.TarInfo) -> str:
+    """
+    A method to get the file name of an archive entry, builds are flat
+    Returns:
+        File name, None for entries that are skipped
+    """
+    name = os.path.normpath(member.name)
+    if member.isdir() and name == ".":
+        return None
+    if os.path.basename(name) != name or name == "..":
+        raise Exception(f"Invalid file name {member.name}")
+    # e.g. .DS_Store or ._ files of macOS tar, the parsers skip them as well
+    if name.startswith("."):
+        return None
+    if not member.isfile():
+        raise Exception(f"{member.name} is not a regular file")
+    return name
+
+
+def copy_to_process(reader: ChunkReader, stdin) -> None:
+    try:
+        while chunk := reader.read(HASH_CHUNK_SIZE):
+            stdin.write(chunk)
+        stdin.close()
+    except (BrokenPipeError, ValueError):
+        pass
+
+
+def extract_archive(reader: ChunkReader, path: str) -> dict:
+    """
+    A method for extracting a tar or tar.zst stream while it arrives,
+    hashing every file on the way. Runs in a thread
+    Args:
+        reader: Request body
+        path: Directory to extract to
+
+    Returns:
+        Dict of file name -> sha256
+    """
+    process = None
+    feeder = None
+    try:
+        fileobj = reader
+        if reader.peek(len(ZSTD_MAGIC)) == ZSTD_MAGIC:
+            process = subprocess.Popen(
+                ["zstd", "-d", "-q", "-c"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            feeder = threading.Thread(
+                target=copy_to_process, args=(reader, process.stdin), daemon=True
+            )
+            feeder.start()
+            fileobj = process.stdout
+        digests = {}
+        with tarfile.open(fileobj=fileobj, mode="r|", bufsize=HASH_CHUNK_SIZE) as tar:
+            for member in tar:
+                name = get_archive_member_name(member)
+                if name is None:
+                    continue
+                if name in digests:
+                    raise Exception(f"{name} is in the archive twice")
+                if len(digests) >= settings.archive_max_files:
+                    raise Exception(
+                        f"More than {settings.archive_max_files} files in archive"
+                    )
+                sha256 = hashlib.sha256()
+                source = tar.extractfile(member)
+                with open(os.path.join(path, name), "wb") as out_file:
+                    while chunk := source.read(HASH_CHUNK_SIZE):
+                        sha256.update(chunk)
+                        out_file.write(chunk)
+                digests[name] = sha256.hexdigest()
+                count(files=1, bytes=member.size)
+        if process:
+            # tar stops at its end marker, zstd may still have padding to flush
+            while process.stdout.read(HASH_CHUNK_SIZE):
+                pass
+            if process.wait() != 0:
+                raise Exception("Archive is not a valid zstd stream")
+        return digests
+    finally:
+        if process:
+            process.kill()
+            process.wait()
+            feeder.join()
+        reader.drain()
+
+
+def expire_manifests() -> None:
+    now = time.time()
+    expired = [
+        upload_id
+        for upload_id, manifest in manifests.items()
+        if now - manifest["created"] > settings.upload_manifest_ttl
+    ]
+    for upload_id in expired:
+        del manifests[upload_id]
+
+
+def find_present_files(reindex_dir, files: List[ManifestFile]) -> tuple:
+    """
+    A method to find already published files, or completed resumable
+    uploads, with the same contents as the files of a manifest. Runs in a
+    thread
+    Args:
+        reindex_dir: Index the upload goes to
+        files: Manifest entries
+
+    Returns:
+        Dict of name -> path of the files the server has, and dict of
+        name -> sha256 of the missing ones
+    """
+    completed = get_completed_uploads(reindex_dir.directory)
+    present = {}
+    missing = {}
+    for file in files:
+        path = reindex_dir.file_digests.get(file.sha256)
+        if not path or not os.path.isfile(path):
+            upload_id = completed.get(file.sha256)
+            path = get_upload_part_path(upload_id) if upload_id else None
+        if path:
+            present[file.name] = path
+        else:
+            missing[file.name] = file.sha256
+    return present, missing
+
+
+def stage_manifest_files(
+    pending: dict, files: List[UploadFile], temp_path: str, final_path: str
+) -> set:
+    """
+    A method for putting the whole build of a manifest upload in staging,
+    the uploaded files checked against their sha256 and the present ones
+    linked or copied. Runs in a thread
+    Args:
+        pending: Pending manifest, see create_upload_manifest()
+        files: Uploaded missing files
+        temp_path: Staging directory of the build
+        final_path: Branch directory
+
+    Returns:
+        Names of the uploaded files
+    """
+    uploaded = set()
+    for file in files:
+        expected = pending["missing"].get(file.filename)
+        if expected is None:
+            raise Exception(f"{file.filename} is not missing from build")
+        filepath = os.path.join(temp_path, file.filename)
+        if save_file_hashed(filepath, file) != expected:
+            raise Exception(f"{file.filename} sha256 mismatch")
+        uploaded.add(file.filename)
+    not_uploaded = set(pending["missing"]) - uploaded
+    if not_uploaded:
+        raise Exception(f"Missing files: {', '.join(sorted(not_uploaded))}")
+    for name, path in pending["present"].items():
+        if not os.path.isfile(path):
+            raise Exception(f"{name} is gone from server, re-send manifest")
+        stage_present_file(path, os.path.join(temp_path, name), final_path)
+    return uploaded
+
+
+def stage_present_file(source: str, dest: str, final_path: str) -> None:
+    # Hardlinking a file onto itself in the final directory is free, but a
+    # link into another directory would share (and bump) the source's mtime,
+    # which add_files_to_version() relies on to find the newest build
+    source_dir = os.path.dirname(os.path.abspath(source))
+    if source_dir in (os.path.abspath(final_path), get_uploads_dir()):
+        try:
+            os.link(source, dest)
+            os.utime(dest)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+
+
+@traced("move_files_for_indexed")
+def move_files_for_indexed(dest_dir: str, source_dir: str, version_token: str) -> tuple:
+    """
+    A method for publishing a build into its branch directory, runs in a
+    thread with the index lock held
+    Args:
+        dest_dir: Branch directory
+        source_dir: Directory with the files of the build
+        version_token: Files of other builds are moved away if it changed
+
+    Returns:
+        Paths and files per build to pass to schedule_tiering()
+    """
     token_file_path = os.path.join(dest_dir, TOKEN_FILENAME)
     do_cleanup = False
     if version_token and os.path.isfile(token_file_path):
@@ -60,18 +347,10 @@ def move_files_for_indexed(dest_dir: str, source_dir: str, version_token: str) -
     else:
         do_cleanup = True
     pathlib.Path(dest_dir).mkdir(parents=True, exist_ok=True)
+    files_per_build = len(os.listdir(source_dir))
+    cold_files = []
     if do_cleanup:
-        files_per_build = len(os.listdir(source_dir))
-        builds_to_keep = 20
-        prev_files = [
-            entry.path
-            for entry in sorted(
-                os.scandir(dest_dir), key=lambda e: e.stat().st_mtime, reverse=True
-            )
-        ]
-        cleanup_files = prev_files[files_per_build * builds_to_keep :]
-        for cleanup_file in cleanup_files:
-            os.remove(cleanup_file)
+        cold_files = select_cold_files(dest_dir, files_per_build)
         if version_token:
             with open(token_file_path, "w") as token_file:
                 token_file.write(version_token)
@@ -79,7 +358,9 @@ def move_files_for_indexed(dest_dir: str, source_dir: str, version_token: str) -
     for file in os.listdir(source_dir):
         sourcefilepath = os.path.join(source_dir, file)
         destfilepath = os.path.join(dest_dir, file)
+        count(files=1, bytes=os.path.getsize(sourcefilepath))
         shutil.move(sourcefilepath, destfilepath)
+    return cold_files, files_per_build
 
 
 def move_files_raw(dest_dir: str, source_dir: str) -> None:
@@ -89,6 +370,157 @@ def move_files_raw(dest_dir: str, source_dir: str) -> None:
         shutil.move(sourcefilepath, destfilepath)
 
 
+def get_uploads_dir() -> str:
+    return os.path.join(os.path.abspath(settings.staging_dir), "uploads")
+
+
+def get_upload_part_path(upload_id: str) -> str:
+    return os.path.join(get_uploads_dir(), upload_id + ".part")
+
+
+def get_upload_info_path(upload_id: str) -> str:
+    return os.path.join(get_uploads_dir(), upload_id + ".json")
+
+
+def read_upload_info(upload_id: str) -> dict:
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        return None
+    try:
+        with open(get_upload_info_path(upload_id), "r") as info_file:
+            return json.load(info_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_upload_info(upload_id: str, info: dict) -> None:
+    info_path = get_upload_info_path(upload_id)
+    with open(info_path + ".tmp", "w") as info_file:
+        json.dump(info, info_file)
+    os.replace(info_path + ".tmp", info_path)
+
+
+def remove_upload(upload_id: str) -> None:
+    resumable_hashers.pop(upload_id, None)
+    for path in (get_upload_part_path(upload_id), get_upload_info_path(upload_id)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def expire_uploads() -> None:
+    uploads_dir = get_uploads_dir()
+    if not os.path.isdir(uploads_dir):
+        return
+    now = time.time()
+    for entry in os.scandir(uploads_dir):
+        if not entry.name.endswith(".json"):
+            continue
+        if now - entry.stat().st_mtime > settings.resumable_upload_ttl:
+            upload_id = entry.name.removesuffix(".json")
+            logging.info(f"Expiring resumable upload {upload_id}")
+            remove_upload(upload_id)
+
+
+def get_completed_uploads(directory: str) -> dict:
+    """
+    A method to get the completed resumable uploads to an index
+    Returns:
+        Dict of sha256 -> upload id
+    """
+    uploads_dir = get_uploads_dir()
+    if not os.path.isdir(uploads_dir):
+        return {}
+    completed = {}
+    for entry in os.scandir(uploads_dir):
+        if not entry.name.endswith(".json"):
+            continue
+        upload_id = entry.name.removesuffix(".json")
+        info = read_upload_info(upload_id)
+        if info and info["directory"] == directory and info["sha256"]:
+            completed.setdefault(info["sha256"], upload_id)
+    return completed
+
+
+def parse_upload_metadata(header: str) -> dict:
+    metadata = {}
+    for pair in filter(None, header.split(",")):
+        key, _, value = pair.strip().partition(" ")
+        metadata[key] = base64.b64decode(value).decode() if value else ""
+    return metadata
+
+
+def get_upload_hasher(upload_id: str, offset: int):
+    """
+    A method to get the running sha256 of a resumable upload. After a restart
+    the state is rebuilt once from the bytes already on disk
+    Args:
+        upload_id: Resumable upload id
+        offset: Current upload offset
+
+    Returns:
+        hashlib sha256 object covering the first `offset` bytes
+    """
+    hasher = resumable_hashers.get(upload_id)
+    if hasher is not None and hasher[1] == offset:
+        return hasher[0]
+    sha256 = hashlib.sha256()
+    with open(get_upload_part_path(upload_id), "rb") as part_file:
+        remaining = offset
+        while remaining > 0:
+            chunk = part_file.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            remaining -= len(chunk)
+    return sha256
+
+
+def write_upload_chunk(fd: int, sha256, chunk: bytes, offset: int) -> None:
+    os.pwrite(fd, chunk, offset)
+    sha256.update(chunk)
+
+
+def tus_headers(offset: int, length: int) -> dict:
+    return {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(offset),
+        "Upload-Length": str(length),
+        "Cache-Control": "no-store",
+    }
+
+
+async def reindex_after_upload(
+    reindex_dir, branch: str, previous: dict
+) -> JSONResponse:
+    """
+    A method for reindexing after an upload in the reindex pool, call it
+    after releasing the index lock, the pool takes it itself
+    Args:
+        reindex_dir: Index the files were uploaded to
+        branch: Branch name
+        previous: Files of the build indexed before the upload, see
+            get_build_files()
+
+    Returns:
+        Upload status
+    """
+    if is_directory_reindex_needed(branch):
+        try:
+            if isinstance(reindex_dir, RepositoryIndex):
+                # GitHub state is kept fresh by GithubRefresher
+                await pool.submit(reindex_dir, (branch,))
+            else:
+                await pool.submit(reindex_dir)
+            schedule_deltas(reindex_dir, branch, previous)
+            return JSONResponse("File uploaded, reindexing is done!")
+        except Exception as e:
+            return JSONResponse(
+                f"File uploaded, but error occurred during re-indexing: {e}",
+                status_code=500,
+            )
+    else:
+        return JSONResponse("File uploaded, reindexing isn't needed!")
+
+
 @router.post("/{directory}/uploadfiles")
 async def create_upload_files(
     directory: str,
@@ -119,26 +551,192 @@ async def create_upload_files(
         logging.exception(e)
         return JSONResponse(str(e), status_code=500)
 
-    async with lock:
-        try:
-            with tempfile.TemporaryDirectory() as temp_path:
-                save_files(temp_path, files)
-                move_files_for_indexed(final_path, temp_path, version_token)
-            logging.info(f"Uploaded {len(files)} files")
-        except Exception as e:
-            logging.exception(e)
-            return JSONResponse(str(e), status_code=500)
-        if is_directory_reindex_needed(branch):
+    with span("uploadfiles", directory=directory, branch=branch):
+        async with locked(get_index_lock(directory), "upload"):
             try:
-                reindex_dir.reindex()
-                return JSONResponse("File uploaded, reindexing is done!")
+                with tempfile.TemporaryDirectory() as temp_path:
+                    save_files(temp_path, files)
+                    tiering = await asyncio.to_thread(
+                        move_files_for_indexed, final_path, temp_path, version_token
+                    )
+                logging.info(f"Uploaded {len(files)} files")
             except Exception as e:
-                return JSONResponse(
-                    f"File uploaded, but error occurred during re-indexing: {e}",
-                    status_code=500,
+                logging.exception(e)
+                return JSONResponse(str(e), status_code=500)
+            previous = get_build_files(reindex_dir.index, directory, branch)
+        schedule_tiering(directory, final_path, *tiering)
+        return await reindex_after_upload(reindex_dir, branch, previous)
+
+
+@router.post("/{directory}/uploadarchive")
+async def create_upload_archive(
+    directory: str, request: Request, branch: str, version_token: str = ""
+):
+    """
+    A method to upload a build as one tar or tar.zst stream. Files are
+    extracted and hashed into staging while the body arrives, the build is
+    published and reindexed once it is complete
+    Args:
+        directory: Repository name
+        branch: Branch name
+        version_token: Same as for uploadfiles
+
+    Returns:
+        Upload status
+    """
+    if directory not in indexes:
+        return JSONResponse(f"{directory} not found!", status_code=404)
+
+    reindex_dir = indexes.get(directory)
+    project_root_path = os.path.join(settings.files_dir, directory)
+    final_path = os.path.join(project_root_path, branch)
+
+    try:
+        check_if_path_inside_allowed_path(project_root_path, final_path)
+    except Exception as e:
+        logging.exception(e)
+        return JSONResponse(str(e), status_code=500)
+
+    with span("uploadarchive", directory=directory, branch=branch):
+        os.makedirs(settings.staging_dir, exist_ok=True)
+        # in staging, so publishing the build renames instead of copying
+        with tempfile.TemporaryDirectory(dir=settings.staging_dir) as temp_path:
+            try:
+                reader = ChunkReader()
+                extraction = asyncio.ensure_future(
+                    asyncio.to_thread(extract_archive, reader, temp_path)
                 )
-        else:
-            return JSONResponse("File uploaded, reindexing isn't needed!")
+                try:
+                    async for chunk in request.stream():
+                        if chunk:
+                            await reader.feed(chunk)
+                except Exception:
+                    await reader.feed(None)
+                    await asyncio.gather(extraction, return_exceptions=True)
+                    raise
+                await reader.feed(None)
+                digests = await extraction
+                if not digests:
+                    raise Exception("No files in archive")
+            except Exception as e:
+                logging.exception(e)
+                return JSONResponse(str(e), status_code=500)
+
+            # the body may take long to arrive, the lock is only held to publish
+            async with locked(get_index_lock(directory), "upload"):
+                try:
+                    tiering = await asyncio.to_thread(
+                        move_files_for_indexed, final_path, temp_path, version_token
+                    )
+                    logging.info(f"Uploaded {len(digests)} files from archive")
+                except Exception as e:
+                    logging.exception(e)
+                    return JSONResponse(str(e), status_code=500)
+                previous = get_build_files(reindex_dir.index, directory, branch)
+        schedule_tiering(directory, final_path, *tiering)
+        return await reindex_after_upload(reindex_dir, branch, previous)
+
+
+@router.post("/{directory}/uploadmanifest")
+async def create_upload_manifest(directory: str, manifest: UploadManifest):
+    """
+    First step of a manifest upload: the client lists the files of a build
+    with their sha256, the server answers which of them it doesn't have yet
+    Args:
+        directory: Repository name
+        manifest: Branch, version token and file list of the build
+
+    Returns:
+        Upload id and the names of missing files
+    """
+    if directory not in indexes:
+        return JSONResponse(f"{directory} not found!", status_code=404)
+
+    reindex_dir = indexes.get(directory)
+    project_root_path = os.path.join(settings.files_dir, directory)
+    final_path = os.path.join(project_root_path, manifest.branch)
+
+    try:
+        check_if_path_inside_allowed_path(project_root_path, final_path)
+        for file in manifest.files:
+            if os.path.basename(file.name) != file.name or file.name.startswith("."):
+                raise Exception(f"Invalid file name {file.name}")
+    except Exception as e:
+        logging.exception(e)
+        return JSONResponse(str(e), status_code=500)
+
+    expire_manifests()
+    present, missing = await asyncio.to_thread(
+        find_present_files, reindex_dir, manifest.files
+    )
+    upload_id = uuid.uuid4().hex
+    manifests[upload_id] = {
+        "directory": directory,
+        "manifest": manifest,
+        "present": present,
+        "missing": missing,
+        "created": time.time(),
+    }
+    logging.info(
+        f"Upload manifest {upload_id}: {len(present)} present, {len(missing)} missing"
+    )
+    return JSONResponse({"upload_id": upload_id, "missing": list(missing)})
+
+
+@router.post("/{directory}/uploadmanifestfiles")
+async def create_upload_manifest_files(
+    directory: str,
+    upload_id: str = Form(),
+    files: List[UploadFile] = File(default=[]),
+):
+    """
+    Second step of a manifest upload: the client uploads the missing files,
+    the server publishes the whole build
+    Args:
+        directory: Repository name
+        upload_id: Id returned by uploadmanifest
+        files: Missing files
+
+    Returns:
+        Upload status
+    """
+    expire_manifests()
+    pending = manifests.get(upload_id)
+    if pending is None or pending["directory"] != directory:
+        return JSONResponse(f"Upload {upload_id} not found!", status_code=404)
+
+    reindex_dir = indexes.get(directory)
+    manifest = pending["manifest"]
+    project_root_path = os.path.join(settings.files_dir, directory)
+    final_path = os.path.join(project_root_path, manifest.branch)
+
+    with span("uploadmanifestfiles", directory=directory, branch=manifest.branch):
+        async with locked(get_index_lock(directory), "upload"):
+            try:
+                os.makedirs(settings.staging_dir, exist_ok=True)
+                with tempfile.TemporaryDirectory(dir=settings.staging_dir) as temp_path:
+                    uploaded = await asyncio.to_thread(
+                        stage_manifest_files, pending, files, temp_path, final_path
+                    )
+                    tiering = await asyncio.to_thread(
+                        move_files_for_indexed,
+                        final_path,
+                        temp_path,
+                        manifest.version_token,
+                    )
+                for path in pending["present"].values():
+                    if os.path.dirname(os.path.abspath(path)) == get_uploads_dir():
+                        remove_upload(os.path.basename(path).removesuffix(".part"))
+                del manifests[upload_id]
+                logging.info(
+                    f"Uploaded {len(uploaded)} files, reused {len(pending['present'])}"
+                )
+            except Exception as e:
+                logging.exception(e)
+                return JSONResponse(str(e), status_code=500)
+            previous = get_build_files(reindex_dir.index, directory, manifest.branch)
+        schedule_tiering(directory, final_path, *tiering)
+        return await reindex_after_upload(reindex_dir, manifest.branch, previous)
 
 
 @router.post("/{directory}/uploadfilesraw")
@@ -160,7 +758,7 @@ async def create_upload_files_raw(
 
     project_root_path = os.path.join(settings.files_dir, directory)
 
-    async with lock:
+    async with locked(get_index_lock(directory), "upload"):
         try:
             with tempfile.TemporaryDirectory() as temp_path:
                 save_files(temp_path, files)
@@ -170,3 +768,161 @@ async def create_upload_files_raw(
         except Exception as e:
             logging.exception(e)
             return JSONResponse(str(e), status_code=500)
+
+
+@router.post("/{directory}/uploads")
+async def create_resumable_upload(
+    directory: str,
+    upload_length: int = Header(),
+    upload_metadata: str = Header(default=""),
+):
+    """
+    A method to create a resumable upload (tus creation extension)
+    Args:
+        directory: Repository name
+        upload_length: Total size of the file in bytes
+        upload_metadata: tus metadata, must contain `filename`,
+            uploads to indexed directories also need `branch`
+
+    Returns:
+        Upload location
+    """
+    if directory not in indexes and directory not in raw_file_upload_directories:
+        return JSONResponse(f"{directory} not found!", status_code=404)
+
+    try:
+        metadata = parse_upload_metadata(upload_metadata)
+        filename = metadata.get("filename", "")
+        if not filename or os.path.basename(filename) != filename:
+            raise Exception(f"Invalid file name {filename!r}")
+        if upload_length < 0:
+            raise Exception(f"Invalid upload length {upload_length}")
+    except Exception as e:
+        logging.exception(e)
+        return JSONResponse(str(e), status_code=400)
+
+    expire_uploads()
+    os.makedirs(get_uploads_dir(), exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    open(get_upload_part_path(upload_id), "wb").close()
+    write_upload_info(
+        upload_id,
+        {
+            "directory": directory,
+            "filename": filename,
+            "branch": metadata.get("branch", ""),
+            "length": upload_length,
+            "sha256": None,
+        },
+    )
+    resumable_hashers[upload_id] = (hashlib.sha256(), 0)
+    location = f"/{directory}/uploads/{upload_id}"
+    return JSONResponse(
+        {"upload_id": upload_id},
+        status_code=201,
+        headers={**tus_headers(0, upload_length), "Location": location},
+    )
+
+
+@router.head("/{directory}/uploads/{upload_id}")
+async def get_resumable_upload_offset(directory: str, upload_id: str):
+    """
+    A method to get the current offset of a resumable upload
+    Args:
+        directory: Repository name
+        upload_id: Resumable upload id
+
+    Returns:
+        Upload-Offset and Upload-Length headers
+    """
+    info = read_upload_info(upload_id)
+    if info is None or info["directory"] != directory:
+        return Response(status_code=404)
+    offset = os.path.getsize(get_upload_part_path(upload_id))
+    return Response(status_code=200, headers=tus_headers(offset, info["length"]))
+
+
+@router.patch("/{directory}/uploads/{upload_id}")
+async def patch_resumable_upload(
+    directory: str,
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(),
+):
+    """
+    A method to append a chunk to a resumable upload. The chunk is written
+    in place at `Upload-Offset`, which must match the current offset. When
+    the last byte arrives the file is published (raw directories) or kept
+    for uploadmanifest by its sha256 (indexed directories)
+    Args:
+        directory: Repository name
+        upload_id: Resumable upload id
+        upload_offset: Offset of the chunk
+
+    Returns:
+        New Upload-Offset, and Upload-Sha256 once the upload is complete
+    """
+    info = read_upload_info(upload_id)
+    if info is None or info["directory"] != directory:
+        return Response(status_code=404)
+    part_path = get_upload_part_path(upload_id)
+    offset = os.path.getsize(part_path)
+    # a PATCH in progress, e.g. a client retrying while its previous
+    # connection still streams, would write at the same offset and feed the
+    # same hasher
+    if (
+        upload_offset != offset
+        or info["sha256"] is not None
+        or upload_id in patching_uploads
+    ):
+        return Response(status_code=409, headers=tus_headers(offset, info["length"]))
+    patching_uploads.add(upload_id)
+    try:
+        return await patch_upload_part(directory, upload_id, request, info, offset)
+    finally:
+        patching_uploads.discard(upload_id)
+
+
+async def patch_upload_part(
+    directory: str, upload_id: str, request: Request, info: dict, offset: int
+) -> Response:
+    part_path = get_upload_part_path(upload_id)
+    sha256 = await asyncio.to_thread(get_upload_hasher, upload_id, offset)
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        async for chunk in request.stream():
+            if offset + len(chunk) > info["length"]:
+                return Response(
+                    status_code=413, headers=tus_headers(offset, info["length"])
+                )
+            await asyncio.to_thread(write_upload_chunk, fd, sha256, chunk, offset)
+            offset += len(chunk)
+            resumable_hashers[upload_id] = (sha256, offset)
+    finally:
+        os.close(fd)
+        # keep info mtime fresh so active uploads don't expire
+        os.utime(get_upload_info_path(upload_id))
+
+    headers = tus_headers(offset, info["length"])
+    if offset < info["length"]:
+        return Response(status_code=204, headers=headers)
+
+    info["sha256"] = sha256.hexdigest()
+    resumable_hashers.pop(upload_id, None)
+    headers["Upload-Sha256"] = info["sha256"]
+    if directory in raw_file_upload_directories:
+        project_root_path = os.path.join(settings.files_dir, directory)
+        async with locked(get_index_lock(directory), "upload"):
+            try:
+                dest_path = os.path.join(project_root_path, info["filename"])
+                check_if_path_inside_allowed_path(project_root_path, dest_path)
+                shutil.move(part_path, dest_path)
+                remove_upload(upload_id)
+            except Exception as e:
+                logging.exception(e)
+                return JSONResponse(str(e), status_code=500, headers=headers)
+        logging.info(f"Uploaded {info['filename']} via resumable upload")
+    else:
+        write_upload_info(upload_id, info)
+        logging.info(f"Resumable upload {upload_id} complete, {info['sha256']}")
+    return Response(status_code=204, headers=headers)
@@ -0,0 +1,179 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+
+from .deltas import delete_orphaned_deltas
+from .tiering import delete_orphaned_cold
+from .metrics import locked, phase
+from .reindex_pool import get_index_lock, call_in_loop
+from .settings import settings
+
+
+class GarbageCollector:
+    """
+    Removes build directories of a RepositoryIndex that no longer match a
+    GitHub branch, release or tag, and empty ones, in the background.
+    Only directory names are looked at, never the builds inside them
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.event = asyncio.Event()
+        self.report = None
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    def request(self) -> None:
+        """
+        A method to ask for a collection after a reindex, collections
+        requested while one is running are merged into the next one
+        """
+        call_in_loop(self.event.set)
+
+    def get_main_dir(self) -> str:
+        return os.path.join(settings.files_dir, self.index.directory)
+
+    def classify(self, name: str, path: str) -> str:
+        """
+        A method to decide what happens to a directory under the main dir
+        Args:
+            name: Path relative to the main dir, may contain slashes
+            path: Absolute path
+
+        Returns:
+            "unlinked", "empty", "descend" or None to keep it
+        """
+        github = self.index.indexer_github
+        if github.is_known(name):
+            with os.scandir(path) as entries:
+                if next(entries, None) is None:
+                    return "empty"
+            return None
+        if github.is_known_prefix(name):
+            return "descend"
+        return "unlinked"
+
+    def plan(self) -> dict:
+        """
+        A method to list what a collection would delete. Starts from the
+        top-level listing and only descends into parents of branch names
+        with slashes (e.g. `user` for `user/feature`)
+
+        Returns:
+            Dict of directory name relative to the main dir -> reason
+        """
+        main_dir = self.get_main_dir()
+        planned = {}
+        pending = [""]
+        while pending:
+            parent = pending.pop()
+            with os.scandir(os.path.join(main_dir, parent)) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or not entry.is_dir():
+                        continue
+                    name = os.path.join(parent, entry.name)
+                    reason = self.classify(name, entry.path)
+                    if reason == "descend":
+                        pending.append(name)
+                    elif reason is not None:
+                        planned[name] = reason
+        return dict(sorted(planned.items()))
+
+    def delete(self, name: str) -> bool:
+        """
+        A method to delete one planned directory, if it still has to go.
+        Parents left empty by the deletion are removed as well
+
+        Returns:
+            True if the directory was deleted
+        """
+        main_dir = self.get_main_dir()
+        path = os.path.join(main_dir, name)
+        if not os.path.isdir(path) or self.classify(name, path) in (None, "descend"):
+            return False
+        shutil.rmtree(path)
+        logging.info(f"Deleting {path}")
+        parent = os.path.dirname(name)
+        while parent and not self.index.indexer_github.is_known(parent):
+            try:
+                os.rmdir(os.path.join(main_dir, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+        return True
+
+    def delete_batch(self, names: list) -> list:
+        """
+        A method to delete planned directories, runs in a thread with the
+        index lock held
+
+        Returns:
+            List of deleted directory names
+        """
+        with phase("gc"):
+            return [name for name in names if self.delete(name)]
+
+    def delete_orphans(self) -> None:
+        with phase("gc"):
+            delete_orphaned_deltas(self.index.directory)
+            delete_orphaned_cold(self.index.directory)
+
+    async def collect(self, dry_run: bool = None) -> dict:
+        """
+        A method to run one collection. Deletions happen in batches of
+        settings.gc_batch_size directories with settings.gc_batch_delay
+        seconds between them, each batch under the index lock
+        Args:
+            dry_run: Only report what would be deleted, defaults to
+                settings.gc_dry_run
+
+        Returns:
+            Report of the collection
+        """
+        if dry_run is None:
+            dry_run = settings.gc_dry_run
+        started = time.monotonic()
+        report = {"dry_run": dry_run, "planned": {}, "deleted": []}
+        # without a synced GitHub state every directory would look unlinked
+        if not self.index.indexer_github.is_synced():
+            report["skipped"] = "GitHub state is not synced"
+            return report
+        with phase("gc"):
+            report["planned"] = await asyncio.to_thread(self.plan)
+        if not dry_run:
+            names = list(report["planned"])
+            batch_size = max(settings.gc_batch_size, 1)
+            for start in range(0, len(names), batch_size):
+                if start > 0:
+                    await asyncio.sleep(settings.gc_batch_delay)
+                async with locked(get_index_lock(self.index.directory), "gc"):
+                    report["deleted"] += await asyncio.to_thread(
+                        self.delete_batch, names[start : start + batch_size]
+                    )
+            await asyncio.to_thread(self.delete_orphans)
+        report["duration"] = round(time.monotonic() - started, 3)
+        logging.info(
+            f"{self.index.directory} GC done, {len(report['planned'])} planned, "
+            f"{len(report['deleted'])} deleted in {report['duration']}s"
+        )
+        self.report = report
+        return report
+
+    async def run(self) -> None:
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            try:
+                await self.collect()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"{self.index.directory} GC failed")
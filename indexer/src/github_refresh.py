@@ -0,0 +1,93 @@
+import time
+import random
+import asyncio
+import logging
+
+from .repository import RepositoryIndex
+from .reindex_pool import pool
+from .settings import settings
+
+
+class GithubRefresher:
+    """
+    Periodically syncs the GitHub state of a RepositoryIndex in the
+    background and reindexes when it changed. The interval adapts to the
+    remaining rate limit budget, so uploads can always reuse the synced
+    state instead of paging through GitHub themselves
+    """
+
+    def __init__(self, index: RepositoryIndex):
+        self.index = index
+        self.interval = settings.github_refresh_interval
+        # requests used by one refresh, measured from the rate limit headers
+        self.cost = None
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    def next_interval(self, before: tuple, after: tuple) -> float:
+        """
+        A method to get the delay before the next refresh
+        Args:
+            before: Rate limit (remaining, limit, reset) before the refresh
+            after: Rate limit after the refresh
+
+        Returns:
+            Seconds to wait
+        """
+        interval = settings.github_refresh_interval
+        remaining, limit, reset = after
+        if remaining >= 0:
+            if before[0] >= remaining and before[2] == reset:
+                self.cost = max(before[0] - remaining, 1)
+            cost = self.cost or 1
+            window = max(reset - time.time(), 1)
+            # only spend a share of what is left until the reset, the rest is
+            # for upload reindexes
+            refreshes = remaining * settings.github_refresh_budget_share / cost
+            if refreshes < 1:
+                interval = window
+            else:
+                interval = max(interval, window / refreshes)
+            interval = min(interval, max(window, settings.github_refresh_interval))
+        interval = min(interval, settings.github_refresh_max_interval)
+        jitter = settings.github_refresh_jitter
+        return interval * random.uniform(1 - jitter, 1 + jitter)
+
+    def sync(self) -> None:
+        github = self.index.indexer_github
+        github.sync_info()
+        github.refresh_versions()
+
+    async def refresh(self) -> None:
+        github = self.index.indexer_github
+        # may make a request, see IndexerGithub.get_rate_limit()
+        before = await asyncio.to_thread(github.get_rate_limit)
+        state = github.get_state()
+        try:
+            await asyncio.to_thread(self.sync)
+        finally:
+            after = await asyncio.to_thread(github.get_rate_limit)
+            self.interval = self.next_interval(before, after)
+        remaining, limit, reset = after
+        logging.info(
+            f"{self.index.directory} GitHub refresh done, {remaining}/{limit} "
+            f"requests left, next in {self.interval:.0f}s"
+        )
+        if github.get_state() != state:
+            await pool.submit(self.index, ())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"{self.index.directory} GitHub refresh failed")
@@ -0,0 +1,127 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Request, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+
+router = APIRouter()
+
+UPLOAD_ROUTE_SUFFIXES = (
+    "/uploadfiles",
+    "/uploadfilesraw",
+    "/uploadarchive",
+    "/uploadmanifestfiles",
+    "/uploads/{upload_id}",
+)
+
+REINDEX_PHASE = Histogram(
+    "indexer_reindex_phase_seconds",
+    "Time spent in one step of a reindex",
+    ["phase"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+REINDEX_DURATION = Histogram(
+    "indexer_reindex_seconds",
+    "Duration of whole reindexes",
+    ["directory", "kind"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+REQUEST_DURATION = Histogram(
+    "indexer_request_seconds",
+    "HTTP request latency by route, including directory.json and uploads",
+    ["route", "method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5, 30, 120),
+)
+UPLOAD_BYTES = Histogram(
+    "indexer_upload_bytes",
+    "Request body size of uploads",
+    ["route"],
+    buckets=(1 << 10, 1 << 16, 1 << 20, 1 << 22, 1 << 24, 1 << 26, 1 << 28, 1 << 30),
+)
+LOCK_WAIT = Histogram(
+    "indexer_lock_wait_seconds",
+    "Time spent waiting for a lock",
+    ["lock"],
+    buckets=(0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60),
+)
+INDEX_SIZE = Gauge(
+    "indexer_index_bytes",
+    "Size of the serialized full index",
+    ["directory"],
+)
+GITHUB_CALLS = Counter(
+    "indexer_github_calls_total",
+    "GitHub API calls, paginated results count once",
+    ["call"],
+)
+UPLOADS_IN_FLIGHT = Gauge(
+    "indexer_uploads_in_flight",
+    "Uploads admitted and not done yet",
+)
+UPLOADS_REJECTED = Counter(
+    "indexer_uploads_rejected_total",
+    "Uploads turned away by admission control",
+    ["reason"],
+)
+SCRUB_BYTES = Counter(
+    "indexer_scrub_bytes_total",
+    "Bytes read by the integrity scrubber",
+)
+SCRUB_MISMATCHES = Gauge(
+    "indexer_scrub_mismatches",
+    "Published files that don't match their digest",
+    ["directory"],
+)
+
+
+def phase(name: str):
+    """
+    A method to time a reindex step, use as `with phase("hashing"):`
+    """
+    return REINDEX_PHASE.labels(name).time()
+
+
+@asynccontextmanager
+async def locked(lock: asyncio.Lock, name: str):
+    """
+    A method to acquire a lock and record how long that took, use as
+    `async with locked(lock, "upload"):`
+    """
+    started = time.monotonic()
+    async with lock:
+        LOCK_WAIT.labels(name).observe(time.monotonic() - started)
+        yield
+
+
+async def observe_request(request: Request, call_next):
+    """
+    Middleware recording the latency of every routed request, and the body
+    size of uploads from their Content-Length
+    """
+    started = time.monotonic()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None:
+        path = getattr(route, "path", "unknown")
+        REQUEST_DURATION.labels(path, request.method).observe(
+            time.monotonic() - started
+        )
+        length = request.headers.get("Content-Length")
+        if path.endswith(UPLOAD_ROUTE_SUFFIXES) and length and length.isdigit():
+            UPLOAD_BYTES.labels(path).observe(int(length))
+    return response
+
+
+@router.get("/metrics")
+async def metrics_request():
+    """
+    Method for exporting metrics in the Prometheus text format
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
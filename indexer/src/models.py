@@ -1,14 +1,22 @@
 import re
 import os
+import copy
 import json
+import time
 import hashlib
 import logging
 import pathlib
+import threading
 import subprocess
 from pydantic import BaseModel
-from github import Github, Repository
-from typing import List, ClassVar
+from typing import List, ClassVar, Optional, TYPE_CHECKING
 
+if TYPE_CHECKING:
+    # PyGithub is imported on the first connection, see IndexerGithub.connect()
+    from github import Github, Repository
+
+from .metrics import phase, GITHUB_CALLS
+from .tracing import traced, annotate, count
 from .settings import settings
 
 
@@ -17,6 +25,9 @@ class VersionFile(BaseModel):
     target: str
     type: str
     sha256: str
+    # only set for delta files, see deltas.py
+    source_sha256: Optional[str] = None
+    target_sha256: Optional[str] = None
 
 
 class Version(BaseModel):
@@ -63,6 +74,14 @@ class PackStats(BaseModel):
     added: int = 0
 
 
+class PackPreview(BaseModel):
+    url: str
+    sha256: str
+    # filled by the previews reindex stage, see previews.py
+    thumbnail_url: str = ""
+    static_url: str = ""
+
+
 class Pack(BaseModel):
     id: str
     name: str
@@ -71,6 +90,7 @@ class Pack(BaseModel):
     description: str
     files: List[PackFile] = []
     preview_urls: List[str] = []
+    preview_variants: List[PackPreview] = []
     stats: PackStats = PackStats()
 
     def add_file(self, file: PackFile) -> None:
@@ -79,6 +99,9 @@ class Pack(BaseModel):
     def add_preview_url(self, preview_url: str) -> None:
         self.preview_urls.append(preview_url)
 
+    def add_preview_variant(self, preview: PackPreview) -> None:
+        self.preview_variants.append(preview)
+
 
 class Catalog(BaseModel):
     packs: List[Pack] = []
@@ -87,54 +110,204 @@ class Catalog(BaseModel):
         self.packs.append(pack)
 
 
+class ManifestFile(BaseModel):
+    name: str
+    sha256: str
+
+
+class UploadManifest(BaseModel):
+    branch: str
+    version_token: str = ""
+    files: List[ManifestFile] = []
+
+
 class IndexerGithub:
-    __repo: Repository.Repository = None
-    __tags: List = []
-    __releases: List = []
-    __branches: List = []
+    __git: "Github" = None
+    __repo: "Repository.Repository" = None
+    __credentials: tuple = None
+    __connect_lock: threading.Lock = None
+    # tags, releases and branches as lists, sets of them for membership
+    # checks, and every parent path of a name with slashes (e.g. `user` for
+    # `user/feature`). Reindexes and GC read it while a refresh syncs, so
+    # sync_info() replaces it as a whole
+    __info: dict = {
+        "tags": [],
+        "releases": [],
+        "branches": [],
+        "tag_set": set(),
+        "release_set": set(),
+        "branch_set": set(),
+        "names": set(),
+        "name_prefixes": set(),
+    }
+    # branch -> Version, "release" -> Version or None, see get_dev_version()
+    __versions: dict = {}
+    synced_at: float = 0
 
     def login(self, token: str, repo_name: str, org_name: str) -> None:
-        try:
-            git = Github(token)
-            org = git.get_organization(org_name)
-            self.__repo = org.get_repo(repo_name)
-        except Exception as e:
-            logging.exception(e)
-            raise e
+        """
+        A method for setting the credentials, the connection is made on
+        first use by connect()
+        """
+        self.__credentials = (token, repo_name, org_name)
+        self.__connect_lock = threading.Lock()
+        self.__git = None
+        self.__repo = None
+
+    def connect(self) -> None:
+        """
+        A method for connecting to the repository, retried
+        settings.github_connect_retries times with exponential backoff
+        """
+        from github import Github
+
+        token, repo_name, org_name = self.__credentials
+        retries = settings.github_connect_retries
+        for attempt in range(retries + 1):
+            try:
+                git = Github(token, timeout=settings.github_timeout)
+                GITHUB_CALLS.labels("get_organization").inc()
+                org = git.get_organization(org_name)
+                GITHUB_CALLS.labels("get_repo").inc()
+                self.__repo = org.get_repo(repo_name)
+                self.__git = git
+                return
+            except Exception as e:
+                if attempt == retries:
+                    logging.exception(e)
+                    raise e
+                delay = settings.github_connect_backoff * 2**attempt
+                logging.warning(
+                    f"Connecting to {org_name}/{repo_name} failed, "
+                    f"retrying in {delay}s: {e}"
+                )
+                time.sleep(delay)
 
-    def __get_tags(self) -> None:
+    def __get_repo(self) -> "Repository.Repository":
+        if self.__repo is None:
+            with self.__connect_lock:
+                if self.__repo is None:
+                    self.connect()
+        return self.__repo
+
+    @traced("IndexerGithub.get_tags")
+    def __get_tags(self) -> List[str]:
         try:
-            github_tags = self.__repo.get_tags()
-            self.__tags = [x.name for x in github_tags]
+            GITHUB_CALLS.labels("get_tags").inc()
+            github_tags = self.__get_repo().get_tags()
+            tags = [x.name for x in github_tags]
+            annotate(items=len(tags))
+            return tags
         except Exception as e:
             logging.exception(e)
             raise e
 
-    def __get_releases(self) -> None:
+    @traced("IndexerGithub.get_releases")
+    def __get_releases(self) -> List[str]:
         try:
-            github_releases = self.__repo.get_releases()
-            self.__releases = [x.title for x in github_releases]
+            GITHUB_CALLS.labels("get_releases").inc()
+            github_releases = self.__get_repo().get_releases()
+            releases = [x.title for x in github_releases]
+            annotate(items=len(releases))
+            return releases
         except Exception as e:
             logging.exception(e)
             raise e
 
-    def __get_branches(self) -> None:
+    @traced("IndexerGithub.get_branches")
+    def __get_branches(self) -> List[str]:
         try:
-            github_branches = self.__repo.get_branches()
-            self.__branches = [x.name for x in github_branches]
+            GITHUB_CALLS.labels("get_branches").inc()
+            github_branches = self.__get_repo().get_branches()
+            branches = [x.name for x in github_branches]
+            annotate(items=len(branches))
+            return branches
         except Exception as e:
             logging.exception(e)
             raise e
 
+    @phase("github_sync")
+    @traced("IndexerGithub.sync_info")
     def sync_info(self):
-        self.__get_tags()
-        self.__get_releases()
-        self.__get_branches()
+        tags = self.__get_tags()
+        releases = self.__get_releases()
+        branches = self.__get_branches()
+        names = set(tags) | set(releases) | set(branches)
+        self.__info = {
+            "tags": tags,
+            "releases": releases,
+            "branches": branches,
+            "tag_set": set(tags),
+            "release_set": set(releases),
+            "branch_set": set(branches),
+            "names": names,
+            "name_prefixes": {
+                name.rsplit("/", i)[0]
+                for name in names
+                for i in range(1, name.count("/") + 1)
+            },
+        }
+        self.synced_at = time.time()
+
+    def is_synced(self) -> bool:
+        return self.synced_at > 0
+
+    def invalidate_versions(self, branches: List[str] = None) -> None:
+        """
+        A method for dropping cached versions, so the next get_dev_version()
+        or get_release_version() asks GitHub again
+        Args:
+            branches: Branches to drop ("release" for the release), all if None
+
+        Returns:
+            Nothing
+        """
+        if branches is None:
+            self.__versions = {}
+        else:
+            self.__versions = {
+                k: v for k, v in self.__versions.items() if k not in branches
+            }
+
+    def get_rate_limit(self) -> tuple:
+        """
+        A method to get the rate limit state from the headers of the last
+        GitHub response. Until a response carried them PyGithub asks the
+        rate limit endpoint (which doesn't count against the limit), so it
+        may block on a request
+        Returns:
+            (remaining, limit, reset timestamp), -1 for unknown values
+        """
+        if self.__git is None:
+            return -1, -1, -1
+        remaining, limit = self.__git.rate_limiting
+        if remaining < 0:
+            return -1, -1, -1
+        return remaining, limit, self.__git.rate_limiting_resettime
+
+    def get_state(self) -> tuple:
+        """
+        A method to get everything the index depends on, to tell if a
+        refresh changed anything
+        """
+        versions = tuple(
+            sorted(
+                (k, v.version if v else None, v.timestamp if v else None)
+                for k, v in self.__versions.items()
+            )
+        )
+        info = self.__info
+        return (
+            tuple(info["tags"]),
+            tuple(info["releases"]),
+            tuple(info["branches"]),
+            versions,
+        )
 
     def get_unstable_branch_names(self) -> List[str]:
         return [
             branch
-            for branch in self.__branches
+            for branch in self.__info["branches"]
             if branch
             not in (
                 "dev",
@@ -143,21 +316,61 @@ class IndexerGithub:
         ]
 
     """
-        We need all stuff above (except login) for the delete_unlinked_directories function in repository.py
+        We need all stuff above (except login) for the GarbageCollector in garbage_collection.py
     """
 
     def is_branch_exist(self, branch: str) -> bool:
-        return branch in self.__branches
+        return branch in self.__info["branch_set"]
 
     def is_release_exist(self, release: str) -> bool:
-        return release in self.__releases
+        return release in self.__info["release_set"]
 
     def is_tag_exist(self, tag: str) -> bool:
-        return tag in self.__tags
+        return tag in self.__info["tag_set"]
+
+    def is_known(self, name: str) -> bool:
+        return name in self.__info["names"]
+
+    def is_known_prefix(self, name: str) -> bool:
+        return name in self.__info["name_prefixes"]
 
     def get_dev_version(self, branch: str) -> Version:
+        if branch not in self.__versions:
+            self.__versions = {
+                **self.__versions,
+                branch: self.__get_dev_version(branch),
+            }
+        # callers modify the version, see add_files_to_version()
+        return copy.deepcopy(self.__versions[branch])
+
+    def get_release_version(self) -> Version:
+        if "release" not in self.__versions:
+            self.__versions = {
+                **self.__versions,
+                "release": self.__get_release_version(),
+            }
+        return copy.deepcopy(self.__versions["release"])
+
+    def refresh_versions(self) -> None:
+        """
+        A method for fetching the versions of all known branches and the
+        release again
+        """
+        versions = {"release": self.__get_release_version()}
+        for branch in ["dev", *self.get_unstable_branch_names()]:
+            try:
+                versions[branch] = self.__get_dev_version(branch)
+            except Exception:
+                continue
+        self.__versions = versions
+
+    @phase("commit_fetch")
+    @traced("IndexerGithub.get_dev_version")
+    def __get_dev_version(self, branch: str) -> Version:
+        annotate(branch=branch)
         try:
-            commits = self.__repo.get_commits(branch)
+            GITHUB_CALLS.labels("get_commits").inc()
+            commits = self.__get_repo().get_commits(branch)
             if commits.totalCount == 0:
                 exception_msg = f"No commits found in {branch} branch!"
                 logging.exception(exception_msg)
@@ -182,10 +395,13 @@ class IndexerGithub:
             logging.exception(e)
             raise e
 
-    def get_release_version(self) -> Version:
-        releases = self.__repo.get_releases()
+    @phase("commit_fetch")
+    @traced("IndexerGithub.get_release_version")
+    def __get_release_version(self) -> Version:
+        GITHUB_CALLS.labels("get_releases").inc()
+        releases = self.__get_repo().get_releases()
         if releases.totalCount == 0:
-            logging.warning(f"No releases found for {self.__repo.full_name}!")
+            logging.warning(f"No releases found for {self.__get_repo().full_name}!")
             return None
         try:
             last_release = next(filter(lambda c: not c.prerelease, releases))
@@ -205,10 +421,12 @@ class FileParser(BaseModel):
         r"^flipper-z-(\w+)-(\w+)-mntm-([A-Za-z0-9_.-]+)\.(\w+)$"
     )
 
+    @phase("hashing")
     def getSHA256(self, filepath: str) -> str:
         with open(filepath, "rb") as file:
             file_bytes = file.read()
             sha256 = hashlib.sha256(file_bytes).hexdigest()
+        count(files=1, bytes=len(file_bytes))
         return sha256
 
     def parse(self, filename: str) -> None:
@@ -224,14 +442,18 @@ class FileParser(BaseModel):
 class PackParser(BaseModel):
     anim_regex: ClassVar[re.Pattern] = re.compile(rb"^Name: (.*)", re.MULTILINE)
 
+    @phase("hashing")
     def getSHA256(self, filepath: str) -> str:
         with open(filepath, "rb") as file:
             file_bytes = file.read()
             sha256 = hashlib.sha256(file_bytes).hexdigest()
+        count(files=1, bytes=len(file_bytes))
         return sha256
 
+    @traced("PackParser.parse")
     def parse(self, packpath: str) -> Pack:
         pack_set = pathlib.Path(packpath)
+        annotate(pack=pack_set.name)
 
         with open(pack_set / "meta.json", "r") as f:
             meta: dict = json.load(f)
@@ -301,16 +523,17 @@ class PackParser(BaseModel):
 
         get_file_date = ["git", "log", "-1", r"--format=%ct"]
         targz_file = f"download/{pack.id}.tar.gz"
-        updated = subprocess.check_output(
-            [*get_file_date, "--", targz_file],
-            cwd=pack_set,
-        )
-        pack.stats.updated = int(updated)
-        added = subprocess.check_output(
-            [*get_file_date, "--diff-filter=A", "--follow", "--", targz_file],
-            cwd=pack_set,
-        )
-        pack.stats.added = int(added)
+        with phase("pack_git_history"):
+            updated = subprocess.check_output(
+                [*get_file_date, "--", targz_file],
+                cwd=pack_set,
+            )
+            pack.stats.updated = int(updated)
+            added = subprocess.check_output(
+                [*get_file_date, "--diff-filter=A", "--follow", "--", targz_file],
+                cwd=pack_set,
+            )
+            pack.stats.added = int(added)
 
         for file in (pack_set / "download").iterdir():
             if file.name.startswith(".") or not file.is_file():
@@ -336,10 +559,12 @@ class PackParser(BaseModel):
             if preview.name.startswith(".") or not preview.is_file():
                 continue
             if preview.suffix in (".png", ".jpg", ".gif"):
-                pack.add_preview_url(
-                    os.path.join(
-                        settings.base_url, preview.relative_to(settings.files_dir)
-                    )
+                preview_url = os.path.join(
+                    settings.base_url, preview.relative_to(settings.files_dir)
+                )
+                pack.add_preview_url(preview_url)
+                pack.add_preview_variant(
+                    PackPreview(url=preview_url, sha256=self.getSHA256(preview))
                 )
         if len(pack.preview_urls) not in range(1, 8):
             logging.warn(
@@ -5,9 +5,14 @@ import subprocess
 
 from .models import *
 from .channels import *
+from .deltas import add_delta_files_to_version
+from .scan_cache import get_scan_cache
+from .metrics import phase
+from .tracing import traced, annotate
 from .settings import settings
 
 
+@traced("add_files_to_version")
 def add_files_to_version(
     version: Version, file_parser: FileParser, main_dir: str, сhannel_dir: str
 ) -> Version:
@@ -23,48 +28,45 @@ def add_files_to_version(
         Modified model version in which the file model was added
     """
     directory_path = os.path.join(settings.files_dir, main_dir, сhannel_dir)
+    annotate(branch=сhannel_dir)
 
-    if not os.path.isdir(directory_path):
-        os.mkdir(directory_path)
+    scan_cache = get_scan_cache(main_dir)
+    with phase("directory_scan"):
+        scan = scan_cache.scan(сhannel_dir, file_parser)
 
-    latest_version = None
-    for entry in sorted(
-        os.scandir(directory_path), key=lambda e: e.stat().st_mtime, reverse=True
-    ):
-        cur = entry.name
-        # skip .DS_store files
-        if cur.startswith("."):
-            continue
-        parsed_file = file_parser()
-        try:
-            parsed_file.parse(cur)
-        except Exception as e:
-            logging.exception(e)
-            continue
-        if latest_version is None:
-            match = file_parser.regex.match(cur)
-            latest_version = "mntm-" + match.group(3)
-            # Is not a release number
-            if not version.version.startswith("mntm-"):
-                # Get commit sha at the end
-                version.version = latest_version.split("-")[-1]
-                if version.version in version.changelog:
-                    pos = version.changelog.find(version.version)
-                    pos = version.changelog.rfind("\n", 0, pos)
-                    version.changelog = version.changelog[pos + 1 :]
-        elif latest_version not in cur:
-            continue
+    if scan["build"] is not None:
+        latest_version = "mntm-" + scan["build"]
+        # Is not a release number
+        if not version.version.startswith("mntm-"):
+            # Get commit sha at the end
+            version.version = latest_version.split("-")[-1]
+            if version.version in version.changelog:
+                pos = version.changelog.find(version.version)
+                pos = version.changelog.rfind("\n", 0, pos)
+                version.changelog = version.changelog[pos + 1 :]
+    for file in scan["files"]:
+        if file["sha256"] is None:
+            file["sha256"] = file_parser().getSHA256(
+                os.path.join(directory_path, file["name"])
+            )
+            scan_cache.set_sha256(сhannel_dir, file["name"], file["sha256"])
         version.add_file(
             VersionFile(
-                url=os.path.join(settings.base_url, main_dir, сhannel_dir, cur),
-                target=parsed_file.target,
-                type=parsed_file.type,
-                sha256=parsed_file.getSHA256(os.path.join(directory_path, cur)),
+                url=os.path.join(
+                    settings.base_url, main_dir, сhannel_dir, file["name"]
+                ),
+                target=file["target"],
+                type=file["type"],
+                sha256=file["sha256"],
             )
         )
+    add_delta_files_to_version(
+        version.files, main_dir, сhannel_dir, scan_cache.scan_deltas(сhannel_dir)
+    )
     return version
 
 
+@traced("parse_dev_channel")
 def parse_dev_channel(
     channel: Channel,
     directory: str,
@@ -89,6 +91,7 @@ def parse_dev_channel(
     return channel
 
 
+@traced("parse_release_channel")
 def parse_release_channel(
     channel: Channel,
     directory: str,
@@ -113,6 +116,7 @@ def parse_release_channel(
     return channel
 
 
+@traced("parse_github_channels")
 def parse_github_channels(
     directory: str, file_parser: FileParser, indexer_github: IndexerGithub
 ) -> dict:
@@ -144,19 +148,72 @@ def parse_github_channels(
         )
     )
     for branch in indexer_github.get_unstable_branch_names():
-        branch_dir = os.path.join(settings.files_dir, directory, branch)
-        if not os.path.isdir(branch_dir) or len(os.listdir(branch_dir)) <= 1:
-            continue
-        channel = copy.deepcopy(branch_channel)
-        channel.id = channel.id.format(branch=branch)
-        channel.title = channel.title.format(branch=branch)
-        channel.description = channel.description.format(branch=branch)
-        json.add_channel(
-            parse_dev_channel(channel, directory, file_parser, indexer_github, branch)
+        channel = parse_branch_channel(directory, file_parser, indexer_github, branch)
+        if channel is not None:
+            json.add_channel(channel)
+    try:
+        get_scan_cache(directory).save()
+    except Exception as e:
+        logging.exception(e)
+    return json.dict(exclude_none=True)
+
+
+@traced("parse_branch_channel")
+def parse_branch_channel(
+    directory: str,
+    file_parser: FileParser,
+    indexer_github: IndexerGithub,
+    branch: str,
+) -> Channel:
+    """
+    Method for creating the channel of an unstable branch
+    Args:
+        directory: Save directory
+        file_parser: The method by which the file piercing will take place (FileParser)
+        branch: Branch name
+
+    Returns:
+        New channel, or None if the branch has no builds
+    """
+    scan = get_scan_cache(directory).scan(branch, file_parser, create=False)
+    if scan is None or scan["count"] <= 1:
+        return None
+    channel = copy.deepcopy(branch_channel)
+    channel.id = channel.id.format(branch=branch)
+    channel.title = channel.title.format(branch=branch)
+    channel.description = channel.description.format(branch=branch)
+    return parse_dev_channel(channel, directory, file_parser, indexer_github, branch)
+
+
+@traced("reparse_release_channel")
+def reparse_release_channel(
+    channel: dict, directory: str, file_parser: FileParser
+) -> Channel:
+    """
+    Method for refreshing the files of an indexed release channel
+    without asking GitHub for the release again
+    Args:
+        channel: Release channel in dict form
+        directory: Save directory
+        file_parser: The method by which the file piercing will take place (FileParser)
+
+    Returns:
+        New channel with refreshed files
+    """
+    new_channel = copy.deepcopy(release_channel)
+    for version in channel["versions"]:
+        version = Version(
+            version=version["version"],
+            changelog=version["changelog"],
+            timestamp=version["timestamp"],
         )
-    return json.dict()
+        new_channel.add_version(
+            add_files_to_version(version, file_parser, directory, version.version)
+        )
+    return new_channel
 
 
+@traced("parse_asset_packs")
 def parse_asset_packs(directory: str, pack_parser: PackParser) -> dict:
     """
     Method for creating a new catalog with packs
@@ -176,10 +233,14 @@ def parse_asset_packs(directory: str, pack_parser: PackParser) -> dict:
         raise Exception(exception_msg)
 
     # Update git submodule
-    subprocess.check_call(["git", "fetch"], cwd=directory_path)
-    subprocess.check_call(["git", "checkout", "origin/dev"], cwd=directory_path)
+    with phase("pack_git_fetch"):
+        subprocess.check_call(["git", "fetch"], cwd=directory_path)
+        subprocess.check_call(["git", "checkout", "origin/dev"], cwd=directory_path)
+
+    with phase("directory_scan"):
+        pack_names = sorted(os.listdir(directory_path))
 
-    for cur in sorted(os.listdir(directory_path)):
+    for cur in pack_names:
         pack_path = os.path.join(directory_path, cur)
         # skip .DS_store files
         if cur.startswith(".") or not os.path.isdir(pack_path):
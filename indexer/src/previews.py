@@ -0,0 +1,124 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from .settings import settings
+
+
+# bumped whenever rendering changes in a way settings don't reflect
+RENDER_VERSION = 1
+
+
+def get_render_key() -> str:
+    """
+    A method to get what rendered variants depend on besides the original,
+    part of their file names so changed settings render them again
+    """
+    return f"v{RENDER_VERSION}-{settings.preview_thumbnail_size}"
+
+
+def get_variant_path(sha256: str, variant: str) -> str:
+    name = f"{sha256}.{get_render_key()}.{variant}.png"
+    return os.path.join(settings.previews_dir, sha256[:2], name)
+
+
+def get_variant_url(sha256: str, variant: str) -> str:
+    return os.path.join(
+        settings.base_url,
+        os.path.relpath(get_variant_path(sha256, variant), settings.files_dir),
+    )
+
+
+def make_preview_variants(source_path: str, sha256: str) -> bool:
+    """
+    A method for rendering the variants of one preview, runs in the process pool
+    Args:
+        source_path: Original preview image
+        sha256: sha256 of the original
+
+    Returns:
+        True if the preview is animated and got a static variant
+    """
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        animated = getattr(image, "is_animated", False)
+        image.seek(0)
+        frame = image.convert("RGBA")
+    os.makedirs(os.path.dirname(get_variant_path(sha256, "thumb")), exist_ok=True)
+    variants = {}
+    if animated:
+        variants["static"] = frame
+    thumb = frame.copy()
+    size = settings.preview_thumbnail_size
+    thumb.thumbnail((size, size), Image.Resampling.LANCZOS)
+    variants["thumb"] = thumb
+    for variant, variant_image in variants.items():
+        path = get_variant_path(sha256, variant)
+        variant_image.save(path + ".tmp", format="PNG", optimize=True)
+        os.replace(path + ".tmp", path)
+    return animated
+
+
+def add_preview_variants(catalog: dict) -> None:
+    """
+    Reindex stage that fills thumbnail and static first frame urls of pack
+    previews. Variants are cached by the sha256 of the original and the
+    render settings, only new previews get rendered (in a process pool),
+    unused variants are removed
+    Args:
+        catalog: Catalog in dict form, modified in place
+
+    Returns:
+        Nothing
+    """
+    previews = [
+        preview for pack in catalog["packs"] for preview in pack["preview_variants"]
+    ]
+    jobs = {}
+    for preview in previews:
+        sha256 = preview["sha256"]
+        if sha256 in jobs or os.path.isfile(get_variant_path(sha256, "thumb")):
+            continue
+        source_path = os.path.join(
+            settings.files_dir, preview["url"].removeprefix(settings.base_url + "/")
+        )
+        jobs[sha256] = source_path
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=settings.preview_workers) as executor:
+            futures = {
+                sha256: executor.submit(make_preview_variants, source_path, sha256)
+                for sha256, source_path in jobs.items()
+            }
+            for sha256, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Preview variants of {jobs[sha256]} failed")
+                    logging.exception(e)
+        logging.info(f"Rendered variants for {len(jobs)} previews")
+
+    for preview in previews:
+        sha256 = preview["sha256"]
+        if not os.path.isfile(get_variant_path(sha256, "thumb")):
+            continue
+        preview["thumbnail_url"] = get_variant_url(sha256, "thumb")
+        if os.path.isfile(get_variant_path(sha256, "static")):
+            preview["static_url"] = get_variant_url(sha256, "static")
+        else:
+            preview["static_url"] = preview["url"]
+
+    delete_unused_variants({preview["sha256"] for preview in previews})
+
+
+def delete_unused_variants(used: set) -> None:
+    if not os.path.isdir(settings.previews_dir):
+        return
+    render_key = get_render_key()
+    for root, dirs, files in os.walk(settings.previews_dir):
+        for file in files:
+            # variants rendered with other settings too
+            sha256, _, rest = file.partition(".")
+            if sha256 not in used or rest.partition(".")[0] != render_key:
+                os.remove(os.path.join(root, file))
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import itertools
+
+from .metrics import locked
+from .settings import settings
+
+# directory -> lock held while its files or index change
+index_locks = {}
+
+
+def get_index_lock(directory: str) -> asyncio.Lock:
+    return index_locks.setdefault(directory, asyncio.Lock())
+
+
+class ReindexPool:
+    """
+    Runs reindexes of all indexes in a bounded number of threads, the
+    lowest priority number first. A reindex that is already queued is not
+    queued again, so every index has at most one reindex waiting and a
+    busy index can't starve the others
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.queue = None
+        self.queued = {}
+        self.counter = itertools.count()
+        self.tasks = []
+
+    def start(self, workers: int) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [self.loop.create_task(self.run()) for _ in range(max(workers, 1))]
+
+    def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def submit(
+        self, index, *args, method: str = "reindex", priority: int = None
+    ) -> asyncio.Future:
+        """
+        A method for queueing a reindex
+        Args:
+            index: RepositoryIndex or PacksCatalog
+            args: Arguments of the reindex method, have to be hashable
+            method: Reindex method of the index
+            priority: Overrides the priority of the index
+
+        Returns:
+            Future that is done when the reindex is
+        """
+        key = (index.directory, method, args)
+        if key in self.queued:
+            return self.queued[key]
+        future = self.loop.create_future()
+        # failures are logged by the reindex itself
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.queued[key] = future
+        if priority is None:
+            priority = index.priority
+        self.queue.put_nowait((priority, next(self.counter), key, index))
+        return future
+
+    async def run(self) -> None:
+        while True:
+            priority, _, key, index = await self.queue.get()
+            directory, method, args = key
+            # from here on new requests queue another reindex
+            future = self.queued.pop(key)
+            try:
+                async with locked(get_index_lock(directory), "reindex"):
+                    await asyncio.to_thread(getattr(index, method), *args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+
+pool = ReindexPool()
+
+
+async def reindex_until_initialized(index) -> None:
+    """
+    A method for retrying the first full reindex of an index until one
+    succeeds, e.g. while GitHub is unreachable at startup. The index answers
+    503 until then, never an empty index
+    Args:
+        index: RepositoryIndex or PacksCatalog
+
+    Returns:
+        Nothing
+    """
+    delay = settings.not_ready_retry_after
+    while not index.initialized:
+        try:
+            await pool.submit(index)
+            return
+        except Exception:
+            logging.error(f"{index.directory} first reindex failed, retry in {delay}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, settings.github_refresh_max_interval)
+
+
+def call_in_loop(callback) -> None:
+    """
+    A method to run a callback on the event loop, for code that is called
+    both from the loop and from pool threads (e.g. setting asyncio events)
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        if pool.loop is not None and pool.loop.is_running():
+            pool.loop.call_soon_threadsafe(callback)
+            return
+    callback()
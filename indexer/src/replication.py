@@ -0,0 +1,359 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import JSONResponse, FileResponse
+
+from .repository import indexes, collect_file_digests
+from .slices import match_etag
+from .metrics import phase
+from .settings import settings
+
+
+router = APIRouter()
+
+# directory -> (index, files) of the last published snapshot
+manifests = {}
+# file path -> (mtime_ns, size, sha256) for files the index has no digest for
+file_hashes = {}
+
+
+def collect_files(index: dict) -> dict:
+    """
+    A method for listing every file an index links to, including preview
+    variants and deltas
+    Args:
+        index: Index in dict form
+
+    Returns:
+        Dict of path relative to files_dir -> sha256, None where the
+        index doesn't carry a digest
+    """
+    prefix = settings.base_url + "/"
+    files = {}
+    nodes = [index]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        for key, value in node.items():
+            if isinstance(value, (dict, list)):
+                nodes.append(value)
+            elif key.endswith("url") and isinstance(value, str):
+                if not value.startswith(prefix):
+                    continue
+                path = value.removeprefix(prefix)
+                sha256 = node.get("sha256") if key == "url" else None
+                if files.get(path) is None:
+                    files[path] = sha256
+    return files
+
+
+def get_file_sha256(path: str) -> str:
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    with open(path, "rb") as file:
+        sha256 = hashlib.file_digest(file, "sha256").hexdigest()
+    file_hashes[path] = (stat.st_mtime_ns, stat.st_size, sha256)
+    return sha256
+
+
+def get_manifest(directory: str, index: dict) -> dict:
+    """
+    A method for getting the files of a published index with a digest
+    for every one of them, rebuilt only when the index changes
+    Args:
+        directory: Index directory
+        index: Index in dict form
+
+    Returns:
+        Dict of path relative to files_dir -> sha256
+    """
+    cached = manifests.get(directory)
+    if cached and cached[0] is index:
+        return cached[1]
+    files = {}
+    for path, sha256 in collect_files(index).items():
+        if sha256 is None:
+            try:
+                sha256 = get_file_sha256(os.path.join(settings.files_dir, path))
+            except OSError:
+                logging.warning(f"{directory} links to missing {path}")
+                continue
+        files[path] = sha256
+    manifests[directory] = (index, files)
+    return files
+
+
+@router.get("/replication/{directory}/snapshot")
+async def snapshot_request(request: Request, directory: str):
+    """
+    Method for obtaining the published index of a directory with the
+    digests of all files it links to, for replicas
+    Args:
+        directory: Index directory
+
+    Returns:
+        Generation, ETag of directory.json, index and files in json
+    """
+    index = indexes.get(directory)
+    if index is None:
+        return JSONResponse(f"Index `{directory}` not found!", status_code=404)
+    if not index.initialized:
+        return JSONResponse("Index is not ready yet!", status_code=503)
+    # the index the served directory.json was made of, with its ETag
+    slices = index.slices
+    etag = slices.get()[1]
+    if match_etag(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    files = await asyncio.to_thread(get_manifest, directory, slices.index)
+    return JSONResponse(
+        {
+            "generation": index.changes.generation,
+            "etag": etag,
+            "index": slices.index,
+            "files": files,
+        },
+        headers={"ETag": etag},
+    )
+
+
+@router.get("/replication/{directory}/files/{path:path}")
+async def file_request(directory: str, path: str):
+    """
+    Method for obtaining a file linked from the published index, for replicas
+    Args:
+        directory: Index directory
+        path: File path relative to files_dir, as listed in the snapshot
+
+    Returns:
+        File
+    """
+    index = indexes.get(directory)
+    cached = manifests.get(directory)
+    # only what was published, so nothing else under files_dir leaks out
+    if index is None or cached is None or path not in cached[1]:
+        return JSONResponse("File not found, try a newer snapshot!", status_code=404)
+    file_path = os.path.join(settings.files_dir, path)
+    if not os.path.isfile(file_path):
+        return JSONResponse("File not found, try a newer snapshot!", status_code=404)
+    return FileResponse(file_path, media_type="application/octet-stream")
+
+
+class Replica:
+    """
+    Keeps an index in sync with the same index on the primary
+    (settings.replica_of). Waits for new generations on the primary's
+    change feed, downloads only the files that changed into a staging
+    directory, verifies their digests, moves them in place and then swaps
+    in the new index. Replicas never reindex and never call GitHub
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.generation = None
+        self.etag = None
+        # path relative to files_dir -> sha256 of what is installed
+        self.files = {}
+        self.task = None
+
+    def start(self) -> None:
+        self.load_state()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    def get_state_path(self) -> str:
+        return os.path.join(settings.replica_dir, f"{self.index.directory}.json")
+
+    def get_staging_dir(self) -> str:
+        return os.path.join(settings.replica_dir, f"{self.index.directory}.staging")
+
+    def load_state(self) -> None:
+        """
+        A method for serving the last replicated snapshot right away after
+        a restart, even while the primary is unreachable
+        """
+        try:
+            with open(self.get_state_path(), "r") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.exception(e)
+            return
+        self.files = state["files"]
+        self.etag = state["etag"]
+        self.swap(state["generation"], state["index"])
+
+    def save_state(self, index: dict) -> None:
+        os.makedirs(settings.replica_dir, exist_ok=True)
+        state_path = self.get_state_path()
+        with open(state_path + ".tmp", "w") as state_file:
+            json.dump(
+                {
+                    "generation": self.generation,
+                    "etag": self.etag,
+                    "index": index,
+                    "files": self.files,
+                },
+                state_file,
+            )
+        os.replace(state_path + ".tmp", state_path)
+
+    def open(self, path: str, timeout: float = None, headers: dict = None):
+        request = urllib.request.Request(
+            settings.replica_of.rstrip("/") + urllib.parse.quote(path, safe="/?=&"),
+            headers={"Token": settings.token or "", **(headers or {})},
+        )
+        return urllib.request.urlopen(
+            request, timeout=timeout or settings.replica_timeout
+        )
+
+    def get_json(self, path: str, timeout: float = None, headers: dict = None):
+        with self.open(path, timeout, headers) as response:
+            return json.load(response)
+
+    def is_installed(self, path: str, sha256: str) -> bool:
+        file_path = os.path.join(settings.files_dir, path)
+        if self.files.get(path) == sha256:
+            return os.path.isfile(file_path)
+        try:
+            # e.g. a files dir copied over before the replica first started
+            with open(file_path, "rb") as file:
+                return hashlib.file_digest(file, "sha256").hexdigest() == sha256
+        except OSError:
+            return False
+
+    def download(self, path: str, sha256: str) -> str:
+        """
+        A method for downloading a file of the snapshot into staging
+        Args:
+            path: File path relative to files_dir
+            sha256: Digest from the snapshot
+
+        Returns:
+            Path of the verified staged file
+        """
+        staged_path = os.path.join(
+            self.get_staging_dir(), hashlib.sha256(path.encode()).hexdigest()
+        )
+        digest = hashlib.sha256()
+        with self.open(
+            f"/replication/{self.index.directory}/files/{path}"
+        ) as response, open(staged_path, "wb") as staged_file:
+            while chunk := response.read(1024 * 1024):
+                digest.update(chunk)
+                staged_file.write(chunk)
+        if digest.hexdigest() != sha256:
+            raise ValueError(f"Digest of {path} doesn't match the snapshot")
+        return staged_path
+
+    def delete(self, path: str) -> None:
+        file_path = os.path.join(settings.files_dir, path)
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        # up to, but not including, the index or hidden top level directory
+        parent = os.path.dirname(path)
+        while os.sep in parent:
+            try:
+                os.rmdir(os.path.join(settings.files_dir, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def swap(self, generation: int, index: dict) -> None:
+        self.index.index = index
+        self.index.file_digests = collect_file_digests(index)
+        self.index.build_slices(generation)
+        self.index.initialized = True
+        self.generation = generation
+
+    def sync(self) -> bool:
+        """
+        A method for pulling the primary's current snapshot
+        Returns:
+            True if a new snapshot was swapped in
+        """
+        try:
+            snapshot = self.get_json(
+                f"/replication/{self.index.directory}/snapshot",
+                headers={"If-None-Match": self.etag} if self.etag else None,
+            )
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return False
+            raise e
+        with phase("replica_sync"):
+            files = snapshot["files"]
+            missing = {
+                path: sha256
+                for path, sha256 in files.items()
+                if not self.is_installed(path, sha256)
+            }
+            staging_dir = self.get_staging_dir()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            os.makedirs(staging_dir)
+            try:
+                # everything is verified before anything is touched
+                staged = {
+                    path: self.download(path, sha256)
+                    for path, sha256 in missing.items()
+                }
+                for path, staged_path in staged.items():
+                    file_path = os.path.join(settings.files_dir, path)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    os.replace(staged_path, file_path)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            removed = self.files.keys() - files.keys()
+            self.files = files
+            self.etag = snapshot["etag"]
+            self.swap(snapshot["generation"], snapshot["index"])
+            # only once nothing links to them anymore
+            for path in removed:
+                self.delete(path)
+            self.save_state(snapshot["index"])
+        logging.info(
+            f"{self.index.directory} replicated generation {self.generation}, "
+            f"{len(missing)} files transferred, {len(removed)} removed"
+        )
+        return True
+
+    def wait_for_changes(self) -> None:
+        """
+        A method to long-poll the primary's change feed until there is a
+        newer generation or the wait is over
+        """
+        wait = settings.replica_poll_wait
+        self.get_json(
+            f"/{self.index.directory}/changes?since={self.generation or 0}&wait={wait}",
+            timeout=wait + settings.replica_timeout,
+        )
+
+    async def run(self) -> None:
+        while True:
+            try:
+                # also after a long-poll timed out, the change feed only
+                # covers the latest version of every channel
+                await asyncio.to_thread(self.sync)
+                await asyncio.to_thread(self.wait_for_changes)
+            except Exception as e:
+                logging.error(f"{self.index.directory} replication failed")
+                logging.exception(e)
+                await asyncio.sleep(settings.replica_retry_delay)
@@ -1,15 +1,68 @@
 import os
+import copy
+import time
 import shutil
 import logging
 
-from .parsers import parse_github_channels, parse_asset_packs
+from .parsers import (
+    parse_github_channels,
+    parse_asset_packs,
+    parse_dev_channel,
+    parse_branch_channel,
+    reparse_release_channel,
+)
+from .channels import development_channel, release_channel, branch_channel
+from .garbage_collection import GarbageCollector
+from .cdn import purge_changed
+from .slices import IndexSlices
+from .changes import ChangeFeed
+from .catalog_query import PacksQueryIndex
+from .previews import add_preview_variants
+from .metrics import INDEX_SIZE, REINDEX_DURATION
+from .tracing import traced, annotate
 from .models import *
 from .settings import settings
 
 
+def collect_file_digests(index: dict) -> dict:
+    """
+    A method for mapping the sha256 of every file listed in an index
+    to its location on disk
+    Args:
+        index: Index in dict form
+
+    Returns:
+        Dict of sha256 -> file path
+    """
+    digests = {}
+    nodes = [index]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        if isinstance(node.get("url"), str) and isinstance(node.get("sha256"), str):
+            if node["url"].startswith(settings.base_url + "/"):
+                relative_path = node["url"].removeprefix(settings.base_url + "/")
+                digests[node["sha256"]] = os.path.join(
+                    settings.files_dir, relative_path
+                )
+        nodes.extend(node.values())
+    return digests
+
+
 class RepositoryIndex:
     index: dict
+    slices: IndexSlices
+    changes: ChangeFeed
+    file_digests: dict
+    last_reindex_ns: int
+    initialized: bool
+    gc: GarbageCollector
     indexer_github: IndexerGithub
+    priority: int
 
     def __init__(
         self,
@@ -18,83 +71,151 @@ class RepositoryIndex:
         github_repo: str,
         github_org: str,
         file_parser: FileParser = FileParser,
+        priority: int = 0,
     ):
         self.index = Index().dict()
+        self.slices = IndexSlices(self.index)
+        self.changes = ChangeFeed(directory)
+        self.file_digests = {}
+        self.last_reindex_ns = 0
+        # a full reindex succeeded, until then requests are answered with 503
+        self.initialized = False
         self.indexer_github = IndexerGithub()
         self.indexer_github.login(github_token, github_repo, github_org)
         self.directory = directory
         self.file_parser = file_parser
+        self.priority = priority
+        self.gc = GarbageCollector(self)
 
-    def delete_empty_directories(self):
-        """
-        A method for cleaning directories that are empty
-        Returns:
-            Nothing
-        """
-        main_dir = os.path.join(settings.files_dir, self.directory)
-        for cur in os.listdir(main_dir):
-            if cur.startswith("."):
-                continue
-            cur_dir = os.path.join(main_dir, cur)
-            dir_content = os.listdir(cur_dir)
-            if len(dir_content) > 0:
-                continue
-            shutil.rmtree(cur_dir)
-            logging.info(f"Deleting {cur_dir}")
-
-    def delete_unlinked_directories(self):
-        """
-        A method for cleaning directories that do not match
-        branches/releases in the repository
-        Args:
-            Nothing
-
-        Returns:
-            Nothing
-        """
-        main_dir = os.path.join(settings.files_dir, self.directory)
-        for root, dirs, files in os.walk(main_dir):
-            if len(files) == 0:
-                continue
-            # skip .DS_store files
-            if len(files) == 1 and files[0].startswith("."):
-                continue
-            cur_dir = root.split(main_dir + "/")[1]
-            if self.indexer_github.is_release_exist(cur_dir):
-                continue
-            if self.indexer_github.is_tag_exist(cur_dir):
-                continue
-            if self.indexer_github.is_branch_exist(cur_dir):
-                continue
-            shutil.rmtree(os.path.join(main_dir, cur_dir))
-            logging.info(f"Deleting {cur_dir}")
-
-    def reindex(self):
+    @traced("RepositoryIndex.reindex")
+    def reindex(self, fresh_branches: List[str] = None):
         """
         Method for starting reindexing. We get three channels - dev, release
         from the main repository in the git. We run through all 3 channels,
         each channel has different versions inside. We create models for all
         versions and stuff them with the path to the artifacts.
 
-        At the end of reindexing, all unnecessary branches and
-        empty directories are cleared
+        At the end of reindexing, a garbage collection of unnecessary
+        branches and empty directories is requested, it runs in the background
+
+        Args:
+            fresh_branches: Only ask GitHub about these branches again and
+                reuse the last synced state for everything else. Unknown
+                branches (e.g. a new release) still force a full sync
 
         Returns:
             Nothing
         """
         try:
-            self.indexer_github.sync_info()
+            annotate(directory=self.directory)
+            started = time.monotonic()
+            github = self.indexer_github
+            if (
+                fresh_branches is None
+                or not github.is_synced()
+                or not all(github.is_known(branch) for branch in fresh_branches)
+            ):
+                github.sync_info()
+                github.invalidate_versions()
+            else:
+                if any(github.is_release_exist(branch) for branch in fresh_branches):
+                    fresh_branches = [*fresh_branches, "release"]
+                github.invalidate_versions(fresh_branches)
             self.index = parse_github_channels(
                 self.directory, self.file_parser, self.indexer_github
             )
+            self.file_digests = collect_file_digests(self.index)
+            self.build_slices()
+            REINDEX_DURATION.labels(self.directory, "full").observe(
+                time.monotonic() - started
+            )
             logging.info(f"{self.directory} reindex OK")
-            self.delete_unlinked_directories()
-            self.delete_empty_directories()
+            self.gc.request()
+            self.last_reindex_ns = time.time_ns()
+            self.initialized = True
         except Exception as e:
             logging.error(f"{self.directory} reindex failed")
             logging.exception(e)
             raise e
 
+    @traced("RepositoryIndex.reindex_branch")
+    def reindex_branch(self, branch: str):
+        """
+        Method for reindexing only the channel backed by one branch directory.
+        Uses the GitHub branches/releases known from the last full reindex,
+        directories that don't back a channel are ignored
+
+        Returns:
+            Nothing
+        """
+        try:
+            annotate(directory=self.directory, branch=branch)
+            started = time.monotonic()
+            channels = {channel["id"]: channel for channel in self.index["channels"]}
+            release = channels.get(release_channel.id)
+            if branch == "dev":
+                channel_id = development_channel.id
+                channel = parse_dev_channel(
+                    copy.deepcopy(development_channel),
+                    self.directory,
+                    self.file_parser,
+                    self.indexer_github,
+                    branch,
+                )
+            elif release and any(v["version"] == branch for v in release["versions"]):
+                channel_id = release_channel.id
+                channel = reparse_release_channel(
+                    release, self.directory, self.file_parser
+                )
+            elif branch in self.indexer_github.get_unstable_branch_names():
+                channel_id = branch_channel.id.format(branch=branch)
+                channel = parse_branch_channel(
+                    self.directory, self.file_parser, self.indexer_github, branch
+                )
+            else:
+                logging.info(f"{self.directory}/{branch} is not indexed, skipping")
+                return
+            if channel is None:
+                channels.pop(channel_id, None)
+            else:
+                channels[channel_id] = channel.dict(exclude_none=True)
+            order = [development_channel.id, release_channel.id] + [
+                branch_channel.id.format(branch=name)
+                for name in self.indexer_github.get_unstable_branch_names()
+            ]
+            self.index = {
+                **self.index,
+                "channels": [channels[i] for i in order if i in channels],
+            }
+            self.file_digests = collect_file_digests(self.index)
+            self.build_slices()
+            self.last_reindex_ns = time.time_ns()
+            REINDEX_DURATION.labels(self.directory, "branch").observe(
+                time.monotonic() - started
+            )
+            logging.info(f"{self.directory}/{branch} reindex OK")
+        except Exception as e:
+            logging.error(f"{self.directory}/{branch} reindex failed")
+            logging.exception(e)
+            raise e
+
+    def build_slices(self, generation: int = None) -> None:
+        """
+        A method for serializing the filtered views of the index served by
+        directory.json, has to be called whenever self.index changes
+        Args:
+            generation: Change feed generation, the next one if empty
+
+        Returns:
+            Nothing
+        """
+        slices = IndexSlices(self.index)
+        slices.precompute()
+        self.slices = slices
+        INDEX_SIZE.labels(self.directory).set(len(slices.get()[0]))
+        self.changes.record(self.index, generation)
+        purge_changed(self.directory, slices, self.changes.generation)
+
     # def get_branch_file_names(self: str, branch: str) -> list[str]:
     #     """
     #     A method to get a list of file names in the specified branch
@@ -166,15 +287,31 @@ class RepositoryIndex:
 
 class PacksCatalog:
     index: dict
+    slices: IndexSlices
+    changes: ChangeFeed
+    query_index: PacksQueryIndex
+    last_reindex_ns: int
+    initialized: bool
+    file_digests: dict
+    priority: int
 
     def __init__(
         self,
         directory: str,
         pack_parser: PackParser = PackParser,
+        priority: int = 10,
     ):
         self.index = Catalog().dict()
+        self.slices = IndexSlices(self.index)
+        self.changes = ChangeFeed(directory)
+        self.query_index = PacksQueryIndex(self.index, self.changes.generation)
+        self.file_digests = {}
+        self.last_reindex_ns = 0
+        # a full reindex succeeded, until then requests are answered with 503
+        self.initialized = False
         self.directory = directory
         self.pack_parser = pack_parser
+        self.priority = priority
 
     def delete_empty_directories(self):
         """
@@ -193,6 +330,7 @@ class PacksCatalog:
             shutil.rmtree(cur_dir)
             logging.info(f"Deleting {cur_dir}")
 
+    @traced("PacksCatalog.reindex")
     def reindex(self):
         """
         Method for starting reindexing. We get available packs from disk
@@ -204,14 +342,86 @@ class PacksCatalog:
             Nothing
         """
         try:
+            annotate(directory=self.directory)
+            started = time.monotonic()
             self.index = parse_asset_packs(self.directory, self.pack_parser)
+            add_preview_variants(self.index)
+            self.file_digests = collect_file_digests(self.index)
+            self.build_slices()
+            REINDEX_DURATION.labels(self.directory, "full").observe(
+                time.monotonic() - started
+            )
             logging.info(f"{self.directory} reindex OK")
             self.delete_empty_directories()
+            self.last_reindex_ns = time.time_ns()
+            self.initialized = True
         except Exception as e:
             logging.error(f"{self.directory} reindex failed")
             logging.exception(e)
             raise e
 
+    @traced("PacksCatalog.reindex_pack")
+    def reindex_pack(self, pack_id: str):
+        """
+        Method for reindexing a single pack from disk, without updating
+        the git checkout
+
+        Returns:
+            Nothing
+        """
+        try:
+            annotate(directory=self.directory, pack=pack_id)
+            started = time.monotonic()
+            pack_path = os.path.join(settings.files_dir, self.directory, pack_id)
+            packs = [pack for pack in self.index["packs"] if pack["id"] != pack_id]
+            if os.path.isdir(pack_path) and not pack_id.startswith("."):
+                try:
+                    packs.append(self.pack_parser().parse(pack_path).dict())
+                except Exception as e:
+                    logging.exception(e)
+            packs.sort(key=lambda pack: pack["id"])
+            index = {**self.index, "packs": packs}
+            add_preview_variants(index)
+            self.index = index
+            self.file_digests = collect_file_digests(self.index)
+            self.build_slices()
+            self.last_reindex_ns = time.time_ns()
+            REINDEX_DURATION.labels(self.directory, "pack").observe(
+                time.monotonic() - started
+            )
+            logging.info(f"{self.directory}/{pack_id} reindex OK")
+        except Exception as e:
+            logging.error(f"{self.directory}/{pack_id} reindex failed")
+            logging.exception(e)
+            raise e
+
+    def build_slices(self, generation: int = None) -> None:
+        """
+        A method for serializing the index served by directory.json,
+        has to be called whenever self.index changes
+        Args:
+            generation: Change feed generation, the next one if empty
+
+        Returns:
+            Nothing
+        """
+        slices = IndexSlices(self.index)
+        slices.precompute()
+        self.slices = slices
+        INDEX_SIZE.labels(self.directory).set(len(slices.get()[0]))
+        self.changes.record(self.index, generation)
+        purge_changed(self.directory, slices, self.changes.generation)
+        self.query_index = PacksQueryIndex(self.index, self.changes.generation)
+
+    def list_packs(self, **kwargs) -> dict:
+        """
+        A method for listing packs sorted, filtered and paginated,
+        see PacksQueryIndex.query() for the arguments
+        Returns:
+            Page of packs
+        """
+        return self.query_index.query(**kwargs)
+
     # def get_file_path(
     #     self: str, pack: str, file_type: str, file_name: str, sha256: str
     # ) -> str:
@@ -246,16 +456,19 @@ class PacksCatalog:
     #     return file_path
 
 
-indexes = {
-    "firmware": RepositoryIndex(
-        directory="firmware",
-        github_token=settings.firmware_github_token,
-        github_repo=settings.firmware_github_repo,
-        github_org=settings.github_org,
-    ),
-    "asset-packs": PacksCatalog(
-        directory="asset-packs",
-    ),
-}
+indexes = {}
+for config in settings.indexes.repositories:
+    indexes[config.directory] = RepositoryIndex(
+        directory=config.directory,
+        github_token=os.getenv(config.github_token_env),
+        github_repo=config.github_repo,
+        github_org=config.github_org,
+        priority=config.priority,
+    )
+for config in settings.indexes.pack_catalogs:
+    indexes[config.directory] = PacksCatalog(
+        directory=config.directory,
+        priority=config.priority,
+    )
 
-raw_file_upload_directories = []
+raw_file_upload_directories = list(settings.indexes.raw_directories)
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+from .deltas import DELTA_SUFFIX
+from .settings import settings
+
+
+# index directory -> ScanCache
+caches = {}
+
+
+class ScanCache:
+    """
+    Parsed artifact lists of the branch directories of one index, and the
+    digests of their deltas, keyed on (directory path, mtime_ns, inode) and
+    persisted in state_dir. Adding, removing or renaming a file bumps the
+    mtime of its directory, so an unchanged branch costs a stat of each
+    directory instead of a listing, a stat per file, a parse per file and
+    hashing of the latest build and its deltas. Files rewritten in place are
+    not noticed, uploads, deltas and the cold tier always rename
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        state = self.load()
+        # branch -> scan
+        self.scans = state.get("branches", {})
+        # branch -> delta scan
+        self.deltas = state.get("deltas", {})
+        self.used = set()
+        self.used_deltas = set()
+        self.dirty = False
+
+    def get_state_path(self) -> str:
+        return os.path.join(settings.state_dir, f"{self.directory}.scan.json")
+
+    def load(self) -> dict:
+        try:
+            with open(self.get_state_path(), "r") as state_file:
+                state = json.load(state_file)
+            # written before deltas were cached, it is only a cache
+            if set(state) != {"branches", "deltas"}:
+                return {}
+            return state
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.exception(e)
+            return {}
+
+    def save(self) -> None:
+        """
+        A method for persisting the scans used since the last save, scans
+        of branches that weren't asked for are dropped. Call it after a full
+        reindex, which asks for every branch that still exists
+        """
+        stale = self.scans.keys() - self.used
+        stale_deltas = self.deltas.keys() - self.used_deltas
+        self.used = set()
+        self.used_deltas = set()
+        if not stale and not stale_deltas and not self.dirty:
+            return
+        for branch in stale:
+            del self.scans[branch]
+        for branch in stale_deltas:
+            del self.deltas[branch]
+        os.makedirs(settings.state_dir, exist_ok=True)
+        state_path = self.get_state_path()
+        with open(state_path + ".tmp", "w") as state_file:
+            json.dump({"branches": self.scans, "deltas": self.deltas}, state_file)
+        os.replace(state_path + ".tmp", state_path)
+        self.dirty = False
+
+    def scan(self, branch: str, file_parser, create: bool = True) -> dict:
+        """
+        A method to get the latest build of a branch directory
+        Args:
+            branch: Branch directory name
+            file_parser: FileParser class the artifact names are parsed with
+            create: Create the directory if it doesn't exist
+
+        Returns:
+            Dict with the number of directory entries (`count`), the build
+            of the newest artifact (`build`) and that build's artifacts
+            newest first (`files`: name, target, type and sha256, None
+            until hashed, see set_sha256()). A copy, None if the directory
+            doesn't exist and create is not set
+        """
+        path = os.path.join(settings.files_dir, self.directory, branch)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if not create:
+                return None
+            os.mkdir(path)
+            stat = os.stat(path)
+        self.used.add(branch)
+        key = [stat.st_mtime_ns, stat.st_ino]
+        cached = self.scans.get(branch)
+        if is_fresh(cached, stat):
+            return copy_scan(cached)
+        # e.g. a build was added to another one, only new files are hashed
+        known = {file["name"]: file for file in cached["files"]} if cached else {}
+        scanned_ns = time.time_ns()
+        entries = sorted(
+            os.scandir(path), key=lambda e: e.stat().st_mtime, reverse=True
+        )
+        scan = {
+            "key": key,
+            "scanned_ns": scanned_ns,
+            "count": len(entries),
+            "build": None,
+            "files": [],
+        }
+        for entry in entries:
+            # skip .DS_store files
+            if entry.name.startswith("."):
+                continue
+            parsed_file = file_parser()
+            try:
+                parsed_file.parse(entry.name)
+            except Exception as e:
+                logging.exception(e)
+                continue
+            if scan["build"] is None:
+                scan["build"] = file_parser.regex.match(entry.name).group(3)
+            elif "mntm-" + scan["build"] not in entry.name:
+                continue
+            entry_stat = entry.stat()
+            file = {
+                "name": entry.name,
+                "mtime_ns": entry_stat.st_mtime_ns,
+                "size": entry_stat.st_size,
+                "target": parsed_file.target,
+                "type": parsed_file.type,
+                "sha256": None,
+            }
+            cached_file = known.get(entry.name)
+            if cached_file and all(
+                cached_file[k] == file[k] for k in ("mtime_ns", "size")
+            ):
+                file["sha256"] = cached_file["sha256"]
+            scan["files"].append(file)
+        self.scans[branch] = scan
+        self.dirty = True
+        return copy_scan(scan)
+
+    def set_sha256(self, branch: str, name: str, sha256: str) -> None:
+        """
+        A method for storing the digest of a file listed by scan()
+        """
+        scan = self.scans.get(branch)
+        if scan is None:
+            return
+        for file in scan["files"]:
+            if file["name"] == name:
+                file["sha256"] = sha256
+                self.dirty = True
+
+    def scan_deltas(self, branch: str) -> dict:
+        """
+        A method to get the deltas of a branch with their digests, cached
+        like scan() on their directory in settings.deltas_dir
+        Args:
+            branch: Branch directory name
+
+        Returns:
+            Dict of delta name -> sha256
+        """
+        path = os.path.join(settings.deltas_dir, self.directory, branch)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        self.used_deltas.add(branch)
+        cached = self.deltas.get(branch)
+        if not is_fresh(cached, stat):
+            scanned_ns = time.time_ns()
+            files = {}
+            for entry in os.scandir(path):
+                if not entry.name.endswith(DELTA_SUFFIX):
+                    continue
+                entry_stat = entry.stat()
+                file = {"mtime_ns": entry_stat.st_mtime_ns, "size": entry_stat.st_size}
+                # e.g. one delta was added, the others aren't hashed again
+                known = (cached or {"files": {}})["files"].get(entry.name)
+                if known and all(known[k] == file[k] for k in ("mtime_ns", "size")):
+                    file["sha256"] = known["sha256"]
+                else:
+                    with open(entry.path, "rb") as delta_file:
+                        digest = hashlib.file_digest(delta_file, "sha256")
+                    file["sha256"] = digest.hexdigest()
+                files[entry.name] = file
+            cached = {
+                "key": [stat.st_mtime_ns, stat.st_ino],
+                "scanned_ns": scanned_ns,
+                "files": files,
+            }
+            self.deltas[branch] = cached
+            self.dirty = True
+        return {name: file["sha256"] for name, file in cached["files"].items()}
+
+
+def copy_scan(scan: dict) -> dict:
+    return {**scan, "files": [dict(file) for file in scan["files"]]}
+
+
+def is_fresh(cached: dict, stat: os.stat_result) -> bool:
+    """
+    A method to tell if a cached scan of a directory can be used
+    """
+    if not cached or cached["key"] != [stat.st_mtime_ns, stat.st_ino]:
+        return False
+    # the mtime of a directory changed again within its granularity looks
+    # the same, so scans that close to it are not trusted
+    racy_ns = settings.scan_cache_racy_window * 1e9
+    return cached["scanned_ns"] - stat.st_mtime_ns > racy_ns
+
+
+def get_scan_cache(directory: str) -> ScanCache:
+    if directory not in caches:
+        caches[directory] = ScanCache(directory)
+    return caches[directory]
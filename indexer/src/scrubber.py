@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import ctypes
+import hashlib
+import logging
+import platform
+import threading
+from fastapi import APIRouter
+
+from .repository import indexes
+from .replication import collect_files
+from .metrics import SCRUB_BYTES, SCRUB_MISMATCHES
+from .settings import settings
+
+
+router = APIRouter()
+
+CHUNK_SIZE = 1024 * 1024
+# ioprio_set(2) has no libc wrapper
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def set_idle_io_priority() -> bool:
+    """
+    A method for putting the calling thread in the idle IO scheduling
+    class, so its reads only get disk time nobody else wants. Linux only,
+    and only honored by IO schedulers with priorities (e.g. BFQ)
+
+    Returns:
+        True if the priority was set
+    """
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is None or not hasattr(threading, "get_native_id"):
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        result = libc.syscall(
+            syscall,
+            IOPRIO_WHO_PROCESS,
+            threading.get_native_id(),
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT,
+        )
+    except (OSError, AttributeError):
+        return False
+    return result == 0
+
+
+def list_published_files() -> list:
+    """
+    A method to list the published files that have a digest in an index
+    Returns:
+        Sorted list of (directory, path relative to files_dir, sha256)
+    """
+    files = []
+    for directory, index in indexes.items():
+        for path, sha256 in collect_files(index.index).items():
+            if sha256:
+                files.append((directory, path, sha256))
+    return sorted(files)
+
+
+class Scrubber:
+    """
+    Re-hashes all published files on a rolling schedule, one pass every
+    settings.scrub_interval seconds, and compares them with the digests in
+    the index. Runs in its own thread with idle IO priority and reads at
+    most settings.scrub_rate bytes per second. The position in the pass is
+    saved, so restarts don't start over
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.stopping = threading.Event()
+        self.io_priority_idle = False
+        # held by the scrubber thread while it changes current, last_pass
+        # and mismatches, and by get_status() while it copies them
+        self.lock = threading.Lock()
+        self.current = None
+        self.last_pass = None
+        # path -> details of files that don't match their digest
+        self.mismatches = {}
+        self.cursor = None
+        self.saved = 0.0
+        self.throttle_started = 0.0
+        self.throttle_bytes = 0
+
+    def start(self) -> None:
+        self.load_state()
+        self.thread = threading.Thread(target=self.run, name="scrubber", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def get_state_path(self) -> str:
+        return os.path.join(settings.state_dir, "scrub.json")
+
+    def load_state(self) -> None:
+        try:
+            with open(self.get_state_path(), "r") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.exception(e)
+            return
+        self.cursor = tuple(state["cursor"]) if state["cursor"] else None
+        self.last_pass = state["last_pass"]
+        self.mismatches = state["mismatches"]
+
+    def save_state(self) -> None:
+        os.makedirs(settings.state_dir, exist_ok=True)
+        state_path = self.get_state_path()
+        with open(state_path + ".tmp", "w") as state_file:
+            json.dump(
+                {
+                    "cursor": self.cursor,
+                    "last_pass": self.last_pass,
+                    "mismatches": self.mismatches,
+                },
+                state_file,
+            )
+        os.replace(state_path + ".tmp", state_path)
+        self.saved = time.monotonic()
+
+    def throttle(self, size: int) -> None:
+        self.throttle_bytes += size
+        ahead = self.throttle_bytes / settings.scrub_rate - (
+            time.monotonic() - self.throttle_started
+        )
+        if ahead > 0:
+            self.stopping.wait(ahead)
+
+    def hash_file(self, path: str) -> str:
+        """
+        A method for hashing a file within the read budget
+        Returns:
+            sha256, None if the scrubber is stopping
+        """
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as file:
+            # don't push the files nginx serves out of the page cache
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_NOREUSE)
+            while chunk := file.read(CHUNK_SIZE):
+                sha256.update(chunk)
+                with self.lock:
+                    self.current["bytes"] += len(chunk)
+                SCRUB_BYTES.inc(len(chunk))
+                self.throttle(len(chunk))
+                if self.stopping.is_set():
+                    return None
+        return sha256.hexdigest()
+
+    def is_published(self, directory: str, path: str, sha256: str) -> bool:
+        # the index may have changed while the file was read
+        index = indexes[directory]
+        return collect_files(index.index).get(path) == sha256
+
+    def check(self, directory: str, path: str, sha256: str) -> None:
+        file_path = os.path.join(settings.files_dir, path)
+        try:
+            actual = self.hash_file(file_path)
+        except FileNotFoundError:
+            actual = "missing"
+        if actual is None:
+            return
+        with self.lock:
+            self.current["files"] += 1
+            if actual == sha256:
+                self.mismatches.pop(path, None)
+                return
+        if not self.is_published(directory, path, sha256):
+            return
+        logging.error(f"Scrub: {path} sha256 is {actual}, index has {sha256}")
+        with self.lock:
+            self.mismatches[path] = {
+                "directory": directory,
+                "expected": sha256,
+                "actual": actual,
+                "detected": int(time.time()),
+            }
+
+    def scrub_pass(self) -> None:
+        published = list_published_files()
+        files = published
+        if self.cursor:
+            files = [file for file in files if file[:2] > self.cursor]
+        with self.lock:
+            self.current = {
+                "started": int(time.time()),
+                "files": 0,
+                "bytes": 0,
+                "remaining": len(files),
+            }
+        self.throttle_started = time.monotonic()
+        self.throttle_bytes = 0
+        for directory, path, sha256 in files:
+            if self.stopping.is_set():
+                return
+            self.check(directory, path, sha256)
+            self.cursor = (directory, path)
+            with self.lock:
+                self.current["remaining"] -= 1
+            self.update_metrics()
+            if time.monotonic() - self.saved > settings.scrub_state_save_interval:
+                self.save_state()
+        # files that were replaced or unpublished since
+        published = {path for directory, path, sha256 in published}
+        with self.lock:
+            for path in self.mismatches.keys() - published:
+                del self.mismatches[path]
+            last_pass = {
+                **self.current,
+                "finished": int(time.time()),
+                "mismatches": len(self.mismatches),
+            }
+            del last_pass["remaining"]
+            self.last_pass = last_pass
+            self.current = None
+        self.update_metrics()
+        self.cursor = None
+        self.save_state()
+        logging.info(
+            f"Scrub pass done, {self.last_pass['files']} files, "
+            f"{self.last_pass['mismatches']} mismatches"
+        )
+
+    def update_metrics(self) -> None:
+        for directory in indexes:
+            SCRUB_MISMATCHES.labels(directory).set(
+                sum(m["directory"] == directory for m in self.mismatches.values())
+            )
+
+    def run(self) -> None:
+        self.io_priority_idle = set_idle_io_priority()
+        if not self.io_priority_idle:
+            logging.warning("Scrubber runs without idle IO priority")
+        while not self.stopping.is_set():
+            # before the first reindexes there is nothing to compare with
+            if not all(index.initialized for index in indexes.values()):
+                self.stopping.wait(5)
+                continue
+            started = time.time()
+            try:
+                self.scrub_pass()
+            except Exception:
+                logging.exception("Scrub pass failed")
+            if self.last_pass and self.cursor is None:
+                started = self.last_pass["started"]
+            self.stopping.wait(
+                max(settings.scrub_interval - (time.time() - started), 0)
+            )
+
+    def get_status(self) -> dict:
+        # copies, the scrubber thread keeps changing them while the response
+        # is serialized
+        with self.lock:
+            return {
+                "enabled": self.thread is not None and self.thread.is_alive(),
+                "rate": settings.scrub_rate,
+                "interval": settings.scrub_interval,
+                "io_priority_idle": self.io_priority_idle,
+                "current_pass": dict(self.current) if self.current else None,
+                "last_pass": self.last_pass,
+                "mismatches": dict(self.mismatches),
+            }
+
+
+scrubber = Scrubber()
+
+
+@router.get("/scrub")
+async def scrub_status_request():
+    """
+    Method for obtaining the state of the integrity scrubber
+    Returns:
+        Current and last pass, and files that don't match their digest
+    """
+    return scrubber.get_status()
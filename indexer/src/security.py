@@ -1,9 +1,17 @@
-import os
 from fastapi import Request
 from .settings import settings
 
 
 def check_token(request: Request) -> bool:
-    if os.path.basename(request.url.path) in settings.private_paths:
+    # private routes are either top-level (/metrics, /replication/...) or
+    # directly under an index (/firmware/reindex, /firmware/uploads/{id}),
+    # other segments are channel, branch or file names
+    path_parts = request.url.path.strip("/").split("/")
+    if path_parts[0] in settings.private_paths or (
+        len(path_parts) in (2, 3) and path_parts[1] in settings.private_paths
+    ):
+        # Bearer too, it is what Prometheus scrapes with
+        if request.headers.get("Authorization") == f"Bearer {settings.token}":
+            return True
         return request.headers.get("Token") == settings.token
     return True
@@ -1,25 +1,141 @@
 import os
-from pydantic import BaseModel
+import json
+from pydantic import BaseModel, model_validator
 from typing import List, Union
 import pathlib
 
 
+class RepositoryConfig(BaseModel):
+    directory: str
+    github_org: str
+    github_repo: str
+    # name of the environment variable holding the token, not the token
+    github_token_env: str
+    # lower reindexes first
+    priority: int = 0
+
+
+class PacksCatalogConfig(BaseModel):
+    directory: str
+    priority: int = 10
+
+
+class IndexesConfig(BaseModel):
+    repositories: List[RepositoryConfig] = []
+    pack_catalogs: List[PacksCatalogConfig] = []
+    raw_directories: List[str] = []
+
+    @model_validator(mode="after")
+    def check_directories(self) -> "IndexesConfig":
+        directories = [
+            *(config.directory for config in self.repositories),
+            *(config.directory for config in self.pack_catalogs),
+            *self.raw_directories,
+        ]
+        for directory in directories:
+            if not directory or "/" in directory or directory.startswith("."):
+                raise ValueError(f"Invalid index directory {directory!r}")
+        if len(set(directories)) != len(directories):
+            raise ValueError("Index directories must be unique")
+        return self
+
+
+def load_indexes_config(path: str) -> IndexesConfig:
+    """
+    A method for loading the declarative index definitions
+    Args:
+        path: JSON file, the firmware repository and asset packs if empty
+
+    Returns:
+        Index definitions
+    """
+    if not path:
+        return IndexesConfig(
+            repositories=[
+                RepositoryConfig(
+                    directory="firmware",
+                    github_org="Next-Flip",
+                    github_repo="Momentum-Firmware",
+                    github_token_env="INDEXER_FIRMWARE_GITHUB_TOKEN",
+                )
+            ],
+            pack_catalogs=[PacksCatalogConfig(directory="asset-packs")],
+        )
+    with open(path, "r") as file:
+        return IndexesConfig(**json.load(file))
+
+
 class Settings(BaseModel):
     port: int
     workers: int
     files_dir: str
     base_url: str
     token: str
-    github_org: str
     gelf_host: Union[str, None]
     gelf_port: Union[str, None]
     kubernetes_namespace: Union[str, None]
     kubernetes_app: Union[str, None]
     kubernetes_container: Union[str, None]
     kubernetes_pod: Union[str, None]
-    firmware_github_token: Union[str, None]
-    firmware_github_repo: str
     private_paths: List[str]
+    staging_dir: str
+    upload_manifest_ttl: int
+    resumable_upload_ttl: int
+    deltas_dir: str
+    delta_workers: int
+    delta_file_types: List[str]
+    delta_compression_level: int
+    state_dir: str
+    changes_history: int
+    changes_max_wait: int
+    previews_dir: str
+    preview_workers: int
+    preview_thumbnail_size: int
+    watch_files: bool
+    watch_debounce: float
+    github_refresh_interval: float
+    github_refresh_max_interval: float
+    github_refresh_budget_share: float
+    github_refresh_jitter: float
+    gc_batch_size: int
+    gc_batch_delay: float
+    gc_dry_run: bool
+    tracing: bool
+    indexes: IndexesConfig
+    reindex_workers: int
+    github_timeout: int
+    github_connect_retries: int
+    github_connect_backoff: float
+    startup_reindex_wait: float
+    not_ready_retry_after: int
+    replica_of: Union[str, None]
+    replica_dir: str
+    replica_poll_wait: int
+    replica_timeout: float
+    replica_retry_delay: float
+    hot_builds: int
+    retained_builds: int
+    cold_dir: str
+    cold_compression_level: int
+    cold_skip_compression_suffixes: List[str]
+    cold_restore_ttl: int
+    archive_buffer_size: int
+    archive_max_files: int
+    scrub_rate: int
+    scrub_interval: float
+    scrub_state_save_interval: float
+    cdn_purge_url: Union[str, None]
+    cdn_purge_token: Union[str, None]
+    cdn_purge_timeout: float
+    cdn_purge_retry_delay: float
+    cdn_max_age: int
+    cdn_surrogate_key_header: str
+    scan_cache_racy_window: float
+    max_concurrent_uploads: int
+    max_staged_bytes: int
+    upload_min_free_bytes: int
+    upload_retry_after: int
+    bundle_layout_cache_size: int
 
 
 settings = Settings(
@@ -28,14 +144,89 @@ settings = Settings(
     files_dir=str(pathlib.Path(__file__).parent.parent.parent / "files"),
     base_url="https://up.momentum-fw.dev/builds",
     token=os.getenv("INDEXER_TOKEN"),
-    github_org="Next-Flip",
     gelf_host=os.getenv("GELF_HOST"),
     gelf_port=os.getenv("GELF_PORT"),
     kubernetes_namespace=os.getenv("KUBERNETES_NAMESPACE"),
     kubernetes_app=os.getenv("KUBERNETES_APP"),
     kubernetes_container=os.getenv("KUBERNETES_CONTAINER"),
     kubernetes_pod=os.getenv("HOSTNAME"),
-    firmware_github_token=os.getenv("INDEXER_FIRMWARE_GITHUB_TOKEN"),
-    firmware_github_repo="Momentum-Firmware",
-    private_paths=["reindex", "uploadfiles", "uploadfilesraw"],
+    private_paths=[
+        "reindex",
+        "uploadfiles",
+        "uploadfilesraw",
+        "uploadarchive",
+        "uploadmanifest",
+        "uploadmanifestfiles",
+        "uploads",
+        "gc",
+        "metrics",
+        "profile",
+        "replication",
+        "scrub",
+    ],
+    staging_dir=str(pathlib.Path(__file__).parent.parent.parent / "files" / ".staging"),
+    upload_manifest_ttl=3600,
+    resumable_upload_ttl=86400,
+    deltas_dir=str(pathlib.Path(__file__).parent.parent.parent / "files" / ".deltas"),
+    delta_workers=2,
+    delta_file_types=["update_tgz"],
+    delta_compression_level=19,
+    state_dir=str(pathlib.Path(__file__).parent.parent.parent / "files" / ".state"),
+    changes_history=100,
+    changes_max_wait=60,
+    previews_dir=str(
+        pathlib.Path(__file__).parent.parent.parent / "files" / ".previews"
+    ),
+    preview_workers=2,
+    preview_thumbnail_size=256,
+    watch_files=os.getenv("INDEXER_WATCH_FILES", "") == "1",
+    watch_debounce=2.0,
+    github_refresh_interval=300,
+    github_refresh_max_interval=3600,
+    github_refresh_budget_share=0.5,
+    github_refresh_jitter=0.1,
+    gc_batch_size=20,
+    gc_batch_delay=1.0,
+    gc_dry_run=os.getenv("INDEXER_GC_DRY_RUN", "") == "1",
+    tracing=os.getenv("INDEXER_TRACING", "") == "1",
+    indexes=load_indexes_config(os.getenv("INDEXER_INDEXES_CONFIG", "")),
+    reindex_workers=4,
+    github_timeout=15,
+    github_connect_retries=2,
+    github_connect_backoff=1.0,
+    startup_reindex_wait=0,
+    not_ready_retry_after=5,
+    replica_of=os.getenv("INDEXER_REPLICA_OF") or None,
+    replica_dir=str(pathlib.Path(__file__).parent.parent.parent / "files" / ".replica"),
+    replica_poll_wait=55,
+    replica_timeout=60,
+    replica_retry_delay=10,
+    hot_builds=3,
+    retained_builds=20,
+    cold_dir=os.getenv("INDEXER_COLD_DIR")
+    or str(pathlib.Path(__file__).parent.parent.parent / "files" / ".cold"),
+    cold_compression_level=int(os.getenv("INDEXER_COLD_COMPRESSION_LEVEL", "0")),
+    cold_skip_compression_suffixes=[".tgz", ".zip", ".gz", ".zst"],
+    cold_restore_ttl=86400,
+    archive_buffer_size=8 * 1024 * 1024,
+    archive_max_files=512,
+    scrub_rate=int(os.getenv("INDEXER_SCRUB_RATE", str(4 * 1024 * 1024))),
+    scrub_interval=86400,
+    scrub_state_save_interval=30,
+    cdn_purge_url=os.getenv("INDEXER_CDN_PURGE_URL") or None,
+    cdn_purge_token=os.getenv("INDEXER_CDN_PURGE_TOKEN"),
+    cdn_purge_timeout=10,
+    cdn_purge_retry_delay=10,
+    cdn_max_age=86400,
+    cdn_surrogate_key_header="Surrogate-Key",
+    scan_cache_racy_window=1.0,
+    max_concurrent_uploads=int(os.getenv("INDEXER_MAX_CONCURRENT_UPLOADS", "4")),
+    max_staged_bytes=int(
+        os.getenv("INDEXER_MAX_STAGED_BYTES", str(2 * 1024 * 1024 * 1024))
+    ),
+    upload_min_free_bytes=int(
+        os.getenv("INDEXER_UPLOAD_MIN_FREE_BYTES", str(1024 * 1024 * 1024))
+    ),
+    upload_retry_after=30,
+    bundle_layout_cache_size=64,
 )
@@ -0,0 +1,204 @@
+import json
+import hashlib
+import msgpack
+from typing import Tuple
+
+from .settings import settings
+
+
+VERSION_FIELDS = ("version", "changelog", "timestamp", "files")
+# fields every version keeps, so a sliced version can still be identified
+REQUIRED_VERSION_FIELDS = ("version",)
+# (fields) variants serialized for every channel/target at reindex time,
+# anything else is serialized on first request and memoized until next reindex
+PRECOMPUTED_FIELDS = (None, ("files",))
+# bumped whenever the layout of the compact (msgpack) encoding changes
+COMPACT_FORMAT = 1
+
+
+def serialize(data) -> Tuple[bytes, str]:
+    """
+    A method for serializing an index (or part of it) the way JSONResponse does
+    Args:
+        data: Index in dict form
+
+    Returns:
+        Serialized body and its ETag
+    """
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return body, etag
+
+
+def match_etag(header: str, etag: str) -> bool:
+    """
+    A method for checking an If-None-Match header against an ETag, with
+    the weak comparison it calls for
+    Args:
+        header: If-None-Match value, a comma separated list of ETags or *
+        etag: Current ETag
+
+    Returns:
+        True if the client has the current version
+    """
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = (tag.strip().removeprefix("W/") for tag in header.split(","))
+    return etag.removeprefix("W/") in tags
+
+
+def compact(data, prefixes: dict):
+    """
+    A method for making an index (or part of it) smaller for msgpack:
+    urls under settings.base_url become [prefix id, file name] and sha256
+    digests raw bytes
+    Args:
+        data: Index in dict form
+        prefixes: Directory prefix -> id, filled with the ones used
+
+    Returns:
+        Compacted copy of the data
+    """
+    if isinstance(data, list):
+        return [compact(value, prefixes) for value in data]
+    if not isinstance(data, dict):
+        return data
+    base_url = settings.base_url + "/"
+    result = {}
+    for key, value in data.items():
+        if key.endswith("url") and isinstance(value, str):
+            if value.startswith(base_url):
+                prefix, _, name = value.removeprefix(base_url).rpartition("/")
+                value = [prefixes.setdefault(prefix, len(prefixes)), name]
+        elif key == "sha256" and isinstance(value, str) and len(value) == 64:
+            value = bytes.fromhex(value)
+        else:
+            value = compact(value, prefixes)
+        result[key] = value
+    return result
+
+
+def serialize_compact(data) -> Tuple[bytes, str]:
+    """
+    A method for serializing an index (or part of it) as compact msgpack.
+    Clients restore a url as `base_url + prefixes[id] + "/" + name`
+    Args:
+        data: Index in dict form
+
+    Returns:
+        Serialized body and its ETag
+    """
+    prefixes = {}
+    index = compact(data, prefixes)
+    body = msgpack.packb(
+        {
+            "format": COMPACT_FORMAT,
+            "base_url": settings.base_url + "/",
+            "prefixes": list(prefixes),
+            "index": index,
+        }
+    )
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return body, etag
+
+
+class IndexSlices:
+    """
+    Serialized views of an index filtered by channel, target and version
+    fields, built from one index snapshot and thrown away on reindex
+    """
+
+    def __init__(self, index: dict):
+        self.index = index
+        self.cache = {}
+        self.targets = self.get_targets() if "channels" in index else set()
+
+    def get_targets(self, channel: dict = None) -> set:
+        return {
+            file["target"]
+            for cur_channel in ([channel] if channel else self.index["channels"])
+            for version in cur_channel["versions"]
+            for file in version["files"]
+        }
+
+    def normalize(self, channel: str, target: str, fields: str) -> tuple:
+        if (channel or target or fields) and "channels" not in self.index:
+            raise ValueError("Filters are not supported for this index")
+        if target:
+            target = target.replace("-", "/")
+        if fields:
+            fields = set(filter(None, fields.split(",")))
+            unknown = fields.difference(VERSION_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+            # empty when only required fields are asked for, unlike None
+            fields = tuple(sorted(fields.difference(REQUIRED_VERSION_FIELDS)))
+        else:
+            fields = None
+        if channel and not any(c["id"] == channel for c in self.index["channels"]):
+            raise KeyError(f"Channel `{channel}` not found!")
+        if target and target not in self.targets:
+            raise KeyError(f"Target `{target}` not found!")
+        return channel or None, target or None, fields
+
+    def build(self, channel: str, target: str, fields: tuple) -> dict:
+        if channel is None and target is None and fields is None:
+            return self.index
+        channels = []
+        for cur_channel in self.index["channels"]:
+            if channel is not None and cur_channel["id"] != channel:
+                continue
+            versions = []
+            for version in cur_channel["versions"]:
+                if fields is not None:
+                    keep = REQUIRED_VERSION_FIELDS + fields
+                    version = {k: v for k, v in version.items() if k in keep}
+                if target is not None and "files" in version:
+                    version = {
+                        **version,
+                        "files": [f for f in version["files"] if f["target"] == target],
+                    }
+                versions.append(version)
+            channels.append({**cur_channel, "versions": versions})
+        return {**self.index, "channels": channels}
+
+    def get(
+        self,
+        channel: str = None,
+        target: str = None,
+        fields: str = None,
+        compact: bool = False,
+    ) -> Tuple[bytes, str]:
+        """
+        A method to get a serialized slice of the index
+        Args:
+            channel: Channel id, all channels if empty
+            target: File target, all targets if empty
+            fields: Comma separated version fields, all fields if empty
+            compact: Compact msgpack instead of json
+
+        Returns:
+            Serialized body and its ETag
+        """
+        key = self.normalize(channel, target, fields)
+        if compact:
+            if (*key, "msgpack") not in self.cache:
+                self.cache[(*key, "msgpack")] = serialize_compact(self.build(*key))
+            return self.cache[(*key, "msgpack")]
+        if key not in self.cache:
+            self.cache[key] = serialize(self.build(*key))
+        return self.cache[key]
+
+    def precompute(self) -> None:
+        """
+        A method for serializing the common slices ahead of requests
+        """
+        self.get()
+        self.get(compact=True)
+        for channel in self.index.get("channels", []):
+            for target in (None, *sorted(self.get_targets(channel))):
+                for fields in PRECOMPUTED_FIELDS:
+                    key = (channel["id"], target, fields)
+                    self.cache[key] = serialize(self.build(*key))
@@ -0,0 +1,308 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+import subprocess
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, FileResponse
+
+from .metrics import locked
+from .reindex_pool import get_index_lock
+from .settings import settings
+
+
+router = APIRouter()
+
+COLD_SUFFIX = ".zst"
+
+# keeps references to running tiering tasks, asyncio only holds weak ones
+background_tasks = set()
+# restored path -> task decompressing it, shared by concurrent requests
+restoring = {}
+
+
+def get_cold_path(path: str) -> str:
+    """
+    A method to get where a file or directory under files_dir goes in the
+    cold area, the layout is the same
+    """
+    return os.path.join(settings.cold_dir, os.path.relpath(path, settings.files_dir))
+
+
+def get_restored_dir() -> str:
+    return os.path.join(settings.cold_dir, ".restored")
+
+
+def list_files_newest_first(path: str) -> list:
+    if not os.path.isdir(path):
+        return []
+    with os.scandir(path) as entries:
+        files = [
+            entry
+            for entry in entries
+            if not entry.name.startswith(".") and entry.is_file()
+        ]
+    files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [entry.path for entry in files]
+
+
+def get_hot_builds() -> int:
+    return min(settings.hot_builds, settings.retained_builds)
+
+
+def select_cold_files(dest_dir: str, files_per_build: int) -> list:
+    """
+    A method to get the files to move out of a branch directory to make
+    room for a new build. The newest settings.hot_builds builds stay where
+    nginx serves them, older ones move to the cold area. Builds are told
+    apart by mtime, like the cleanup this replaces
+    Args:
+        dest_dir: Branch directory
+        files_per_build: Files in the new build
+
+    Returns:
+        List of paths, see schedule_tiering()
+    """
+    return list_files_newest_first(dest_dir)[files_per_build * get_hot_builds() :]
+
+
+def stage_cold_file(path: str) -> tuple:
+    """
+    A method for copying a file to a temporary file in the cold area, zstd
+    compressed if settings.cold_compression_level is set, without the
+    index lock. The mtime is kept, builds are told apart by it
+    Args:
+        path: File under files_dir
+
+    Returns:
+        Stat of the file, path of the copy (None if the file can just be
+        renamed) and path of the cold file
+    """
+    stat = os.stat(path)
+    cold_path = get_cold_path(path)
+    cold_dir = os.path.dirname(cold_path)
+    os.makedirs(cold_dir, exist_ok=True)
+    compress = settings.cold_compression_level > 0 and not path.endswith(
+        tuple(settings.cold_skip_compression_suffixes)
+    )
+    if not compress and os.stat(cold_dir).st_dev == stat.st_dev:
+        return stat, None, cold_path
+    if compress:
+        cold_path += COLD_SUFFIX
+    # hidden, so the cold builds listed by list_files_newest_first() don't
+    # include it
+    fd, tmp_path = tempfile.mkstemp(dir=cold_dir, prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        if compress:
+            subprocess.check_call(
+                [
+                    "zstd",
+                    "-q",
+                    "-f",
+                    f"-{settings.cold_compression_level}",
+                    path,
+                    "-o",
+                    tmp_path,
+                ]
+            )
+        else:
+            shutil.copyfile(path, tmp_path)
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return stat, tmp_path, cold_path
+
+
+def commit_cold_files(dest_dir: str, staged: list, files_per_build: int) -> None:
+    """
+    A method for swapping staged cold files in for the hot ones, and keeping
+    only settings.retained_builds builds in total. Call it with the index
+    lock held
+    Args:
+        dest_dir: Branch directory
+        staged: List of (path, *stage_cold_file())
+        files_per_build: Files in the new build
+
+    Returns:
+        Nothing
+    """
+    for path, stat, tmp_path, cold_path in staged:
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            current = None
+        # tiered by an upload before, deleted, or uploaded again meanwhile
+        if current is None or (current.st_ino, current.st_mtime_ns) != (
+            stat.st_ino,
+            stat.st_mtime_ns,
+        ):
+            # the orphan sweep of GC may have removed the branch already
+            if tmp_path and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            continue
+        # the orphan sweep removes empty cold directories
+        os.makedirs(os.path.dirname(cold_path), exist_ok=True)
+        if tmp_path:
+            os.replace(tmp_path, cold_path)
+            os.remove(path)
+        else:
+            os.rename(path, cold_path)
+    cold_files = list_files_newest_first(get_cold_path(dest_dir))
+    retained = files_per_build * (settings.retained_builds - get_hot_builds())
+    for path in cold_files[retained:]:
+        os.remove(path)
+
+
+async def tier_builds(
+    directory: str, dest_dir: str, paths: list, files_per_build: int
+) -> None:
+    """
+    A method for moving older builds of a branch to the cold area. Files are
+    compressed or copied without the index lock, it is only held to swap
+    them in
+    Args:
+        directory: Repository name
+        dest_dir: Branch directory
+        paths: Files to move, see select_cold_files()
+        files_per_build: Files in the new build
+
+    Returns:
+        Nothing
+    """
+    staged = []
+    try:
+        for path in paths:
+            try:
+                staged.append((path, *await asyncio.to_thread(stage_cold_file, path)))
+            except FileNotFoundError:
+                continue
+        async with locked(get_index_lock(directory), "tiering"):
+            await asyncio.to_thread(
+                commit_cold_files, dest_dir, staged, files_per_build
+            )
+            staged = []
+    finally:
+        for _, _, tmp_path, _ in staged:
+            if tmp_path and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+
+def schedule_tiering(
+    directory: str, dest_dir: str, paths: list, files_per_build: int
+) -> None:
+    """
+    A method for starting tier_builds() in the background, so the upload
+    response doesn't wait for it
+    """
+    if not paths:
+        return
+
+    def done(task: asyncio.Task) -> None:
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Tiering builds of {dest_dir} failed")
+            logging.exception(task.exception())
+
+    task = asyncio.get_running_loop().create_task(
+        tier_builds(directory, dest_dir, paths, files_per_build)
+    )
+    background_tasks.add(task)
+    task.add_done_callback(done)
+
+
+def delete_orphaned_cold(directory: str) -> None:
+    """
+    A method for removing cold builds of branches that have no build
+    directory anymore, and restored files that weren't asked for in
+    settings.cold_restore_ttl seconds
+    Args:
+        directory: Repository name
+
+    Returns:
+        Nothing
+    """
+    main_dir = os.path.join(settings.cold_dir, directory)
+    if os.path.isdir(main_dir):
+        for root, dirs, files in os.walk(main_dir, topdown=False):
+            branch = os.path.relpath(root, main_dir)
+            if branch == ".":
+                continue
+            branch_dir = os.path.join(settings.files_dir, directory, branch)
+            if files and not os.path.isdir(branch_dir):
+                shutil.rmtree(root)
+                logging.info(f"Deleting cold builds of {branch}")
+            elif not files and not os.listdir(root):
+                os.rmdir(root)
+    restored_dir = os.path.join(get_restored_dir(), directory)
+    if os.path.isdir(restored_dir):
+        expired = time.time() - settings.cold_restore_ttl
+        for root, dirs, files in os.walk(restored_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.stat(path).st_mtime < expired:
+                    os.remove(path)
+
+
+def restore(cold_path: str, restored_path: str) -> None:
+    os.makedirs(os.path.dirname(restored_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(restored_path), prefix=".", suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        subprocess.check_call(["zstd", "-q", "-d", "-f", cold_path, "-o", tmp_path])
+        os.replace(tmp_path, restored_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+async def restore_once(cold_path: str, restored_path: str) -> None:
+    """
+    A method for restoring a cold file, concurrent requests for the same
+    file wait for one decompression
+    """
+    task = restoring.get(restored_path)
+    if task is None:
+        task = asyncio.ensure_future(
+            asyncio.to_thread(restore, cold_path, restored_path)
+        )
+        restoring[restored_path] = task
+        task.add_done_callback(lambda _: restoring.pop(restored_path, None))
+    # a cancelled request must not cancel the restore others wait for
+    await asyncio.shield(task)
+
+
+@router.get("/cold/{path:path}")
+async def cold_file_request(path: str):
+    """
+    Method for downloading a build that was moved to the cold area, nginx
+    falls back to it when a file is not on the hot volume. Compressed files
+    are restored on first request and kept for settings.cold_restore_ttl
+    Args:
+        path: File path relative to files_dir, as in its url
+
+    Returns:
+        File
+    """
+    path = os.path.normpath(path)
+    if path.startswith(("..", "/", ".")):
+        return JSONResponse("File not found!", status_code=404)
+    cold_path = os.path.join(settings.cold_dir, path)
+    if os.path.isfile(cold_path):
+        return FileResponse(cold_path, media_type="application/octet-stream")
+    if not os.path.isfile(cold_path + COLD_SUFFIX):
+        return JSONResponse("File not found!", status_code=404)
+    restored_path = os.path.join(get_restored_dir(), path)
+    try:
+        if not os.path.isfile(restored_path):
+            await restore_once(cold_path + COLD_SUFFIX, restored_path)
+        os.utime(restored_path)
+    except Exception as e:
+        logging.exception(e)
+        return JSONResponse("Restoring the file failed!", status_code=500)
+    return FileResponse(restored_path, media_type="application/octet-stream")
@@ -0,0 +1,147 @@
+import time
+import uuid
+import logging
+import functools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from .settings import settings
+
+
+router = APIRouter()
+logger = logging.getLogger("indexer.trace")
+current_span = contextvars.ContextVar("current_span", default=None)
+# folded stack ("a;b;c") -> self time in microseconds, see get_profile()
+profile = Counter()
+
+
+class Span:
+    """
+    One timed stage of a trace. Stages count what they processed in
+    `files` and `bytes`, other attributes go in `fields`
+    """
+
+    def __init__(self, name: str, parent: "Span" = None, **fields):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.stack = f"{parent.stack};{name}" if parent else name
+        self.fields = fields
+        self.files = 0
+        self.bytes = 0
+        self.children_ns = 0
+        self.started_ns = time.perf_counter_ns()
+
+    def finish(self, error: BaseException = None) -> None:
+        duration_ns = time.perf_counter_ns() - self.started_ns
+        if self.parent:
+            self.parent.children_ns += duration_ns
+            self.parent.files += self.files
+            self.parent.bytes += self.bytes
+        profile[self.stack] += max(duration_ns - self.children_ns, 0) // 1000
+        if not settings.tracing:
+            return
+        extra = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent.span_id if self.parent else "",
+            "span": self.name,
+            "duration_ms": round(duration_ns / 1e6, 3),
+            "files": self.files,
+            "bytes": self.bytes,
+            **{f"span_{k}": v for k, v in self.fields.items()},
+        }
+        if error is not None:
+            extra["error"] = repr(error)
+        logger.info(
+            f"span {self.name} {extra['duration_ms']}ms, "
+            f"{self.files} files, {self.bytes} bytes",
+            extra=extra,
+        )
+
+
+@contextmanager
+def span(name: str, **fields):
+    """
+    A method to time a stage, nested spans share the trace id of the
+    outermost one. Use as `with span("stage", branch=branch) as s:`
+    and count work with `s.files += 1`, `s.bytes += size`
+    """
+    parent = current_span.get()
+    cur = Span(name, parent, **fields)
+    token = current_span.set(cur)
+    try:
+        yield cur
+    except BaseException as e:
+        cur.finish(e)
+        raise
+    else:
+        cur.finish()
+    finally:
+        current_span.reset(token)
+
+
+def annotate(**fields) -> None:
+    """
+    A method to add attributes to the current span, if any
+    """
+    cur = current_span.get()
+    if cur is not None:
+        cur.fields.update(fields)
+
+
+def count(files: int = 0, bytes: int = 0) -> None:
+    """
+    A method to count processed files and bytes in the current span, if any
+    """
+    cur = current_span.get()
+    if cur is not None:
+        cur.files += files
+        cur.bytes += bytes
+
+
+def traced(name: str):
+    """
+    Decorator version of span() for functions without interesting fields
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_profile() -> str:
+    """
+    A method to get the collected span times in the folded stack format
+    read by flamegraph.pl, inferno and speedscope
+    Returns:
+        One `stack;of;spans microseconds` line per stack
+    """
+    return "".join(f"{stack} {us}\n" for stack, us in sorted(profile.items()) if us)
+
+
+@router.get("/profile")
+async def profile_request(reset: bool = False):
+    """
+    Method for dumping the span profile collected since the start or the
+    last reset, e.g. `curl .../profile | flamegraph.pl > profile.svg`
+    Args:
+        reset: Clear the profile after dumping it
+
+    Returns:
+        Folded stacks
+    """
+    body = get_profile()
+    if reset:
+        profile.clear()
+    return PlainTextResponse(body)
@@ -0,0 +1,204 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+
+from .repository import indexes, RepositoryIndex, PacksCatalog
+from .metrics import locked
+from .reindex_pool import pool, get_index_lock
+from .settings import settings
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class FilesWatcher:
+    """
+    Watches settings.files_dir with inotify and runs the partial reindex
+    matching every changed branch directory or pack, after a quiet period
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = None
+        self.watches = {}
+        # (index name, branch or pack id) -> newest path that changed
+        self.pending = {}
+        self.debounce_handle = None
+        self.task = None
+
+    def add_watch(self, path: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logging.warning(f"Can't watch {path}: {os.strerror(errno)}")
+            return
+        self.watches[wd] = path
+
+    def add_watch_tree(self, path: str) -> None:
+        self.add_watch(path)
+        for root, dirs, files in os.walk(path):
+            # skip .git, .staging, .deltas and friends
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for cur in dirs:
+                self.add_watch(os.path.join(root, cur))
+
+    def start(self) -> None:
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.add_watch(settings.files_dir)
+        for directory in indexes:
+            index_path = os.path.join(settings.files_dir, directory)
+            if os.path.isdir(index_path):
+                self.add_watch_tree(index_path)
+        asyncio.get_running_loop().add_reader(self.fd, self.read_events)
+        logging.info(f"Watching {len(self.watches)} directories")
+
+    def stop(self) -> None:
+        if self.fd is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.fd)
+        if self.debounce_handle:
+            self.debounce_handle.cancel()
+        os.close(self.fd)
+        self.fd = None
+
+    def map_path(self, path: str, is_dir: bool) -> tuple:
+        """
+        A method to map a changed path to what has to be reindexed
+        Args:
+            path: Changed file or directory
+            is_dir: Whether the path is a directory
+
+        Returns:
+            (index name, branch or pack id), or None if nothing is affected
+        """
+        parts = os.path.relpath(path, settings.files_dir).split(os.sep)
+        if len(parts) < 2 or parts[0] not in indexes:
+            return None
+        if any(part.startswith(".") for part in parts[1:-1]):
+            return None
+        index = indexes[parts[0]]
+        if isinstance(index, RepositoryIndex):
+            # artifacts live directly in the branch directory, branch names
+            # may contain slashes
+            branch_parts = parts[1:] if is_dir else parts[1:-1]
+            if not branch_parts or branch_parts[-1].startswith("."):
+                return None
+            return parts[0], "/".join(branch_parts)
+        if isinstance(index, PacksCatalog):
+            if parts[1].startswith("."):
+                return None
+            return parts[0], parts[1]
+        return None
+
+    def read_events(self) -> None:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflow, doing full reindex")
+                for directory in indexes:
+                    self.pending[(directory, None)] = settings.files_dir
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue
+            path = os.path.join(parent, os.fsdecode(name)) if name else parent
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                if not os.path.basename(path).startswith("."):
+                    self.add_watch_tree(path)
+            key = self.map_path(path, is_dir)
+            if key is not None:
+                self.pending[key] = path
+        if self.pending:
+            if self.debounce_handle:
+                self.debounce_handle.cancel()
+            self.debounce_handle = asyncio.get_running_loop().call_later(
+                settings.watch_debounce, self.flush
+            )
+
+    def flush(self) -> None:
+        self.debounce_handle = None
+        if self.task is not None and not self.task.done():
+            # a flush is still running, try again after another quiet period
+            self.debounce_handle = asyncio.get_running_loop().call_later(
+                settings.watch_debounce, self.flush
+            )
+            return
+        pending, self.pending = self.pending, {}
+        self.task = asyncio.get_running_loop().create_task(self.reindex(pending))
+
+    def is_changed_since_reindex(self, index, path: str) -> bool:
+        # uploads and reindexes touch the tree themselves, those changes are
+        # older than the end of the last reindex and are already indexed.
+        # Deletions only show up in the mtime of the nearest existing parent
+        while not os.path.exists(path) and path != settings.files_dir:
+            path = os.path.dirname(path)
+        for cur in (path, os.path.dirname(path)):
+            try:
+                if os.stat(cur).st_mtime_ns > index.last_reindex_ns:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    async def reindex(self, pending: dict) -> None:
+        full = {directory for directory, key in pending if key is None}
+        results = await asyncio.gather(
+            *(pool.submit(indexes[directory]) for directory in full),
+            return_exceptions=True,
+        )
+        for directory, result in zip(full, results):
+            if isinstance(result, Exception):
+                logging.error(f"Watcher {directory} reindex failed")
+        for (directory, key), path in pending.items():
+            index = indexes[directory]
+            if directory in full:
+                continue
+            if isinstance(index, RepositoryIndex):
+                partial_reindex = index.reindex_branch
+            else:
+                partial_reindex = index.reindex_pack
+            async with locked(get_index_lock(directory), "watcher"):
+                if not await asyncio.to_thread(
+                    self.is_changed_since_reindex, index, path
+                ):
+                    continue
+                # off the event loop, like full reindexes in the pool
+                try:
+                    await asyncio.to_thread(partial_reindex, key)
+                except Exception:
+                    logging.exception(f"Watcher {directory}/{key} reindex failed")